@@ -0,0 +1,83 @@
+# 非同期タスク (/async_task) の投入先を差し替えるための抽象
+#
+# * CloudTasksDispatcher: Cloud Tasks にキュー追加する (本番)
+# * LocalTaskDispatcher: 同一プロセス内のキューに積んで、handler で順に実行する (テスト、ローカル実行)
+
+from abc import ABC, abstractmethod
+from collections import deque
+from collections.abc import Callable
+from typing import Any
+
+from src.async_task import google as async_task_google
+from src.logger import logger
+
+
+class TaskDispatcher(ABC):
+    """/async_task の kind と data を受け取って、非同期に実行されるように投入する"""
+
+    @abstractmethod
+    def dispatch(
+        self,
+        kind: str,
+        data: dict[str, Any] | None = None,
+        scheduled_seconds_from_now: int | None = None,
+    ) -> None: ...
+
+
+class CloudTasksDispatcher(TaskDispatcher):
+    """Cloud Tasks 経由で自身の /async_task に投入する"""
+
+    def __init__(self, deadline_in_seconds: int | None = None):
+        self.deadline_in_seconds = deadline_in_seconds
+
+    def dispatch(
+        self,
+        kind: str,
+        data: dict[str, Any] | None = None,
+        scheduled_seconds_from_now: int | None = None,
+    ) -> None:
+        async_task_google.enqueue_async_task(
+            kind,
+            data,
+            scheduled_seconds_from_now=scheduled_seconds_from_now,
+            deadline_in_seconds=self.deadline_in_seconds,
+        )
+
+
+class LocalTaskDispatcher(TaskDispatcher):
+    """
+    同一プロセス内で実行する dispatcher。dispatch されたタスクはキューに積むだけで、
+    run_until_empty を呼んだ時点で handler(kind, data) を投入順に実行する。
+    scheduled_seconds_from_now は無視する (遅延させたいタスクも、先に積まれたタスクの後に実行される)。
+    """
+
+    def __init__(self, handler: Callable[[str, dict[str, Any] | None], None]):
+        self.handler = handler
+        self._queue: deque[tuple[str, dict[str, Any] | None]] = deque()
+        # 実行したタスクの kind の履歴
+        self.executed: list[str] = []
+
+    def dispatch(
+        self,
+        kind: str,
+        data: dict[str, Any] | None = None,
+        scheduled_seconds_from_now: int | None = None,
+    ) -> None:
+        logger.info(f"local task dispatched: {kind}")
+        self._queue.append((kind, data))
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def run_until_empty(self, max_tasks: int = 1000) -> int:
+        """キューが空になるまで実行し、実行したタスク数を返す。
+        タスクが再投入され続ける場合に備えて max_tasks で打ち切る。"""
+        count = 0
+        while self._queue:
+            if count >= max_tasks:
+                raise ValueError(f"too many tasks: {max_tasks}")
+            kind, data = self._queue.popleft()
+            self.handler(kind, data)
+            self.executed.append(kind)
+            count += 1
+        return count
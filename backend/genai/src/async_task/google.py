@@ -11,7 +11,15 @@ from src.logger import logger
 # 現状、queueは worker 1つのみを想定
 WORKER_QUEUE_NAME = "async-task-worker"
 
-cloudtasks_client = tasks.CloudTasksClient()
+# クライアントの作成には認証情報が必要なので、import 時ではなく最初に投入する時に作る
+_cloudtasks_client: tasks.CloudTasksClient | None = None
+
+
+def _get_cloudtasks_client() -> tasks.CloudTasksClient:
+    global _cloudtasks_client
+    if _cloudtasks_client is None:
+        _cloudtasks_client = tasks.CloudTasksClient()
+    return _cloudtasks_client
 
 
 def _create_http_task(
@@ -36,6 +44,7 @@ def _create_http_task(
     """
     project_id = os.getenv("GOOGLE_CLOUD_PROJECT", "")
     location = os.getenv("GOOGLE_CLOUD_LOCATION", "")
+    cloudtasks_client = _get_cloudtasks_client()
 
     task = tasks.Task(
         http_request=tasks.HttpRequest(
@@ -0,0 +1,222 @@
+# blob.storage の async 版
+#
+# google-cloud-storage のクライアントは同期 I/O なので、async def のハンドラから直接呼ぶと
+# アップロード・ダウンロードの間イベントループが止まる。
+# ここでは同じ関数 (同じパス、同じ metadata) を上限付きの I/O 用スレッドプールで実行し、await できるようにする。
+# 複数の blob 操作は asyncio.gather で並行に待てる。
+#
+# 例:
+#   script_blob, audio_blob = await asyncio.gather(
+#       async_storage.put_tts_script_file(sig, script),
+#       async_storage.put_tts_audio_file(sig, audio),
+#   )
+
+import asyncio
+import functools
+import io
+import os
+import threading
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, BinaryIO
+
+from google.cloud import storage as gcs  # type: ignore
+
+from src.blob import storage
+from src.blob.storage import OaiPmhCacheIndex, RssCacheValidators
+from src.logger import logger
+
+# GCS への同時 I/O 数の上限
+BLOB_IO_MAX_WORKERS = int(os.getenv("BLOB_IO_MAX_WORKERS", "16"))
+
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=BLOB_IO_MAX_WORKERS, thread_name_prefix="blob_io"
+            )
+        return _executor
+
+
+def shutdown_executor() -> None:
+    """I/O 用スレッドプールを終了する。実行中の I/O は完了を待つ。lifespan の終了時に呼ぶ。"""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+        logger.info("blob I/O executor shut down")
+
+
+async def _run[T](func: Callable[..., T], *args, **kwargs) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _get_executor(), functools.partial(func, *args, **kwargs)
+    )
+
+
+# 呼び出し時に storage の関数を参照するので、テストで storage 側を差し替えてもそのまま使える
+
+
+async def upload_blob_file(
+    blob_path: str,
+    file: BinaryIO,
+    metadata: dict[str, Any],
+    content_type: str,
+    acl: str | None = None,
+    content_encoding: str | None = None,
+) -> gcs.Blob:
+    return await _run(
+        storage._upload_blob_file,
+        blob_path,
+        file,
+        metadata,
+        content_type,
+        acl=acl,
+        content_encoding=content_encoding,
+    )
+
+
+async def upload_blob_string(
+    blob_path: str,
+    s: str,
+    metadata: dict[str, Any],
+    content_type: str,
+    acl: str | None = None,
+) -> gcs.Blob:
+    return await _run(
+        storage._upload_blob_string, blob_path, s, metadata, content_type, acl=acl
+    )
+
+
+async def put_tts_script_file(signature: str, script: str) -> gcs.Blob:
+    return await _run(storage.put_tts_script_file, signature, script)
+
+
+async def put_tts_audio_file(signature: str, file: BinaryIO) -> gcs.Blob:
+    return await _run(storage.put_tts_audio_file, signature, file)
+
+
+async def put_rss_xml_file(
+    last_build_date: datetime,
+    prefix_dir: str,
+    file: BinaryIO,
+    suffix_dir: str,
+    etag: str | None = None,
+    last_modified: str | None = None,
+) -> gcs.Blob:
+    return await _run(
+        storage.put_rss_xml_file,
+        last_build_date=last_build_date,
+        prefix_dir=prefix_dir,
+        file=file,
+        suffix_dir=suffix_dir,
+        etag=etag,
+        last_modified=last_modified,
+    )
+
+
+async def put_rss_validators(
+    prefix_dir: str, suffix_dir: str, validators: RssCacheValidators
+) -> gcs.Blob | None:
+    return await _run(storage.put_rss_validators, prefix_dir, suffix_dir, validators)
+
+
+async def get_rss_validators(
+    prefix_dir: str, suffix_dir: str
+) -> RssCacheValidators | None:
+    return await _run(storage.get_rss_validators, prefix_dir, suffix_dir)
+
+
+async def get_rss_xml_file(blob_path: str) -> io.BytesIO | None:
+    return await _run(storage.get_rss_xml_file, blob_path)
+
+
+async def put_oai_pmh_json(signature: str, prefix_dir: str, json_str: str) -> gcs.Blob:
+    return await _run(storage.put_oai_pmh_json, signature, prefix_dir, json_str)
+
+
+async def put_oai_pmh_harvest_state(repository: str, json_str: str) -> gcs.Blob:
+    return await _run(storage.put_oai_pmh_harvest_state, repository, json_str)
+
+
+async def get_oai_pmh_harvest_state(repository: str) -> str | None:
+    return await _run(storage.get_oai_pmh_harvest_state, repository)
+
+
+async def put_combined_json_file(signature: str, json_str: str) -> gcs.Blob:
+    return await _run(storage.put_combined_json_file, signature, json_str)
+
+
+async def put_masterdata_partition(
+    signature: str, day: str, lines: Iterable[str]
+) -> gcs.Blob:
+    return await _run(storage.put_masterdata_partition, signature, day, list(lines))
+
+
+async def put_masterdata_index(signature: str, json_str: str) -> gcs.Blob:
+    return await _run(storage.put_masterdata_index, signature, json_str)
+
+
+async def put_masterdata_checkpoint_segment(
+    signature: str, segment: int, json_str: str
+) -> gcs.Blob:
+    return await _run(
+        storage.put_masterdata_checkpoint_segment, signature, segment, json_str
+    )
+
+
+async def put_masterdata_checkpoint_cursor(signature: str, segments: int) -> gcs.Blob:
+    return await _run(storage.put_masterdata_checkpoint_cursor, signature, segments)
+
+
+async def get_masterdata_checkpoint_segments(signature: str) -> list[str]:
+    return await _run(storage.get_masterdata_checkpoint_segments, signature)
+
+
+async def delete_masterdata_checkpoint(signature: str) -> None:
+    await _run(storage.delete_masterdata_checkpoint, signature)
+
+
+async def put_masterdata_shard(signature: str, shard: int, json_str: str) -> gcs.Blob:
+    return await _run(storage.put_masterdata_shard, signature, shard, json_str)
+
+
+async def get_masterdata_shard(signature: str, shard: int) -> str | None:
+    return await _run(storage.get_masterdata_shard, signature, shard)
+
+
+async def delete_masterdata_shards(signature: str, shards: int) -> None:
+    await _run(storage.delete_masterdata_shards, signature, shards)
+
+
+async def get_closest_cached_rss_file(
+    target_utc: datetime, prefix_dir: str, suffix_dir: str = "non"
+) -> io.BytesIO | None:
+    return await _run(
+        storage.get_closest_cached_rss_file, target_utc, prefix_dir, suffix_dir
+    )
+
+
+async def get_closest_cached_oai_pmh_file(
+    target_isbn: str, prefix_dir: str
+) -> io.BytesIO | None:
+    return await _run(storage.get_closest_cached_oai_pmh_file, target_isbn, prefix_dir)
+
+
+async def get_cached_oai_pmh_file_with_index(
+    index: OaiPmhCacheIndex, target_isbn: str, prefix_dir: str
+) -> io.BytesIO | None:
+    return await _run(
+        storage.get_cached_oai_pmh_file_with_index, index, target_isbn, prefix_dir
+    )
+
+
+async def get_json_file(blob_path: str) -> str:
+    return await _run(storage.get_json_file, blob_path)
@@ -0,0 +1,324 @@
+# blob.storage の保存先を GCS の代わりにローカルディスクにする backend
+#
+# blob.storage が使う google.cloud.storage の Bucket / Blob の機能
+# (blob, get_blob, list_blobs, upload_from_file/string, download_*, open, delete) を、同じ意味で実装する。
+# GCS のエミュレータなしで、ワークフロー全体をディスクの速度でベンチマーク・負荷試験するために使う。
+#
+# * 内容は <root>/objects/<blob path>、metadata (generation, time_created, content_type など) は
+#   <root>/meta/<blob path>.json に置く
+# * 書き込みは同じディレクトリの一時ファイルに書いてから os.replace するので、読み手が書きかけの内容を見ることはない
+# * 読み出しは mmap で行い、ファイル全体をコピーしない
+# * generation は書き込みごとに増え、if_generation_match (0 は存在しないこと) を検査する。
+#   generation の検査と書き込みはバケット単位のロックで行うので、1つのプロセスから使う想定
+# * list_blobs は GCS と同じく prefix は文字列の前方一致で、名前の順に返す
+# * ファイルとディレクトリが同じ名前になる blob (a と a/b) は同時には置けない
+
+import gzip
+import io
+import json
+import mmap
+import os
+import tempfile
+import threading
+import time
+from collections.abc import Callable, Iterator
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import Any, BinaryIO
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+from src.logger import logger
+
+OBJECTS_DIR = "objects"
+META_DIR = "meta"
+
+
+class _MmapReader(io.RawIOBase):
+    """mmap したファイルを先頭から読む stream。io.BufferedReader で包んで使う。"""
+
+    def __init__(self, path: Path):
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:  # type: ignore[override]
+        data = self._mmap[self._pos : self._pos + len(b)]
+        n = len(data)
+        b[:n] = data
+        self._pos += n
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            self._mmap.close()
+            self._file.close()
+        super().close()
+
+
+class LocalBlob:
+    """ローカルディスク上の blob。google.cloud.storage.Blob のうち blob.storage が使う部分を実装する。"""
+
+    def __init__(self, bucket: "LocalBucket", name: str, generation: int | None = None):
+        self.bucket = bucket
+        self.name = name
+        # 指定した場合は、その generation の内容だけを読む
+        self._requested_generation = generation
+        self.metadata: dict[str, Any] | None = None
+        self.content_type: str | None = None
+        self.content_encoding: str | None = None
+        self.generation: int | None = None
+        self.time_created: datetime | None = None
+        self.size: int | None = None
+
+    @property
+    def public_url(self) -> str:
+        return self.bucket.object_path(self.name).as_uri()
+
+    def _load(self, meta: dict[str, Any]) -> None:
+        self.metadata = meta.get("metadata")
+        self.content_type = meta.get("content_type")
+        self.content_encoding = meta.get("content_encoding")
+        self.generation = meta["generation"]
+        self.time_created = datetime.fromisoformat(meta["time_created"])
+        self.size = meta["size"]
+
+    def reload(self) -> None:
+        meta = self.bucket.read_meta(self.name)
+        if meta is None or (
+            self._requested_generation is not None
+            and meta["generation"] != self._requested_generation
+        ):
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        self._load(meta)
+
+    def exists(self) -> bool:
+        try:
+            self.reload()
+        except NotFound:
+            return False
+        return True
+
+    def upload_from_file(
+        self,
+        file: BinaryIO,
+        content_type: str | None = None,
+        predefined_acl: str | None = None,
+        if_generation_match: int | None = None,
+    ) -> None:
+        self._upload(file.read(), content_type, if_generation_match)
+
+    def upload_from_string(
+        self,
+        data: str | bytes,
+        content_type: str | None = None,
+        predefined_acl: str | None = None,
+        if_generation_match: int | None = None,
+    ) -> None:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._upload(data, content_type, if_generation_match)
+
+    def _upload(
+        self, data: bytes, content_type: str | None, if_generation_match: int | None
+    ) -> None:
+        meta = self.bucket.write(
+            self.name,
+            data,
+            {
+                "metadata": self.metadata,
+                "content_type": content_type,
+                "content_encoding": self.content_encoding,
+            },
+            if_generation_match,
+        )
+        self._load(meta)
+
+    def _open_raw(self) -> BinaryIO:
+        self.reload()
+        path = self.bucket.object_path(self.name)
+        if self.size == 0:
+            # 長さ 0 のファイルは mmap できない
+            return io.BufferedReader(io.BytesIO(b""))  # type: ignore[arg-type]
+        return io.BufferedReader(_MmapReader(path))
+
+    def open(self, mode: str = "rb", raw_download: bool = False) -> BinaryIO:
+        """読み出し用の stream を開く。raw_download でなければ gzip で保存したものは展開する (GCS の transcoding と同じ)"""
+        if mode != "rb":
+            raise ValueError(f"unsupported mode: {mode}")
+        stream = self._open_raw()
+        if not raw_download and self.content_encoding == "gzip":
+            return gzip.GzipFile(fileobj=stream, mode="rb")  # type: ignore[return-value]
+        return stream
+
+    def download_as_bytes(self, raw_download: bool = False, **kwargs) -> bytes:
+        with self.open("rb", raw_download=raw_download) as stream:
+            return stream.read()
+
+    def download_as_string(self, raw_download: bool = False, **kwargs) -> bytes:
+        return self.download_as_bytes(raw_download=raw_download)
+
+    def download_to_file(
+        self, file_obj: BinaryIO, raw_download: bool = False, **kwargs
+    ) -> None:
+        with self.open("rb", raw_download=raw_download) as stream:
+            while chunk := stream.read(1024 * 1024):
+                file_obj.write(chunk)
+
+    def delete(self) -> None:
+        self.bucket.delete(self.name, generation=self._requested_generation)
+
+
+class LocalBucket:
+    """root 以下のディレクトリを1つのバケットとして扱う。google.cloud.storage.Bucket の一部を実装する。"""
+
+    def __init__(self, root: str | Path, name: str = "local"):
+        self.root = Path(root)
+        self.name = name
+        self._lock = threading.Lock()
+        self._last_generation = 0
+        (self.root / OBJECTS_DIR).mkdir(parents=True, exist_ok=True)
+        (self.root / META_DIR).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def _check_name(name: str) -> None:
+        if name == "" or name.startswith("/") or ".." in name.split("/"):
+            raise ValueError(f"invalid blob name: {name}")
+
+    def object_path(self, name: str) -> Path:
+        self._check_name(name)
+        return self.root / OBJECTS_DIR / name
+
+    def meta_path(self, name: str) -> Path:
+        self._check_name(name)
+        return self.root / META_DIR / f"{name}.json"
+
+    def read_meta(self, name: str) -> dict[str, Any] | None:
+        try:
+            return json.loads(self.meta_path(name).read_bytes())
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _atomic_write(path: Path, data: bytes) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _next_generation(self) -> int:
+        # GCS と同じく、書き込みの時刻 (マイクロ秒) を元にした単調増加の値にする
+        self._last_generation = max(time.time_ns() // 1000, self._last_generation + 1)
+        return self._last_generation
+
+    def write(
+        self,
+        name: str,
+        data: bytes,
+        attributes: dict[str, Any],
+        if_generation_match: int | None = None,
+    ) -> dict[str, Any]:
+        """内容と metadata を書き込み、書き込んだ metadata を返す。"""
+        with self._lock:
+            current = self.read_meta(name)
+            if if_generation_match is not None:
+                current_generation = current["generation"] if current else 0
+                if current_generation != if_generation_match:
+                    raise PreconditionFailed(
+                        f"generation mismatch: {name} ({current_generation} != {if_generation_match})"
+                    )
+            meta = {
+                **attributes,
+                "generation": self._next_generation(),
+                "time_created": datetime.now(UTC).isoformat(),
+                "size": len(data),
+            }
+            # 内容を先に置き換え、metadata の置き換えで書き込みを確定する
+            self._atomic_write(self.object_path(name), data)
+            self._atomic_write(self.meta_path(name), json.dumps(meta).encode("utf-8"))
+        return meta
+
+    def delete(self, name: str, generation: int | None = None) -> None:
+        """blob を削除する。generation を指定した場合は、その generation の場合だけ削除する。"""
+        with self._lock:
+            meta = self.read_meta(name)
+            if meta is None or (
+                generation is not None and meta["generation"] != generation
+            ):
+                raise NotFound(f"No such object: {self.name}/{name}")
+            self.meta_path(name).unlink()
+            self.object_path(name).unlink(missing_ok=True)
+
+    def delete_blobs(
+        self,
+        blobs: list[LocalBlob],
+        on_error: Callable[[LocalBlob], None] | None = None,
+    ) -> None:
+        for blob in blobs:
+            try:
+                blob.delete()
+            except NotFound:
+                if on_error is None:
+                    raise
+                on_error(blob)
+
+    def blob(self, blob_name: str, generation: int | None = None) -> LocalBlob:
+        return LocalBlob(self, blob_name, generation=generation)
+
+    def get_blob(self, blob_name: str, **kwargs) -> LocalBlob | None:
+        blob = LocalBlob(self, blob_name)
+        if not blob.exists():
+            return None
+        return blob
+
+    def list_blobs(
+        self, prefix: str = "", max_results: int | None = None, **kwargs
+    ) -> Iterator[LocalBlob]:
+        """prefix で始まる blob を名前の順に返す"""
+        meta_root = self.root / META_DIR
+        # prefix の最後の "/" までのディレクトリだけを辿る
+        start = meta_root / prefix.rsplit("/", 1)[0] if "/" in prefix else meta_root
+        names: list[str] = []
+        for dirpath, _, filenames in os.walk(start):
+            for filename in filenames:
+                if not filename.endswith(".json") or filename.startswith(".tmp_"):
+                    continue
+                rel = os.path.relpath(os.path.join(dirpath, filename), meta_root)
+                name = rel.replace(os.sep, "/")[: -len(".json")]
+                if name.startswith(prefix):
+                    names.append(name)
+        count = 0
+        for name in sorted(names):
+            if max_results is not None and count >= max_results:
+                return
+            blob = LocalBlob(self, name)
+            meta = self.read_meta(name)
+            if meta is None:
+                # 一覧の途中で削除された
+                continue
+            blob._load(meta)
+            count += 1
+            yield blob
+
+
+_local_buckets: dict[str, LocalBucket] = {}
+_local_buckets_lock = threading.Lock()
+
+
+def get_local_bucket(root: str) -> LocalBucket:
+    """root ごとに1つの LocalBucket を返す (generation の検査のロックを共有するため)"""
+    with _local_buckets_lock:
+        bucket = _local_buckets.get(root)
+        if bucket is None:
+            bucket = LocalBucket(root)
+            _local_buckets[root] = bucket
+            logger.info(f"using local blob backend: {root}")
+        return bucket
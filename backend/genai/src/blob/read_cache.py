@@ -0,0 +1,142 @@
+# 読み出した blob の内容を (パス, generation) ごとに保持するキャッシュ
+#
+# masterdata は一度書いたら置き換えないので、同じ masterdata から何度も番組を作る場合に毎回ダウンロードしない。
+# 読み出す側は metadata だけを取得して現在の generation を調べ、同じ generation の内容があればそれを使う。
+# 置き換えられた blob は generation が変わるので、古い内容を返すことはない。
+#
+# * メモリ上の LRU (memory_max_bytes まで) と、ディスク上の LRU (disk_max_bytes まで) の2段
+# * ディスクには <directory>/<パスの sha256>_<generation> として置く。書き込みは一時ファイルに書いてから os.replace する
+# * ディスクの LRU の順は、起動時はファイルの mtime、以降は読み書きの順。上限を超えたら古いものから削除する
+# * 上限より大きい内容はその段には置かない。上限を 0 にした段は使わない
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from src.logger import logger
+
+
+class BlobReadCache:
+    """blob の内容を (パス, generation) ごとに保持する、メモリとディスクの2段の LRU キャッシュ。"""
+
+    def __init__(
+        self,
+        directory: str | Path | None,
+        memory_max_bytes: int,
+        disk_max_bytes: int,
+    ):
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes if directory else 0
+        self.directory = Path(directory) if directory else None
+        self._lock = threading.Lock()
+        # (パス, generation) -> 内容
+        self._memory: OrderedDict[tuple[str, int], bytes] = OrderedDict()
+        self._memory_bytes = 0
+        # ファイル名 -> サイズ
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_bytes = 0
+        if self.directory is not None and self.disk_max_bytes > 0:
+            self._load_disk()
+
+    def _load_disk(self) -> None:
+        """前回までにディスクに置いたものを、mtime の古い順に LRU に載せる"""
+        assert self.directory is not None
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for path in self.directory.iterdir():
+            if path.name.startswith(".tmp_") or not path.is_file():
+                continue
+            stat = path.stat()
+            entries.append((stat.st_mtime, path.name, stat.st_size))
+        for _, file_name, size in sorted(entries):
+            self._disk[file_name] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    @staticmethod
+    def _file_name(name: str, generation: int) -> str:
+        return f"{hashlib.sha256(name.encode('utf-8')).hexdigest()}_{generation}"
+
+    def contains(self, name: str) -> bool:
+        """name のいずれかの generation を保持しているか"""
+        prefix = self._file_name(name, 0)[: -len("0")]
+        with self._lock:
+            return any(key[0] == name for key in self._memory) or any(
+                file_name.startswith(prefix) for file_name in self._disk
+            )
+
+    def get(self, name: str, generation: int) -> bytes | None:
+        """name の generation の内容を返す。なければ None"""
+        key = (name, generation)
+        file_name = self._file_name(name, generation)
+        with self._lock:
+            in_disk = file_name in self._disk
+            if in_disk:
+                self._disk.move_to_end(file_name)
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+            if not in_disk:
+                return None
+        assert self.directory is not None
+        try:
+            data = (self.directory / file_name).read_bytes()
+        except FileNotFoundError:
+            # 別のスレッドが削除した
+            return None
+        with self._lock:
+            self._put_memory(key, data)
+        return data
+
+    def put(self, name: str, generation: int, data: bytes) -> None:
+        """name の generation の内容を置く"""
+        with self._lock:
+            self._put_memory((name, generation), data)
+        if self.directory is None or len(data) > self.disk_max_bytes:
+            return
+        file_name = self._file_name(name, generation)
+        try:
+            self._write_file(self.directory / file_name, data)
+        except OSError:
+            # ディスクに置けなくても、次回ダウンロードし直すだけなので失敗にはしない
+            logger.warning(f"failed to write read cache: {name}", exc_info=True)
+            return
+        with self._lock:
+            self._disk_bytes += len(data) - self._disk.pop(file_name, 0)
+            self._disk[file_name] = len(data)
+            self._evict_disk()
+
+    def _put_memory(self, key: tuple[str, int], data: bytes) -> None:
+        if len(data) > self.memory_max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _evict_disk(self) -> None:
+        assert self.directory is not None
+        while self._disk_bytes > self.disk_max_bytes:
+            file_name, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            (self.directory / file_name).unlink(missing_ok=True)
+
+    @staticmethod
+    def _write_file(path: Path, data: bytes) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
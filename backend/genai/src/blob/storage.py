@@ -1,10 +1,22 @@
+import gzip
+import hashlib
 import io
+import json
 import os
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from typing import Any, BinaryIO
 
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from google.cloud import storage as gcs
+from google.cloud.storage.batch import Batch
+from pydantic import BaseModel, ConfigDict
 
+from src.blob.local import get_local_bucket
+from src.blob.read_cache import BlobReadCache
 from src.logger import logger
 from src.utils import JST, get_diff_days, get_now
 
@@ -18,8 +30,15 @@ else:
     storage_bucket = os.getenv("GOOGLE_CLOUD_STORAGE_BUCKET", "")
 
 
+# blob の保存先。"gcs" か "local" (BLOB_LOCAL_ROOT 以下のローカルディスク。GCS なしでのベンチマーク・負荷試験用)
+BLOB_BACKEND = os.getenv("BLOB_BACKEND", "gcs")
+BLOB_LOCAL_ROOT = os.getenv("BLOB_LOCAL_ROOT", "/tmp/advena_blob")
+
 # プロジェクトが設定されている場合は project 引数を渡してクライアントを生成
-storage_client = gcs.Client(project=gcp_project)
+# local の場合は GCS の認証情報がなくても動くように、クライアントを作らない
+storage_client: gcs.Client | None = (
+    gcs.Client(project=gcp_project) if BLOB_BACKEND == "gcs" else None
+)
 
 # GCS上での論理ディレクトリ構造（リーディングスラッシュは含めない）
 PRIVATE_DIR = "private"
@@ -28,6 +47,16 @@ PUBLIC_DIR = "public"
 RSS_RAW_DIR = f"{PRIVATE_DIR}/rss"
 OAI_PMH_RAW_DIR = f"{PRIVATE_DIR}/oai_pmh"
 MASTERDATA_DIR = f"{PRIVATE_DIR}/masterdata"
+# 作成途中の masterdata のチェックポイント
+MASTERDATA_CHECKPOINT_DIR = f"{MASTERDATA_DIR}/_checkpoint"
+# 分割して作成した masterdata の断片
+MASTERDATA_SHARD_DIR = f"{MASTERDATA_DIR}/_shards"
+# masterdata の公開 (索引のアップロードとラジオ番組の作成) を1回にするための marker
+MASTERDATA_PUBLISH_DIR = f"{MASTERDATA_DIR}/_publish"
+# 日付ごとに分割した masterdata の索引のファイル名 (private/masterdata/<signature>/ 以下に置く)
+MASTERDATA_INDEX_FILE_NAME = "_index.json"
+# LLM の応答のキャッシュ (入力のハッシュごとに1つ)
+LLM_RESPONSE_CACHE_DIR = f"{PRIVATE_DIR}/llm_cache"
 # public 以下（認証済みユーザーに read 許可）
 RADIO_SHOW_AUDIO_DIR = f"{PUBLIC_DIR}/radio_show_audio"
 RADIO_SHOW_SCRIPT_DIR = f"{PUBLIC_DIR}/radio_show_script"
@@ -35,28 +64,124 @@ RADIO_SHOW_SCRIPT_DIR = f"{PUBLIC_DIR}/radio_show_script"
 XML_LATEST_ALL_DIR_BASE = "latest_all"
 XML_KEYWORD_DIR_BASE = "keyword"
 
+# RSS のキャッシュごとに置く、最新のキャッシュと HTTP の validator を記録したファイル名
+RSS_LATEST_FILE_NAME = "_latest.json"
+# 最新のキャッシュの pointer を同時に更新した場合に、読み直して更新する回数
+RSS_LATEST_UPDATE_ATTEMPTS = 5
+
 ISBN_DIR = "isbn"
 JP_E_CODE_DIR = "jp_e_code"
+# OAI-PMH の ListRecords による harvest の状態 (high-water mark) を置くディレクトリ
+OAI_PMH_HARVEST_DIR = f"{OAI_PMH_RAW_DIR}/_harvest"
+# OAI-PMH のキャッシュの索引 (identifier -> blob) を置くディレクトリ
+OAI_PMH_INDEX_DIR = f"{OAI_PMH_RAW_DIR}/_index"
+# 索引の分割数 (identifier のハッシュの先頭1文字で分割する)
+OAI_PMH_INDEX_SHARDS = 16
+# OAI-PMH のキャッシュの有効日数
+OAI_PMH_CACHE_DAYS = 7
+
+# 多数の小さな blob をまとめてアップロードする場合 (BatchUploader) の並列数と、1つの blob の試行回数
+BLOB_UPLOAD_MAX_WORKERS = int(os.getenv("BLOB_UPLOAD_MAX_WORKERS", "16"))
+BLOB_UPLOAD_MAX_ATTEMPTS = int(os.getenv("BLOB_UPLOAD_MAX_ATTEMPTS", "3"))
+
+# キャッシュの GC で1ページに一覧する件数と、1回の batch request で削除する件数 (GCS の上限は100件)
+CACHE_GC_PAGE_SIZE = int(os.getenv("CACHE_GC_PAGE_SIZE", "1000"))
+CACHE_GC_DELETE_BATCH_SIZE = 100
+
+# masterdata の公開中の marker の有効秒数。これより古ければ、公開していたタスクが止まったとみなして引き継ぐ
+MASTERDATA_PUBLISH_LEASE_SECONDS = int(
+    os.getenv("MASTERDATA_PUBLISH_LEASE_SECONDS", "900")
+)
+
+# masterdata の作成途中のファイル (チェックポイントと断片) を残す日数。これより前から更新がないものは、
+# 失敗したか放棄された実行のものとみなして gc_cache で削除する
+MASTERDATA_WORK_RETENTION_DAYS = int(os.getenv("MASTERDATA_WORK_RETENTION_DAYS", "7"))
+# masterdata の公開の marker を残す日数。Cloud Tasks のタスクは最長31日で消えるので、
+# それより後に同じタスクが重複して届くことはない
+MASTERDATA_PUBLISH_RETENTION_DAYS = int(
+    os.getenv("MASTERDATA_PUBLISH_RETENTION_DAYS", "31")
+)
+
+# アップロードした内容 (圧縮前) の SHA-256 を記録する metadata のキー
+CONTENT_DIGEST_METADATA_KEY = "content_sha256"
+
+# masterdata と OAI-PMH のキャッシュ (JSON) の圧縮形式。"gzip" か "none"
+BLOB_JSON_COMPRESSION = os.getenv("BLOB_JSON_COMPRESSION", "gzip")
+
+# LLM の応答のキャッシュの有効日数と、gc_cache で残す合計サイズ (バイト)
+LLM_RESPONSE_CACHE_DAYS = int(os.getenv("LLM_RESPONSE_CACHE_DAYS", "7"))
+LLM_RESPONSE_CACHE_MAX_BYTES = int(
+    os.getenv("LLM_RESPONSE_CACHE_MAX_BYTES", str(256 * 1024 * 1024))
+)
+
+# masterdata (get_json_file, iter_cached_ndjson_file) で読み出した内容を (パス, generation) ごとに保持するキャッシュの
+# 置き場所と上限 (バイト)。ディレクトリを空にするとディスクには置かない。上限を 0 にするとその段は使わない
+# Cloud Run の /tmp はメモリ上にあるので、ディスクの段は既定では使わない (永続ディスクがある環境でだけ設定する)
+BLOB_READ_CACHE_DIR = os.getenv("BLOB_READ_CACHE_DIR", "/tmp/advena_blob_cache")
+BLOB_READ_CACHE_MEMORY_BYTES = int(
+    os.getenv("BLOB_READ_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024))
+)
+BLOB_READ_CACHE_DISK_BYTES = int(os.getenv("BLOB_READ_CACHE_DISK_BYTES", "0"))
+GZIP_MAGIC = b"\x1f\x8b"
 
 
 def _get_bucket() -> gcs.Bucket:
-    """GCSのバケットを取得する。"""
+    """GCSのバケットを取得する。BLOB_BACKEND が local の場合は、同じ使い方ができるローカルディスクのバケットを返す。"""
+    if BLOB_BACKEND == "local":
+        return get_local_bucket(BLOB_LOCAL_ROOT)  # type: ignore[return-value]
+    if storage_client is None:
+        raise ValueError(f"unsupported BLOB_BACKEND: {BLOB_BACKEND}")
     # 1つの bucket のみでの運用を想定（user_project の指定は必要に応じて）
     logger.info(f"target bucket: {storage_bucket}")
     b = storage_client.bucket(bucket_name=storage_bucket, user_project=gcp_project)
     return b
 
 
+class BlobWrite(BaseModel):
+    """1つの blob の書き込み。BatchUploader に積む単位"""
+
+    blob_path: str
+    payload: str
+    metadata: dict[str, Any]
+    content_type: str = "application/json"
+    # JSON として BLOB_JSON_COMPRESSION に従って圧縮する
+    compress: bool = True
+
+
+class BlobUploadResult(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    blob_path: str
+    # アップロードした blob (失敗した場合は None)
+    blob: Any = None
+    attempts: int = 0
+    error: str | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def content_digest(data: str | bytes) -> str:
+    """キャッシュの内容が変わったかを比べるための SHA-256 (hex)"""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
 def _upload_blob_file(
     blob_path: str,
     file: BinaryIO,
     metadata: dict[str, Any],
     content_type: str,
     acl: str | None = None,
+    content_encoding: str | None = None,
 ) -> gcs.Blob:
     """ファイルを GCS にアップロードし、公開 URL を返す。"""
     blob = _get_bucket().blob(blob_path)
     blob.metadata = metadata
+    if content_encoding:
+        blob.content_encoding = content_encoding
 
     logger.info(f"Uploading file to GCS: {blob_path}")
     logger.info(f"Metadata: {metadata}")
@@ -95,6 +220,150 @@ def _upload_blob_string(
     return blob
 
 
+def _upload_blob_json(
+    blob_path: str,
+    json_str: str,
+    metadata: dict[str, Any],
+    content_type: str = "application/json",
+) -> gcs.Blob:
+    """
+    JSON (NDJSON) を GCS にアップロードする。BLOB_JSON_COMPRESSION が gzip の場合は圧縮し、Content-Encoding: gzip を付ける。
+    読み出しは _download_blob_text で、圧縮の有無に関わらず行える。
+    """
+    if BLOB_JSON_COMPRESSION != "gzip":
+        return _upload_blob_string(
+            blob_path, json_str, metadata, content_type=content_type
+        )
+    compressed = gzip.compress(json_str.encode("utf-8"))
+    logger.info(
+        f"compressed json: {len(json_str.encode('utf-8'))} -> {len(compressed)} bytes"
+    )
+    return _upload_blob_file(
+        blob_path,
+        io.BytesIO(compressed),
+        metadata,
+        content_type=content_type,
+        content_encoding="gzip",
+    )
+
+
+def put_blob_write(write: BlobWrite) -> gcs.Blob:
+    """BlobWrite を1つアップロードする。"""
+    if write.compress:
+        return _upload_blob_json(
+            write.blob_path,
+            write.payload,
+            write.metadata,
+            content_type=write.content_type,
+        )
+    return _upload_blob_string(
+        write.blob_path, write.payload, write.metadata, content_type=write.content_type
+    )
+
+
+class BatchUploader:
+    """
+    多数の小さな blob (OAI-PMH のキャッシュなど) の書き込みをキューに積み、バックグラウンドのスレッドで並行にアップロードする。
+    失敗した書き込みは間隔を空けて max_attempts 回まで試行する。
+    join で全ての書き込みの完了を待ち、積んだ順の結果 (失敗したものは error 付き) を返す。
+    """
+
+    def __init__(
+        self,
+        max_workers: int = BLOB_UPLOAD_MAX_WORKERS,
+        max_attempts: int = BLOB_UPLOAD_MAX_ATTEMPTS,
+        retry_wait_seconds: float = 0.5,
+        upload: Callable[[BlobWrite], gcs.Blob] = put_blob_write,
+    ):
+        if max_workers < 1:
+            raise ValueError("max_workers must be positive.")
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be positive.")
+        self.max_attempts = max_attempts
+        self.retry_wait_seconds = retry_wait_seconds
+        self._upload_func = upload
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="blob_upload"
+        )
+        self._futures: list[Future[BlobUploadResult]] = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def submit(
+        self,
+        write: BlobWrite,
+        on_uploaded: Callable[[gcs.Blob], None] | None = None,
+    ) -> Future[BlobUploadResult]:
+        """書き込みを積む。アップロードできたら、そのスレッドで on_uploaded(blob) を呼ぶ。"""
+        with self._lock:
+            if self._closed:
+                raise ValueError("batch uploader is already joined.")
+            future = self._executor.submit(self._upload, write, on_uploaded)
+            self._futures.append(future)
+        return future
+
+    def _upload(
+        self, write: BlobWrite, on_uploaded: Callable[[gcs.Blob], None] | None
+    ) -> BlobUploadResult:
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                blob = self._upload_func(write)
+                break
+            except Exception as e:
+                if attempt >= self.max_attempts:
+                    logger.error(
+                        f"Failed to upload {write.blob_path} after {attempt} attempts: {e}"
+                    )
+                    return BlobUploadResult(
+                        blob_path=write.blob_path, attempts=attempt, error=str(e)
+                    )
+                logger.warning(f"retry uploading {write.blob_path} ({attempt}): {e}")
+                time.sleep(self.retry_wait_seconds * 2 ** (attempt - 1))
+        if on_uploaded is not None:
+            on_uploaded(blob)
+        return BlobUploadResult(blob_path=write.blob_path, blob=blob, attempts=attempt)
+
+    def join(self) -> list[BlobUploadResult]:
+        """積んだ書き込みの完了を待ち、積んだ順の結果を返す。以降は submit できない。"""
+        with self._lock:
+            self._closed = True
+            futures = list(self._futures)
+        try:
+            results = [future.result() for future in futures]
+        finally:
+            self._executor.shutdown(wait=True)
+        failed = sum(1 for result in results if not result.ok)
+        logger.info(f"batch uploaded {len(results) - failed} blobs, {failed} failed")
+        return results
+
+
+def _download_blob_bytes(blob: gcs.Blob) -> bytes:
+    """blob 全体を取得する。gzip で保存されたものは展開する。
+    ダウンロードの応答から blob.generation も設定される。"""
+    data = blob.download_as_bytes(raw_download=True)
+    if data[:2] == GZIP_MAGIC:
+        data = gzip.decompress(data)
+    return data
+
+
+def _download_blob_text(blob: gcs.Blob) -> str:
+    """blob 全体を文字列として取得する。gzip で保存されたものは展開する。"""
+    return _download_blob_bytes(blob).decode("utf-8")
+
+
+def _download_blob_to_bytes_io(blob: gcs.Blob) -> io.BytesIO:
+    """blob を BytesIO に取得する。gzip で保存されたものは展開する。"""
+    bs = io.BytesIO()
+    blob.download_to_file(bs, raw_download=True)
+    if bs.getvalue()[:2] == GZIP_MAGIC:
+        bs = io.BytesIO(gzip.decompress(bs.getvalue()))
+    # ファイルの先頭に戻す
+    bs.seek(0)
+    return bs
+
+
 def put_tts_script_file(signature: str, script: str) -> gcs.Blob:
     """
     TTS後のスクリプトファイルを GCS にアップロードし、公開 URL を返す。
@@ -137,13 +406,24 @@ def put_tts_audio_file(signature: str, file: BinaryIO) -> gcs.Blob:
     )
 
 
+def _rss_xml_path(prefix_dir: str, suffix_dir: str, signature: str) -> str:
+    return f"{RSS_RAW_DIR}/{prefix_dir}_{suffix_dir}/{signature}.xml"
+
+
 def put_rss_xml_file(
-    last_build_date: datetime, prefix_dir: str, file: BinaryIO, suffix_dir: str = "non"
+    last_build_date: datetime,
+    prefix_dir: str,
+    file: BinaryIO,
+    suffix_dir: str = "non",
+    etag: str | None = None,
+    last_modified: str | None = None,
 ) -> gcs.Blob:
     """
     RSS XML ファイルを GCS にアップロードし、公開 URL を返す。
     キャッシュの有効期限は 5 分間。
     アップロード先: private/rss/(latest_all|keyword_X)/<signature>.xml
+    アップロード後に、最新のキャッシュを指す _latest.json を更新する (etag, last_modified も記録する)。
+    最新のキャッシュと同じ内容 (SHA-256 が一致) の場合はアップロードしない。
 
     signature: ファイル名の接頭辞として利用する日時文字列 (JST)
     例: 20250209_000000_0900
@@ -155,16 +435,164 @@ def put_rss_xml_file(
         last_build_date_w_tz = last_build_date.astimezone(JST)
 
     signature = f"{last_build_date_w_tz.strftime('%Y%m%d_%H%M%S_0900')}"
-    blob_path = f"{RSS_RAW_DIR}/{prefix_dir}_{suffix_dir}/{signature}.xml"
+    blob_path = _rss_xml_path(prefix_dir, suffix_dir, signature)
+    # 先頭へ
+    file.seek(0)
+    digest = content_digest(file.read())
+    file.seek(0)
+
+    latest = get_rss_validators(prefix_dir, suffix_dir)
+    if latest is not None and latest.blob_name == blob_path and latest.digest == digest:
+        # 最新のキャッシュと同じ内容なのでアップロードしない。validator だけ更新する
+        logger.info(f"RSS file is unchanged. skip uploading: {blob_path}")
+        blob = _get_bucket().blob(blob_path, generation=latest.generation)
+        if latest.etag == etag and latest.last_modified == last_modified:
+            return blob
+    else:
+        metadata = {
+            "Cache-Control": "public, max-age=300",  # 5分間
+            "content-type": "application/xml; charset=utf-8",
+            "custom_time": get_now().isoformat(),
+            CONTENT_DIGEST_METADATA_KEY: digest,
+        }
+        logger.info("start uploading RSS file to GCS")
+        blob = _upload_blob_file(
+            blob_path, file, metadata, content_type="application/xml"
+        )
+    try:
+        put_rss_validators(
+            prefix_dir,
+            suffix_dir,
+            RssCacheValidators(
+                blob_name=blob.name,
+                generation=blob.generation,
+                digest=digest,
+                etag=etag,
+                last_modified=last_modified,
+            ),
+        )
+    except Exception:
+        # pointer が古いままでも、次回は list_blobs か NDL からの取得になるだけなので失敗にはしない
+        logger.error(f"Failed to update RSS latest pointer: {blob_path}", exc_info=True)
+    return blob
+
+
+class RssCacheValidators(BaseModel):
+    # 最新の RSS キャッシュの blob path
+    blob_name: str
+    # 最新の RSS キャッシュの generation と内容の SHA-256
+    generation: int | None = None
+    digest: str | None = None
+    # 取得時のレスポンスヘッダ (条件付きリクエストに使う)
+    etag: str | None = None
+    last_modified: str | None = None
+
+
+def _rss_latest_path(prefix_dir: str, suffix_dir: str) -> str:
+    return f"{RSS_RAW_DIR}/{prefix_dir}_{suffix_dir}/{RSS_LATEST_FILE_NAME}"
+
+
+def put_rss_validators(
+    prefix_dir: str, suffix_dir: str, validators: RssCacheValidators
+) -> gcs.Blob | None:
+    """
+    最新の RSS キャッシュを指す pointer (blob path, generation と ETag / Last-Modified) を GCS にアップロードする。
+    アップロード先: private/rss/(latest_all|keyword_X)_<suffix_dir>/_latest.json
+
+    他のワークフローと同時に更新しても古いキャッシュで上書きしないように、
+    最新の pointer を読み直して比べ、generation の precondition 付きでアップロードする。
+    既により新しいキャッシュを指している場合は更新せずに None を返す。
+    """
+    if prefix_dir == "" or suffix_dir == "":
+        raise ValueError("prefix_dir and suffix_dir should not be empty.")
+    blob_path = _rss_latest_path(prefix_dir, suffix_dir)
+    metadata = {
+        "Cache-Control": "no-store",
+        "content-type": "application/json; charset=utf-8",
+        "custom_time": get_now().isoformat(),
+    }
+    bucket = _get_bucket()
+    logger.info("start uploading RSS validators to GCS")
+    for i in range(RSS_LATEST_UPDATE_ATTEMPTS):
+        current_blob = bucket.get_blob(blob_path)
+        generation = 0
+        if current_blob is not None:
+            generation = current_blob.generation or 0
+            current = RssCacheValidators.model_validate_json(
+                current_blob.download_as_bytes()
+            )
+            # ファイル名は lastBuildDate (JST) なので、名前の順序が新旧の順序になる
+            if current.blob_name > validators.blob_name:
+                logger.info(
+                    f"RSS latest pointer already points to newer cache: {current.blob_name}"
+                )
+                return None
+        blob = bucket.blob(blob_path)
+        blob.metadata = metadata
+        try:
+            blob.upload_from_string(
+                validators.model_dump_json(),
+                content_type="application/json",
+                if_generation_match=generation,
+            )
+            return blob
+        except PreconditionFailed:
+            logger.info(f"RSS latest pointer is updated concurrently. retry {i + 1}")
+            if i == RSS_LATEST_UPDATE_ATTEMPTS - 1:
+                raise
+    return None
+
+
+def get_rss_validators(prefix_dir: str, suffix_dir: str) -> RssCacheValidators | None:
+    """最新の RSS キャッシュの pointer を取得する。存在しない場合は None を返す。
+    1回の GET で取得する。"""
+    if prefix_dir == "" or suffix_dir == "":
+        raise ValueError("prefix_dir and suffix_dir should not be empty.")
+    blob_path = _rss_latest_path(prefix_dir, suffix_dir)
+    try:
+        data = _get_bucket().blob(blob_path).download_as_bytes()
+    except NotFound:
+        logger.info(f"No RSS validators found: {blob_path}")
+        return None
+    return RssCacheValidators.model_validate_json(data)
+
+
+def get_rss_xml_file(blob_path: str) -> io.BytesIO | None:
+    """キャッシュされた RSS ファイルを blob path で取得する。存在しない場合は None を返す。"""
+    if blob_path == "":
+        raise ValueError("blob_path should not be empty.")
+    bs = io.BytesIO()
+    try:
+        _get_bucket().blob(blob_path).download_to_file(bs)
+    except NotFound:
+        logger.info(f"Cached RSS file is not found: {blob_path}")
+        return None
+    # ファイルの先頭に戻す
+    bs.seek(0)
+    return bs
+
+
+def get_rss_xml_file_by_signature(
+    signature: str, prefix_dir: str, suffix_dir: str = "non"
+) -> io.BytesIO | None:
+    """put_rss_xml_file でキャッシュした RSS ファイルを signature (更新日時) で取得する。存在しない場合は None を返す。"""
+    if signature == "" or prefix_dir == "":
+        raise ValueError("signature and prefix_dir should not be empty.")
+    return get_rss_xml_file(_rss_xml_path(prefix_dir, suffix_dir, signature))
+
+
+def oai_pmh_json_write(signature: str, prefix_dir: str, json_str: str) -> BlobWrite:
+    """OAI-PMH 用の JSON ファイルの書き込み (put_oai_pmh_json と同じパス、metadata) を作る。BatchUploader に積む。"""
+    if signature == "" or json_str == "" or prefix_dir == "":
+        raise ValueError("signature should not be empty.")
+    blob_path = f"{OAI_PMH_RAW_DIR}/{prefix_dir}/{signature}.json"
     metadata = {
         "Cache-Control": "public, max-age=300",  # 5分間
-        "content-type": "application/xml; charset=utf-8",
+        "content-type": "application/json; charset=utf-8",
         "custom_time": get_now().isoformat(),
+        CONTENT_DIGEST_METADATA_KEY: content_digest(json_str),
     }
-    # 先頭へ
-    file.seek(0)
-    logger.info("start uploading RSS file to GCS")
-    return _upload_blob_file(blob_path, file, metadata, content_type="application/xml")
+    return BlobWrite(blob_path=blob_path, payload=json_str, metadata=metadata)
 
 
 def put_oai_pmh_json(signature: str, prefix_dir: str, json_str: str) -> gcs.Blob:
@@ -173,20 +601,42 @@ def put_oai_pmh_json(signature: str, prefix_dir: str, json_str: str) -> gcs.Blob
     キャッシュの有効期限は 5 分間。
     アップロード先: private/oai_pmh/(isbn|jp_e_code)/<signature>.json
     """
-    if signature == "" or json_str == "" or prefix_dir == "":
-        raise ValueError("signature should not be empty.")
-    blob_path = f"{OAI_PMH_RAW_DIR}/{prefix_dir}/{signature}.json"
+    write = oai_pmh_json_write(signature, prefix_dir, json_str)
+    logger.info("start uploading OAI-PMH file to GCS")
+    return put_blob_write(write)
+
+
+def put_oai_pmh_harvest_state(repository: str, json_str: str) -> gcs.Blob:
+    """
+    OAI-PMH の harvest の状態 (high-water mark, resumptionToken) を GCS にアップロードする。
+    アップロード先: private/oai_pmh/_harvest/<repository>.json
+    """
+    if repository == "" or json_str == "":
+        raise ValueError("repository and json_str should not be empty.")
+    blob_path = f"{OAI_PMH_HARVEST_DIR}/{repository}.json"
     metadata = {
-        "Cache-Control": "public, max-age=300",  # 5分間
+        "Cache-Control": "no-store",
         "content-type": "application/json; charset=utf-8",
         "custom_time": get_now().isoformat(),
     }
-    logger.info("start uploading OAI-PMH file to GCS")
+    logger.info("start uploading OAI-PMH harvest state to GCS")
     return _upload_blob_string(
         blob_path, json_str, metadata, content_type="application/json"
     )
 
 
+def get_oai_pmh_harvest_state(repository: str) -> str | None:
+    """OAI-PMH の harvest の状態を GCS から取得する。存在しない場合は None を返す。"""
+    if repository == "":
+        raise ValueError("repository should not be empty.")
+    blob_path = f"{OAI_PMH_HARVEST_DIR}/{repository}.json"
+    blob = _get_bucket().get_blob(blob_path)
+    if blob is None:
+        logger.info(f"No OAI-PMH harvest state found: {blob_path}")
+        return None
+    return blob.download_as_bytes().decode("utf-8")
+
+
 def put_combined_json_file(signature: str, json_str: str) -> gcs.Blob:
     """
     Masterdata ファイル (JSON) を GCS にアップロードし、公開 URL を返す。
@@ -202,15 +652,273 @@ def put_combined_json_file(signature: str, json_str: str) -> gcs.Blob:
         "custom_time": get_now().isoformat(),
     }
     logger.info("start uploading masterdata file to GCS")
+    return _upload_blob_json(blob_path, json_str, metadata)
+
+
+def masterdata_partition_path(signature: str, day: str) -> str:
+    """日付ごとに分割した masterdata の blob path。day は JST の日付 (YYYYMMDD)"""
+    return f"{MASTERDATA_DIR}/{signature}/{day}.ndjson"
+
+
+def masterdata_index_path(signature: str) -> str:
+    """日付ごとに分割した masterdata の索引の blob path"""
+    return f"{MASTERDATA_DIR}/{signature}/{MASTERDATA_INDEX_FILE_NAME}"
+
+
+def put_masterdata_partition(
+    signature: str, day: str, lines: Iterable[str]
+) -> gcs.Blob:
+    """
+    published (JST) が day の書籍だけの masterdata (NDJSON) を GCS にアップロードする。
+    キャッシュの有効期限は 5 分間。
+    アップロード先: private/masterdata/<signature>/<YYYYMMDD>.ndjson
+    """
+    if signature == "" or day == "":
+        raise ValueError("signature and day should not be empty.")
+    ndjson_str = "".join(f"{line}\n" for line in lines)
+    if ndjson_str == "":
+        raise ValueError("lines should not be empty.")
+    blob_path = masterdata_partition_path(signature, day)
+    metadata = {
+        "Cache-Control": "public, max-age=300",  # 5分間
+        "content-type": "application/x-ndjson; charset=utf-8",
+        "custom_time": get_now().isoformat(),
+    }
+    logger.info(f"start uploading masterdata partition {day} to GCS")
+    return _upload_blob_json(
+        blob_path, ndjson_str, metadata, content_type="application/x-ndjson"
+    )
+
+
+def put_masterdata_index(signature: str, json_str: str) -> gcs.Blob:
+    """
+    日付ごとに分割した masterdata の索引 (日付と書籍数) を GCS にアップロードする。
+    全ての日付の masterdata をアップロードした後に置く。
+    アップロード先: private/masterdata/<signature>/_index.json
+    """
+    if signature == "" or json_str == "":
+        raise ValueError("signature and json_str should not be empty.")
+    blob_path = masterdata_index_path(signature)
+    metadata = {
+        "Cache-Control": "public, max-age=300",  # 5分間
+        "content-type": "application/json; charset=utf-8",
+        "custom_time": get_now().isoformat(),
+    }
+    logger.info("start uploading masterdata index to GCS")
+    return _upload_blob_json(blob_path, json_str, metadata)
+
+
+def iter_cached_ndjson_file(blob_path: str) -> Iterator[bytes]:
+    """
+    NDJSON ファイルを読み出しのキャッシュを通して取得し、1行ずつ返す。空行は飛ばす。
+    ファイル全体をメモリに載せるので、日付ごとの masterdata のような小さいファイルに使う。
+    """
+    if blob_path == "":
+        raise ValueError("blob_path should not be empty.")
+    for line in _read_blob_cached(blob_path).splitlines():
+        line = line.strip()
+        if line:
+            yield line
+
+
+def _masterdata_checkpoint_dir(signature: str) -> str:
+    return f"{MASTERDATA_CHECKPOINT_DIR}/{signature}"
+
+
+def put_masterdata_checkpoint_segment(
+    signature: str, segment: int, json_str: str
+) -> gcs.Blob:
+    """
+    作成途中の masterdata のうち、前回のチェックポイントから増えた書籍 (JSON) を GCS にアップロードする。
+    アップロード先: private/masterdata/_checkpoint/<signature>/<segment>.json
+    アップロードした後に put_masterdata_checkpoint_cursor で segment の数を更新する。
+    """
+    if signature == "" or json_str == "":
+        raise ValueError("signature and json_str should not be empty.")
+    if segment < 0:
+        raise ValueError("segment must not be negative.")
+    blob_path = f"{_masterdata_checkpoint_dir(signature)}/{segment}.json"
+    metadata = {
+        "Cache-Control": "no-store",
+        "content-type": "application/json; charset=utf-8",
+        "custom_time": get_now().isoformat(),
+    }
+    logger.info(f"start uploading masterdata checkpoint segment {segment} to GCS")
+    return _upload_blob_json(blob_path, json_str, metadata)
+
+
+def put_masterdata_checkpoint_cursor(signature: str, segments: int) -> gcs.Blob:
+    """
+    チェックポイントの segment の数 (カーソル) を GCS にアップロードする。
+    アップロード先: private/masterdata/_checkpoint/<signature>/_cursor.json
+    """
+    if signature == "":
+        raise ValueError("signature should not be empty.")
+    if segments < 0:
+        raise ValueError("segments must not be negative.")
+    blob_path = f"{_masterdata_checkpoint_dir(signature)}/_cursor.json"
+    metadata = {
+        "Cache-Control": "no-store",
+        "content-type": "application/json; charset=utf-8",
+        "custom_time": get_now().isoformat(),
+    }
     return _upload_blob_string(
-        blob_path, json_str, metadata, content_type="application/json"
+        blob_path,
+        json.dumps({"segments": segments}),
+        metadata,
+        content_type="application/json",
     )
 
 
+def get_masterdata_checkpoint_segments(signature: str) -> list[str]:
+    """
+    masterdata のチェックポイントの segment (JSON) を順に取得する。チェックポイントがなければ空のリストを返す。
+    カーソルより後の segment (カーソルを更新する前に止まったもの) は読まない。次の保存で上書きされる。
+    """
+    if signature == "":
+        raise ValueError("signature should not be empty.")
+    checkpoint_dir = _masterdata_checkpoint_dir(signature)
+    bucket = _get_bucket()
+    cursor = bucket.get_blob(f"{checkpoint_dir}/_cursor.json")
+    if cursor is None:
+        logger.info(f"No masterdata checkpoint found: {checkpoint_dir}")
+        return []
+    segments = json.loads(_download_blob_text(cursor))["segments"]
+    result: list[str] = []
+    for segment in range(segments):
+        blob = bucket.get_blob(f"{checkpoint_dir}/{segment}.json")
+        if blob is None:
+            raise ValueError(
+                f"masterdata checkpoint segment is missing: {checkpoint_dir}/{segment}.json"
+            )
+        result.append(_download_blob_text(blob))
+    return result
+
+
+def delete_masterdata_checkpoint(signature: str) -> None:
+    """masterdata のチェックポイント (segment とカーソル) を削除する。存在しない場合は何もしない。"""
+    if signature == "":
+        raise ValueError("signature should not be empty.")
+    listings = list(list_blob_listings(f"{_masterdata_checkpoint_dir(signature)}/"))
+    if len(listings) == 0:
+        logger.info(f"No masterdata checkpoint to delete: {signature}")
+        return
+    _delete_listings(listings)
+
+
+def _masterdata_publish_path(signature: str, key: str) -> str:
+    return f"{MASTERDATA_PUBLISH_DIR}/{signature}/{key}.json"
+
+
+def claim_masterdata_publish(signature: str, key: str) -> int | None:
+    """
+    masterdata の公開を始める前に、公開中の marker を置く。置けた場合はその generation を返す。
+    公開済みの場合と、別のタスクが公開中 (MASTERDATA_PUBLISH_LEASE_SECONDS 以内) の場合は None を返す。
+    公開中のまま古くなった marker は、公開していたタスクが止まったとみなして引き継ぐ。
+    """
+    if signature == "" or key == "":
+        raise ValueError("signature and key should not be empty.")
+    blob_path = _masterdata_publish_path(signature, key)
+    bucket = _get_bucket()
+    expected_generation = 0
+    current = bucket.get_blob(blob_path)
+    if current is not None:
+        marker = json.loads(_download_blob_text(current))
+        if marker.get("status") == "done":
+            logger.info(f"masterdata is already published: {blob_path}")
+            return None
+        claimed_at = datetime.fromisoformat(marker["claimed_at"])
+        if (get_now() - claimed_at).total_seconds() < MASTERDATA_PUBLISH_LEASE_SECONDS:
+            logger.info(f"masterdata is being published by another task: {blob_path}")
+            return None
+        logger.warning(f"take over a stale masterdata publish: {blob_path}")
+        expected_generation = current.generation
+    blob = bucket.blob(blob_path)
+    try:
+        blob.upload_from_string(
+            json.dumps({"status": "running", "claimed_at": get_now().isoformat()}),
+            content_type="application/json",
+            if_generation_match=expected_generation,
+        )
+    except PreconditionFailed:
+        logger.info(f"masterdata publish is claimed concurrently: {blob_path}")
+        return None
+    return blob.generation
+
+
+def complete_masterdata_publish(signature: str, key: str, generation: int) -> None:
+    """claim_masterdata_publish で置いた marker を公開済みにする"""
+    blob_path = _masterdata_publish_path(signature, key)
+    try:
+        _get_bucket().blob(blob_path).upload_from_string(
+            json.dumps({"status": "done", "claimed_at": get_now().isoformat()}),
+            content_type="application/json",
+            if_generation_match=generation,
+        )
+    except PreconditionFailed:
+        # lease を過ぎて別のタスクに引き継がれた。公開自体は済んでいる
+        logger.warning(f"masterdata publish marker is taken over: {blob_path}")
+
+
+def release_masterdata_publish(signature: str, key: str, generation: int) -> None:
+    """公開に失敗した場合に marker を削除して、再実行で公開し直せるようにする"""
+    blob_path = _masterdata_publish_path(signature, key)
+    try:
+        _get_bucket().blob(blob_path, generation=generation).delete()
+    except NotFound:
+        logger.info(f"No masterdata publish marker to release: {blob_path}")
+
+
+def put_masterdata_shard(signature: str, shard: int, json_str: str) -> gcs.Blob:
+    """
+    分割して作成した masterdata の断片 (JSON) を GCS にアップロードする。
+    アップロード先: private/masterdata/_shards/<signature>/<shard>.json
+    """
+    if signature == "" or json_str == "":
+        raise ValueError("signature and json_str should not be empty.")
+    if shard < 0:
+        raise ValueError("shard must not be negative.")
+    blob_path = f"{MASTERDATA_SHARD_DIR}/{signature}/{shard}.json"
+    metadata = {
+        "Cache-Control": "no-store",
+        "content-type": "application/json; charset=utf-8",
+        "custom_time": get_now().isoformat(),
+    }
+    logger.info(f"start uploading masterdata shard {shard} to GCS")
+    return _upload_blob_json(blob_path, json_str, metadata)
+
+
+def get_masterdata_shard(signature: str, shard: int) -> str | None:
+    """masterdata の断片を GCS から取得する。まだ存在しない場合は None を返す。"""
+    if signature == "":
+        raise ValueError("signature should not be empty.")
+    blob_path = f"{MASTERDATA_SHARD_DIR}/{signature}/{shard}.json"
+    blob = _get_bucket().get_blob(blob_path)
+    if blob is None:
+        return None
+    return _download_blob_text(blob)
+
+
+def delete_masterdata_shards(signature: str, shards: int) -> None:
+    """結合し終わった masterdata の断片を削除する。存在しないものは無視する。"""
+    if signature == "":
+        raise ValueError("signature should not be empty.")
+    bucket = _get_bucket()
+    for shard in range(shards):
+        blob_path = f"{MASTERDATA_SHARD_DIR}/{signature}/{shard}.json"
+        try:
+            bucket.blob(blob_path).delete()
+        except NotFound:
+            logger.info(f"No masterdata shard to delete: {blob_path}")
+
+
 def get_closest_cached_rss_file(
     target_utc: datetime, prefix_dir: str, suffix_dir: str = "non"
 ) -> io.BytesIO | None:
-    """指定日のキャッシュされた RSS ファイルを取得する。prefix_dir は private/rss 以下のディレクトリ名。"""
+    """指定日のキャッシュされた RSS ファイルを取得する。prefix_dir は private/rss 以下のディレクトリ名。
+
+    最新のキャッシュは _latest.json (pointer) の1回の GET で決める。pointer が指すキャッシュが指定日のもの
+    でなければ None を返す。pointer がない場合 (pointer を置く前のキャッシュ) だけ、同日のファイルを一覧して探す。"""
     if prefix_dir == "":
         raise ValueError("target_isbn and prefix_dir should not be empty.")
     if target_utc is None:
@@ -218,27 +926,33 @@ def get_closest_cached_rss_file(
 
     # タイムゾーンを UTC から JST に変換
     target_jst = target_utc.astimezone(JST)
+    target_day = target_jst.strftime("%Y%m%d")
 
     bucket = _get_bucket()
     prefix_base = f"{RSS_RAW_DIR}/{prefix_dir}_{suffix_dir}"
+
+    pointer = get_rss_validators(prefix_dir, suffix_dir)
+    if pointer is not None:
+        if not pointer.blob_name.startswith(f"{prefix_base}/{target_day}"):
+            logger.info(f"Latest cached RSS file is not for {target_day}.")
+            return None
+        logger.info(f"Found closest cached RSS file: {pointer.blob_name}")
+        try:
+            return _download_blob_to_bytes_io(
+                bucket.blob(pointer.blob_name, generation=pointer.generation)
+            )
+        except NotFound:
+            logger.info(f"Cached RSS file is not found: {pointer.blob_name}")
+            return None
+
     # ソートはできないので、日までが同じものを全て取得してから、チェックする
     # ex: "private/rss/latest_all/20250209"
-    search_prefix = prefix_base + "/" + target_jst.strftime("%Y%m%d")
+    search_prefix = prefix_base + "/" + target_day
 
     logger.info(f"searching for cached RSS files...: {search_prefix}")
-    blobs = list(
-        bucket.list_blobs(
-            prefix=search_prefix,
-            max_results=10,
-        )
-    )
-    if not blobs:
-        logger.info("No cached RSS files found.")
-        return None
-
     # 同日の中で最も新しいファイルを有効なキャッシュとする
-    newest_blob: gcs.Blob | None = None
-    for blob in blobs:
+    newest_blob: BlobListing | None = None
+    for blob in list_blob_listings(search_prefix):
         logger.info(f"blob name: {blob.name}")
         if newest_blob is None:
             newest_blob = blob
@@ -253,39 +967,65 @@ def get_closest_cached_rss_file(
     logger.info(f"Found closest cached RSS file: {newest_blob.name}")
 
     bs = io.BytesIO()
-    newest_blob.download_to_file(bs)
+    bucket.blob(newest_blob.name, generation=newest_blob.generation).download_to_file(
+        bs
+    )
     # ファイルの先頭に戻す
     bs.seek(0)
     return bs
 
 
-def get_closest_cached_oai_pmh_file(
-    target_isbn: str, prefix_dir: str
-) -> io.BytesIO | None:
-    if target_isbn == "" or prefix_dir == "":
-        raise ValueError("target_isbn and prefix_dir should not be empty.")
+class BlobListing(BaseModel):
+    """一覧で取得する blob の情報。名前、generation、作成日時、サイズだけを持つ"""
 
-    bucket = _get_bucket()
+    name: str
+    generation: int | None = None
+    time_created: datetime | None = None
+    size: int | None = None
+
+
+# 一覧では BlobListing に必要なフィールドだけを返させる (nextPageToken がないと次のページを取得できない)
+BLOB_LISTING_FIELDS = "items(name,generation,timeCreated,size),nextPageToken"
+# 一覧の1ページの件数
+BLOB_LISTING_PAGE_SIZE = 1000
+
+
+def list_blob_listings(
+    prefix: str,
+    page_size: int = BLOB_LISTING_PAGE_SIZE,
+    max_results: int | None = None,
+) -> Iterator[BlobListing]:
+    """
+    prefix 以下の blob を名前の順に一覧する。必要なフィールドだけを page_size 件ずつのページで取得し、
+    次のページは読み進めた時に取得する。ACL や metadata などは取得しない。
+    """
+    if prefix == "":
+        raise ValueError("prefix should not be empty.")
+    blobs = _get_bucket().list_blobs(
+        prefix=prefix,
+        max_results=max_results,
+        page_size=page_size,
+        fields=BLOB_LISTING_FIELDS,
+    )
+    for blob in blobs:
+        yield BlobListing(
+            name=blob.name,
+            generation=blob.generation,
+            time_created=blob.time_created,
+            size=blob.size,
+        )
+
+
+def _find_newest_oai_pmh_blob(target_isbn: str, prefix_dir: str) -> BlobListing | None:
+    """private/oai_pmh 以下から identifier に一致する最も新しい blob を探す。"""
     prefix_base = f"{OAI_PMH_RAW_DIR}/{prefix_dir}"
     # ソートはできないので、同じものを取得してから、作成日チェックして、7日以内のものを取得する
     # ex: "private/oai_pmh/isbn/9784621310328"
     search_prefix = prefix_base + "/" + target_isbn
 
     logger.info(f"searching for cached OAI-PMH files...: {search_prefix}")
-    blobs = list(
-        bucket.list_blobs(
-            prefix=search_prefix,
-            max_results=10,
-        )
-    )
-    if not blobs:
-        logger.info("No cached OAI-PMH files found.")
-        return None
-
-    # 7日以内を有効なキャッシュとする
-    utcnow = get_now()
-    newest_blob: gcs.Blob | None = None
-    for blob in blobs:
+    newest_blob: BlobListing | None = None
+    for blob in list_blob_listings(search_prefix, page_size=10, max_results=10):
         logger.info(f"blob name: {blob.name}")
         if newest_blob is None:
             newest_blob = blob
@@ -294,36 +1034,535 @@ def get_closest_cached_oai_pmh_file(
                 newest_blob = blob
     if newest_blob is None:
         logger.info("No cached OAI-PMH files found.")
+    return newest_blob
+
+
+def get_closest_cached_oai_pmh_file(
+    target_isbn: str, prefix_dir: str
+) -> io.BytesIO | None:
+    if target_isbn == "" or prefix_dir == "":
+        raise ValueError("target_isbn and prefix_dir should not be empty.")
+
+    newest_blob = _find_newest_oai_pmh_blob(target_isbn, prefix_dir)
+    if newest_blob is None:
         return None
 
+    # 7日以内を有効なキャッシュとする
+    utcnow = get_now()
     if (
         newest_blob.time_created is not None
-        and get_diff_days(utcnow, newest_blob.time_created) > 7
+        and get_diff_days(utcnow, newest_blob.time_created) > OAI_PMH_CACHE_DAYS
     ):
         logger.info("Cached OAI-PMH file is too old.")
         return None
 
     logger.info(f"Found closest cached OAI-PMH file: {newest_blob.name}")
+    return _download_blob_to_bytes_io(
+        _get_bucket().blob(newest_blob.name, generation=newest_blob.generation)
+    )
 
-    bs = io.BytesIO()
-    newest_blob.download_to_file(bs)
-    # ファイルの先頭に戻す
-    bs.seek(0)
-    return bs
+
+class OaiPmhIndexEntry(BaseModel):
+    blob_name: str
+    generation: int | None = None
+    time_created: datetime | None = None
+    # 内容 (圧縮前) の SHA-256
+    digest: str | None = None
+    # 取得し直した内容が変わっていないことを最後に確認した日時
+    verified_at: datetime | None = None
+
+    @property
+    def cached_at(self) -> datetime | None:
+        """キャッシュの鮮度の基準。内容を確認し直していればその日時を使う"""
+        return self.verified_at or self.time_created
+
+
+class OaiPmhCacheIndex:
+    """
+    private/oai_pmh 以下のキャッシュの索引。identifier -> blob (name, generation, time_created, digest) を保持する。
+    索引は prefix_dir と identifier のハッシュで分割して private/oai_pmh/_index/<prefix_dir>/<shard>.json に置く。
+
+    ワークフローの実行ごとに1つ作成し、各 shard は初めて参照した時に1度だけ読み込む。
+    キャッシュの有無と鮮度の判定はメモリ上で行い、list_blobs を書籍ごとに呼ばない。
+    更新 (record) はメモリ上に溜めておき、最後に flush でまとめてアップロードする。
+    複数スレッドから共有して使う想定。
+    """
+
+    def __init__(self) -> None:
+        # (prefix_dir, shard) -> (identifier -> entry)
+        self._shards: dict[tuple[str, str], dict[str, OaiPmhIndexEntry]] = {}
+        self._dirty: dict[tuple[str, str], dict[str, OaiPmhIndexEntry]] = {}
+        self._lock = threading.Lock()
+        # shard の読み込みは shard ごとの lock で1度だけにする (他の shard の読み込みや参照は止めない)
+        self._shard_locks: dict[tuple[str, str], threading.Lock] = {}
+
+    @staticmethod
+    def _shard_of(identifier: str) -> str:
+        digest = hashlib.sha1(identifier.encode("utf-8")).hexdigest()
+        return f"{int(digest[:8], 16) % OAI_PMH_INDEX_SHARDS:02x}"
+
+    @staticmethod
+    def _shard_path(prefix_dir: str, shard: str) -> str:
+        return f"{OAI_PMH_INDEX_DIR}/{prefix_dir}/{shard}.json"
+
+    @staticmethod
+    def _download_shard(
+        prefix_dir: str, shard: str
+    ) -> tuple[dict[str, OaiPmhIndexEntry], int]:
+        """shard を取得する。存在しない場合は空の shard と generation 0 を返す。"""
+        blob = _get_bucket().get_blob(OaiPmhCacheIndex._shard_path(prefix_dir, shard))
+        if blob is None:
+            return {}, 0
+        raw = json.loads(blob.download_as_bytes().decode("utf-8"))
+        entries = {k: OaiPmhIndexEntry.model_validate(v) for k, v in raw.items()}
+        return entries, blob.generation or 0
+
+    def _get_shard(
+        self, prefix_dir: str, identifier: str
+    ) -> dict[str, OaiPmhIndexEntry]:
+        key = (prefix_dir, self._shard_of(identifier))
+        with self._lock:
+            shard = self._shards.get(key)
+            if shard is not None:
+                return shard
+            shard_lock = self._shard_locks.setdefault(key, threading.Lock())
+        with shard_lock:
+            with self._lock:
+                shard = self._shards.get(key)
+            if shard is None:
+                # ダウンロードは全体の lock の外で行い、読み込んだものだけを lock の中で置く
+                logger.info(f"loading OAI-PMH cache index: {self._shard_path(*key)}")
+                loaded, _ = self._download_shard(*key)
+                with self._lock:
+                    # 読み込んでいる間に flush が置いたものがあればそちらを使う
+                    shard = self._shards.setdefault(key, loaded)
+            return shard
+
+    def lookup(self, prefix_dir: str, identifier: str) -> OaiPmhIndexEntry | None:
+        """索引から identifier の blob を探す。索引にない場合は None を返す。"""
+        return self._get_shard(prefix_dir, identifier).get(identifier)
+
+    def _put(self, prefix_dir: str, identifier: str, entry: OaiPmhIndexEntry) -> None:
+        key = (prefix_dir, self._shard_of(identifier))
+        shard = self._get_shard(prefix_dir, identifier)
+        with self._lock:
+            shard[identifier] = entry
+            self._dirty.setdefault(key, {})[identifier] = entry
+
+    def record(
+        self, prefix_dir: str, identifier: str, blob: gcs.Blob | BlobListing
+    ) -> None:
+        """アップロードした (または一覧で見つけた) blob を索引に記録する。"""
+        # 一覧で見つけたもの (BlobListing) は metadata を取得していないので digest は記録しない
+        metadata = getattr(blob, "metadata", None) or {}
+        entry = OaiPmhIndexEntry(
+            blob_name=blob.name,
+            generation=blob.generation,
+            time_created=blob.time_created or get_now(),
+            digest=metadata.get(CONTENT_DIGEST_METADATA_KEY),
+        )
+        self._put(prefix_dir, identifier, entry)
+
+    def refresh_if_unchanged(
+        self, prefix_dir: str, identifier: str, digest: str
+    ) -> bool:
+        """索引の blob と内容 (SHA-256) が同じなら、アップロードせずに確認日時だけ更新して True を返す。
+        内容が変わった場合や、digest を記録する前のキャッシュの場合は False を返す。"""
+        entry = self.lookup(prefix_dir, identifier)
+        if entry is None or entry.digest is None or entry.digest != digest:
+            return False
+        self._put(
+            prefix_dir, identifier, entry.model_copy(update={"verified_at": get_now()})
+        )
+        return True
+
+    def flush(self) -> int:
+        """溜めておいた更新を索引にまとめて反映する。反映した entry の件数を返す。
+        他のワークフローと同時に更新しても失われないように、最新の shard を読み直してマージし、
+        generation の precondition 付きでアップロードする。"""
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = {}
+
+        count = 0
+        for (prefix_dir, shard), updates in dirty.items():
+            blob_path = self._shard_path(prefix_dir, shard)
+            for i in range(5):
+                entries, generation = self._download_shard(prefix_dir, shard)
+                for identifier, entry in updates.items():
+                    current = entries.get(identifier)
+                    if (
+                        current is None
+                        or current.cached_at is None
+                        or entry.cached_at is None
+                        or entry.cached_at >= current.cached_at
+                    ):
+                        entries[identifier] = entry
+                data = json.dumps(
+                    {k: v.model_dump(mode="json") for k, v in entries.items()},
+                    ensure_ascii=False,
+                    separators=(",", ":"),
+                )
+                try:
+                    _get_bucket().blob(blob_path).upload_from_string(
+                        data,
+                        content_type="application/json",
+                        if_generation_match=generation,
+                    )
+                    break
+                except PreconditionFailed:
+                    logger.info(f"index shard is updated concurrently. retry {i + 1}")
+                    if i == 4:
+                        raise
+            with self._lock:
+                self._shards[(prefix_dir, shard)] = entries
+            count += len(updates)
+        logger.info(f"flushed {count} entries to OAI-PMH cache index")
+        return count
+
+
+def get_cached_oai_pmh_file_with_index(
+    index: OaiPmhCacheIndex, target_isbn: str, prefix_dir: str
+) -> io.BytesIO | None:
+    """
+    索引を使ってキャッシュされた OAI-PMH ファイルを取得する。7日より古い場合は None を返す。
+    索引に存在しない identifier だけは list_blobs で探し、見つかれば索引に記録する (索引作成前のキャッシュへの対応)。
+    """
+    if target_isbn == "" or prefix_dir == "":
+        raise ValueError("target_isbn and prefix_dir should not be empty.")
+
+    entry = index.lookup(prefix_dir, target_isbn)
+    if entry is None:
+        blob = _find_newest_oai_pmh_blob(target_isbn, prefix_dir)
+        if blob is None:
+            return None
+        index.record(prefix_dir, target_isbn, blob)
+        entry = index.lookup(prefix_dir, target_isbn)
+        if entry is None:
+            return None
+
+    # 7日以内を有効なキャッシュとする
+    if (
+        entry.cached_at is not None
+        and get_diff_days(get_now(), entry.cached_at) > OAI_PMH_CACHE_DAYS
+    ):
+        logger.info("Cached OAI-PMH file is too old.")
+        return None
+
+    logger.info(f"Found cached OAI-PMH file in index: {entry.blob_name}")
+    blob = _get_bucket().blob(entry.blob_name, generation=entry.generation)
+    try:
+        return _download_blob_to_bytes_io(blob)
+    except NotFound:
+        logger.info(f"Cached OAI-PMH file is not found: {entry.blob_name}")
+        return None
+
+
+def llm_response_cache_path(key: str) -> str:
+    """LLM の応答のキャッシュのパス: private/llm_cache/<key>.json"""
+    if key == "":
+        raise ValueError("key should not be empty.")
+    return f"{LLM_RESPONSE_CACHE_DIR}/{key}.json"
+
+
+def put_llm_response(key: str, response: str) -> gcs.Blob:
+    """LLM の応答を入力のハッシュ (key) ごとに保存する。"""
+    if response == "":
+        raise ValueError("response should not be empty.")
+    metadata = {
+        "Cache-Control": "no-store",
+        "content-type": "application/json; charset=utf-8",
+        "custom_time": get_now().isoformat(),
+    }
+    return _upload_blob_json(
+        llm_response_cache_path(key),
+        json.dumps({"response": response}, ensure_ascii=False),
+        metadata,
+    )
+
+
+def get_llm_response(key: str) -> str | None:
+    """key の LLM の応答を返す。存在しないか LLM_RESPONSE_CACHE_DAYS より古い場合は None を返す。"""
+    blob_path = llm_response_cache_path(key)
+    bucket = _get_bucket()
+    current = bucket.get_blob(blob_path)
+    if current is None:
+        return None
+    if (
+        current.time_created is not None
+        and get_diff_days(get_now(), current.time_created) > LLM_RESPONSE_CACHE_DAYS
+    ):
+        logger.info(f"Cached LLM response is too old: {blob_path}")
+        return None
+    try:
+        text = _download_blob_text(
+            bucket.blob(blob_path, generation=current.generation)
+        )
+    except NotFound:
+        # 確認した後に置き換えられた
+        return None
+    return json.loads(text)["response"]
+
+
+_read_cache: BlobReadCache | None = None
+_read_cache_lock = threading.Lock()
+
+
+def _get_read_cache() -> BlobReadCache:
+    global _read_cache
+    with _read_cache_lock:
+        if _read_cache is None:
+            _read_cache = BlobReadCache(
+                BLOB_READ_CACHE_DIR,
+                memory_max_bytes=BLOB_READ_CACHE_MEMORY_BYTES,
+                disk_max_bytes=BLOB_READ_CACHE_DISK_BYTES,
+            )
+        return _read_cache
+
+
+def _read_blob_cached(blob_path: str) -> bytes:
+    """
+    blob 全体を読み出しのキャッシュを通して取得する。gzip で保存されたものは展開する。
+    読み出したことのあるパスは metadata だけを取得して現在の generation を調べ、同じ generation ならダウンロードしない。
+    初めて読むパスは metadata を取得せずにダウンロードし、generation はダウンロードの応答から得る。
+    """
+    bucket = _get_bucket()
+    cache = _get_read_cache()
+    if cache.contains(blob_path):
+        current = bucket.get_blob(blob_path)
+        if current is None:
+            raise NotFound(f"No such object: {blob_path}")
+        if current.generation is not None:
+            cached = cache.get(blob_path, current.generation)
+            if cached is not None:
+                logger.info(f"read cache hit: {blob_path} ({current.generation})")
+                return cached
+        # 調べた generation を指定して読むので、その間に置き換えられても内容と generation は食い違わない
+        blob = bucket.blob(blob_path, generation=current.generation)
+    else:
+        blob = bucket.blob(blob_path)
+    try:
+        data = _download_blob_bytes(blob)
+    except Exception:
+        logger.error(f"Failed to download string from GCS: {blob_path}", exc_info=True)
+        raise
+    if blob.generation is not None:
+        cache.put(blob_path, blob.generation, data)
+    return data
 
 
 def get_json_file(blob_path: str) -> str:
     """
     Masterdata ファイル (JSON) を GCS から取得する。
     URL は private/masterdata/<signature>.json とする。
+    gzip で圧縮して保存したものは展開する。圧縮していない既存のファイルもそのまま読める。
+    読み出しのキャッシュを通すので、同じ generation を読み出したことがあればダウンロードしない。
     """
     if blob_path == "":
         raise ValueError("url should not be empty.")
+    return _read_blob_cached(blob_path).decode("utf-8")
+
+
+class _DeleteBatch(Batch):
+    """finish の戻り値 (積んだ順の、リクエストごとの応答) を responses に残す Batch。
+    raise_exception=False の場合、失敗したリクエストの応答もそのまま含まれる。"""
+
+    def __init__(self, client: gcs.Client, raise_exception: bool = True):
+        super().__init__(client, raise_exception=raise_exception)
+        self.responses: list[Any] = []
+
+    def finish(self, raise_exception: bool = True) -> list[Any]:
+        self.responses = super().finish(raise_exception=raise_exception)
+        return self.responses
+
+
+def delete_blobs(blobs: list[gcs.Blob]) -> list[gcs.Blob]:
+    """blob をまとめて削除し、削除できたものを返す。GCS では CACHE_GC_DELETE_BATCH_SIZE 件ずつの batch request にする。
+    既に存在しないもの (別の generation に置き換わったものを含む) や削除に失敗したものは返さない。"""
     bucket = _get_bucket()
-    blob = bucket.blob(blob_path)
-    try:
-        json_str = blob.download_as_string()
-    except Exception:
-        logger.error(f"Failed to download string from GCS: {blob_path}", exc_info=True)
-        raise
-    return json_str.decode("utf-8")
+    client = getattr(bucket, "client", None)
+    deleted: list[gcs.Blob] = []
+    for i in range(0, len(blobs), CACHE_GC_DELETE_BATCH_SIZE):
+        chunk = blobs[i : i + CACHE_GC_DELETE_BATCH_SIZE]
+        if client is not None and hasattr(client, "batch"):
+            with _DeleteBatch(client, raise_exception=False) as batch:
+                for blob in chunk:
+                    blob.delete()
+            # batch の応答は積んだ順に並ぶ。2xx のものだけを削除できたとする
+            for blob, response in zip(chunk, batch.responses, strict=True):
+                if 200 <= response.status_code < 300:
+                    deleted.append(blob)
+        else:
+            # batch request のない backend (ローカルディスク) では1件ずつ削除する
+            failed: list[gcs.Blob] = []
+            bucket.delete_blobs(chunk, on_error=failed.append)
+            failed_ids = {id(blob) for blob in failed}
+            deleted.extend(blob for blob in chunk if id(blob) not in failed_ids)
+    return deleted
+
+
+def _delete_listings(listings: list[BlobListing]) -> list[BlobListing]:
+    """一覧した generation を指定して削除し、削除できたものを返す"""
+    bucket = _get_bucket()
+    blobs = [bucket.blob(b.name, generation=b.generation) for b in listings]
+    deleted = {id(blob) for blob in delete_blobs(blobs)}
+    return [
+        listing
+        for listing, blob in zip(listings, blobs, strict=True)
+        if id(blob) in deleted
+    ]
+
+
+class CacheGcResult(BaseModel):
+    prefix: str
+    # 一覧した blob の数
+    scanned: int = 0
+    # 残した blob の数
+    kept: int = 0
+    # 削除した blob の数と合計サイズ
+    deleted: int = 0
+    reclaimed_bytes: int = 0
+
+
+def rss_cache_key(relative_name: str) -> str:
+    """RSS のキャッシュを日ごとにまとめるキー。<prefix_dir>_<suffix_dir>/<YYYYMMDD>_... -> <prefix_dir>_<suffix_dir>/<YYYYMMDD>"""
+    feed_dir, _, file_name = relative_name.rpartition("/")
+    return f"{feed_dir}/{file_name[:8]}"
+
+
+def gc_cache_blobs(
+    prefix: str, key_func: Callable[[str], str], dry_run: bool = False
+) -> CacheGcResult:
+    """
+    prefix 以下の blob をページごとに一覧し、key_func (prefix からの相対パス -> キー) が同じものの中で
+    最も新しい (time_created, 名前の順) ものだけを残して、それ以外を batch request で削除する。
+    名前が "_" で始まるパス (索引、pointer、harvest の状態など) は対象にしない。
+    削除は一覧した generation を指定して行うので、一覧の後に書き換えられた blob は削除しない。
+    """
+    if prefix == "":
+        raise ValueError("prefix should not be empty.")
+    base = prefix.rstrip("/") + "/"
+    result = CacheGcResult(prefix=base)
+    # キー -> これまでで最も新しい blob
+    newest: dict[str, BlobListing] = {}
+    pending: list[BlobListing] = []
+
+    def sort_key(blob: BlobListing) -> tuple[datetime, str]:
+        return (blob.time_created or datetime.min.replace(tzinfo=JST), blob.name)
+
+    def count(blobs: list[BlobListing]) -> None:
+        result.deleted += len(blobs)
+        result.reclaimed_bytes += sum(blob.size or 0 for blob in blobs)
+
+    def drop(blob: BlobListing) -> None:
+        if dry_run:
+            count([blob])
+            return
+        pending.append(blob)
+        if len(pending) >= CACHE_GC_DELETE_BATCH_SIZE:
+            count(_delete_listings(pending))
+            pending.clear()
+
+    for blob in list_blob_listings(base, page_size=CACHE_GC_PAGE_SIZE):
+        relative_name = blob.name[len(base) :]
+        if any(part.startswith("_") for part in relative_name.split("/")):
+            continue
+        result.scanned += 1
+        key = key_func(relative_name)
+        current = newest.get(key)
+        if current is None:
+            newest[key] = blob
+        elif sort_key(blob) > sort_key(current):
+            newest[key] = blob
+            drop(current)
+        else:
+            drop(blob)
+    if pending:
+        count(_delete_listings(pending))
+    result.kept = len(newest)
+    logger.info(
+        f"cache gc {base}: scanned {result.scanned}, deleted {result.deleted} ({result.reclaimed_bytes} bytes)"
+        + (" (dry run)" if dry_run else "")
+    )
+    return result
+
+
+def gc_llm_response_cache(
+    max_age_days: int = LLM_RESPONSE_CACHE_DAYS,
+    max_bytes: int = LLM_RESPONSE_CACHE_MAX_BYTES,
+    dry_run: bool = False,
+) -> CacheGcResult:
+    """
+    LLM の応答のキャッシュのうち、max_age_days より古いものを削除し、
+    残りは新しいものから合計 max_bytes までを残して、それより古いものを削除する。
+    """
+    base = LLM_RESPONSE_CACHE_DIR + "/"
+    result = CacheGcResult(prefix=base)
+    now = get_now()
+    fresh: list[BlobListing] = []
+    expired: list[BlobListing] = []
+    for blob in list_blob_listings(base, page_size=CACHE_GC_PAGE_SIZE):
+        result.scanned += 1
+        if (
+            blob.time_created is not None
+            and get_diff_days(now, blob.time_created) > max_age_days
+        ):
+            expired.append(blob)
+        else:
+            fresh.append(blob)
+    fresh.sort(
+        key=lambda b: (b.time_created or datetime.min.replace(tzinfo=JST), b.name),
+        reverse=True,
+    )
+    total = 0
+    for blob in fresh:
+        total += blob.size or 0
+        if total > max_bytes:
+            expired.append(blob)
+        else:
+            result.kept += 1
+    if not dry_run and expired:
+        expired = _delete_listings(expired)
+    result.deleted = len(expired)
+    result.reclaimed_bytes = sum(blob.size or 0 for blob in expired)
+    logger.info(
+        f"cache gc {base}: scanned {result.scanned}, deleted {result.deleted} ({result.reclaimed_bytes} bytes)"
+        + (" (dry run)" if dry_run else "")
+    )
+    return result
+
+
+def gc_masterdata_work_blobs(
+    base_dir: str, max_age_days: int, dry_run: bool = False
+) -> CacheGcResult:
+    """
+    masterdata の作成途中のファイル (base_dir/<signature>/...) のうち、signature ごとに
+    最も新しいものが max_age_days より古いものをまとめて削除する。
+    チェックポイントは segment と cursor が揃っていないと読めないので、一部だけを削除しない。
+    """
+    base = base_dir + "/"
+    result = CacheGcResult(prefix=base)
+    now = get_now()
+    groups: dict[str, list[BlobListing]] = {}
+    for blob in list_blob_listings(base, page_size=CACHE_GC_PAGE_SIZE):
+        result.scanned += 1
+        groups.setdefault(blob.name[len(base) :].split("/", 1)[0], []).append(blob)
+    expired: list[BlobListing] = []
+    for blobs in groups.values():
+        if all(
+            blob.time_created is not None
+            and get_diff_days(now, blob.time_created) > max_age_days
+            for blob in blobs
+        ):
+            expired.extend(blobs)
+        else:
+            result.kept += len(blobs)
+    if not dry_run and expired:
+        expired = _delete_listings(expired)
+    result.deleted = len(expired)
+    result.reclaimed_bytes = sum(blob.size or 0 for blob in expired)
+    logger.info(
+        f"cache gc {base}: scanned {result.scanned}, deleted {result.deleted} ({result.reclaimed_bytes} bytes)"
+        + (" (dry run)" if dry_run else "")
+    )
+    return result
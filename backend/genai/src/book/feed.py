@@ -1,17 +1,24 @@
+import xml.etree.ElementTree as ET
+from collections.abc import Iterator
+from contextlib import ExitStack, contextmanager
 from datetime import UTC, datetime
+from email.utils import parsedate_to_datetime
 from typing import Any
 
 import feedparser  # type: ignore
-import httpx
+from feedparser.sanitizer import _sanitize_html  # type: ignore
 from pydantic import BaseModel
 
+from src import http_client
 from src.logger import logger
 
 
 def fetch_rss(url: str) -> str:
-    """httpx を使って RSS フィードを取得する関数。"""
+    """共有の httpx.Client を使って RSS フィードを取得する関数。"""
     try:
-        response = httpx.get(url, timeout=300)  # タイムアウトは 300 秒 = 5 分
+        response = http_client.get_client(url).get(
+            url, timeout=300
+        )  # タイムアウトは 300 秒 = 5 分
         response.raise_for_status()
         raw_xml = response.text
         return raw_xml
@@ -22,6 +29,47 @@ def fetch_rss(url: str) -> str:
         l
 
 
+class RssFetchResult(BaseModel):
+    raw_xml: str = ""
+    # 次回の条件付きリクエストに使う validator
+    etag: str | None = None
+    last_modified: str | None = None
+    # 304 Not Modified の場合は True (raw_xml は空)
+    not_modified: bool = False
+
+
+def fetch_rss_conditional(
+    url: str, etag: str | None = None, last_modified: str | None = None
+) -> RssFetchResult:
+    """If-None-Match / If-Modified-Since を付けて RSS フィードを取得する関数。
+    304 の場合は not_modified=True を返すので、呼び出し側でキャッシュを使うこと。"""
+    headers: dict[str, str] = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    try:
+        # タイムアウトは 300 秒 = 5 分
+        response = http_client.get_client(url).get(url, headers=headers, timeout=300)
+        if response.status_code == 304:
+            logger.info(f"RSS フィードは更新されていません: {url}")
+            return RssFetchResult(
+                etag=response.headers.get("ETag", etag),
+                last_modified=response.headers.get("Last-Modified", last_modified),
+                not_modified=True,
+            )
+        response.raise_for_status()
+        return RssFetchResult(
+            raw_xml=response.text,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+    except Exception as e:
+        logger.error(f"RSS フィードの取得に失敗しました: {url}")
+        logger.error(e)
+        raise e
+
+
 def parse_rss(raw_xml: str) -> tuple[feedparser.FeedParserDict, datetime | None]:
     """
     生の XML 文字列から feedparser を使って RSS フィードをパースし、
@@ -66,18 +114,12 @@ class FeedEntry(BaseModel):
         extra = "allow"
 
 
-def convert_to_entry_item(feed: feedparser.FeedParserDict) -> FeedEntry:
-    """feedparser.FeedParserDict を FeedEntry に変換する関数。"""
-    # published_parseを使ってutc datetimeに変換
-    published_date = None
-    published_parsed = feed.get("published_parsed")
-    published_date = datetime(*published_parsed[:6], tzinfo=UTC)
-
+def _parse_link_id(link_id: str) -> tuple[str, str, str]:
+    """link (id) から (repo, isbn, jp_e_code) を取り出す関数。"""
     # linkの末尾を取り出し `https://ndlsearch.ndl.go.jp/books/R100000137-I9784798073972`
     # `R100000137-I9784798073972` のように 13桁をISBN
     # `R100000137-I09D154490010d0000000` のように 20桁をJP-eコード
     # として取り出す I が先頭についているので取り除くことに注意
-    link_id: str = feed.get("id", "")
     repo = ""
     isbn = ""
     jp_e_code = ""
@@ -85,13 +127,24 @@ def convert_to_entry_item(feed: feedparser.FeedParserDict) -> FeedEntry:
         last_part = link_id.split("/")[-1]
         parts = last_part.split("-")
         if len(parts) == 2:
-            parts[1] = parts[1]
             repo = parts[0]
             signature = parts[1][1:]  # 先頭の1文字(I)を取り除く
             if len(signature) == 13:  # ISBN
                 isbn = signature
             elif len(signature) == 20:  # JP-eコード
                 jp_e_code = signature
+    return repo, isbn, jp_e_code
+
+
+def convert_to_entry_item(feed: feedparser.FeedParserDict) -> FeedEntry:
+    """feedparser.FeedParserDict を FeedEntry に変換する関数。"""
+    # published_parseを使ってutc datetimeに変換
+    published_date = None
+    published_parsed = feed.get("published_parsed")
+    published_date = datetime(*published_parsed[:6], tzinfo=UTC)
+
+    link_id: str = feed.get("id", "")
+    repo, isbn, jp_e_code = _parse_link_id(link_id)
 
     data: dict[str, Any] = {
         "title": feed.get("title", ""),
@@ -111,3 +164,195 @@ def convert_to_entry_item(feed: feedparser.FeedParserDict) -> FeedEntry:
 
     # NOTE: 厳密にすると今後の変更に追随できないので `construct` でゆるい型チェックにする
     return FeedEntry.construct(**data)
+
+
+def _parse_rfc822_datetime(value: str | None) -> datetime | None:
+    """RSS の日時 (RFC 822) を UTC の datetime に変換する。変換できない場合は None を返す。"""
+    if not value:
+        return None
+    try:
+        parsed = parsedate_to_datetime(value.strip())
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=UTC)
+    return parsed.astimezone(UTC)
+
+
+def _convert_item_element(item: ET.Element) -> FeedEntry:
+    """RSS の <item> 要素を FeedEntry に変換する関数。feedparser と同じ形の値にする。"""
+    title = (item.findtext("title") or "").strip()
+    link = (item.findtext("link") or "").strip()
+    # feedparser と同じく、description の HTML から危険なタグや属性を取り除く
+    summary = _sanitize_html(
+        (item.findtext("description") or "").strip(), "utf-8", "text/html"
+    )
+    guid_element = item.find("guid")
+    link_id = link
+    guidislink = False
+    if guid_element is not None and guid_element.text:
+        link_id = guid_element.text.strip()
+        guidislink = link_id != link and guid_element.get("isPermaLink") == "true"
+    repo, isbn, jp_e_code = _parse_link_id(link_id)
+
+    data: dict[str, Any] = {
+        "title": title,
+        "title_detail": {
+            "type": "text/plain",
+            "language": None,
+            "base": "",
+            "value": title,
+        },
+        "links": [{"rel": "alternate", "type": "text/html", "href": link}]
+        if link
+        else [],
+        "link": link,
+        "summary": summary,
+        "summary_detail": {
+            "type": "text/html",
+            "language": None,
+            "base": "",
+            "value": summary,
+        },
+        "id": link_id,
+        "guidislink": guidislink,
+        "tags": [
+            {"term": c.text.strip(), "scheme": None, "label": None}
+            for c in item.findall("category")
+            if c.text
+        ],
+        "published": _parse_rfc822_datetime(item.findtext("pubDate")),
+        "repo": repo,
+        "isbn": isbn,
+        "jp_e_code": jp_e_code,
+    }
+    return FeedEntry.construct(**data)
+
+
+class RssStreamParser:
+    """
+    RSS をバイト列の断片ごとにパースして、<item> が閉じたところで FeedEntry を返すパーサー。
+    パース済みの <item> 要素は破棄するので、フィード全体のツリーはメモリに残らない。
+    <lastBuildDate> (なければ channel の <pubDate>) は読み込んだ時点で last_build_date (UTC) に入る。
+    <lastBuildDate> より先に閉じた item があれば items_before_last_build_date が True になる。
+    """
+
+    def __init__(self) -> None:
+        self._parser = ET.XMLPullParser(events=("start", "end"))
+        self._stack: list[ET.Element] = []
+        self.last_build_date: datetime | None = None
+        self.items_before_last_build_date = False
+        self._channel_published: datetime | None = None
+
+    def feed(self, chunk: bytes) -> list[FeedEntry]:
+        """断片を読み込み、この断片で閉じた item を FeedEntry にして返す"""
+        self._parser.feed(chunk)
+        return self._read_events()
+
+    def close(self) -> list[FeedEntry]:
+        """最後まで読み込んだ後に呼ぶ。last_build_date がなければ channel の pubDate を使う"""
+        self._parser.close()
+        entries = self._read_events()
+        if self.last_build_date is None:
+            self.last_build_date = self._channel_published
+        if self.last_build_date is None:
+            logger.warning("RSS フィードの更新日時が取得できませんでした。")
+        return entries
+
+    def _read_events(self) -> list[FeedEntry]:
+        entries: list[FeedEntry] = []
+        for event, element in self._parser.read_events():
+            if event == "start":
+                self._stack.append(element)
+                continue
+            self._stack.pop()
+            parent = self._stack[-1] if self._stack else None
+            if parent is None or parent.tag != "channel":
+                continue
+            if element.tag == "item":
+                entries.append(_convert_item_element(element))
+                if self.last_build_date is None:
+                    self.items_before_last_build_date = True
+                # パース済みの item は channel から外してメモリを解放する
+                parent.remove(element)
+            elif element.tag == "lastBuildDate":
+                self.last_build_date = _parse_rfc822_datetime(element.text)
+            elif element.tag == "pubDate":
+                self._channel_published = _parse_rfc822_datetime(element.text)
+        return entries
+
+
+class RssStreamResponse:
+    """stream_rss の結果。not_modified でなければ chunks から本文を順に読み出せる"""
+
+    def __init__(
+        self,
+        chunks: Iterator[bytes],
+        etag: str | None = None,
+        last_modified: str | None = None,
+        not_modified: bool = False,
+    ):
+        self.chunks = chunks
+        self.etag = etag
+        self.last_modified = last_modified
+        self.not_modified = not_modified
+
+
+def _iter_response_bytes(response: Any, url: str) -> Iterator[bytes]:
+    """本文を受信しながら返す。受信中の失敗は取得の失敗としてログに残す"""
+    try:
+        yield from response.iter_bytes()
+    except Exception as e:
+        logger.error(f"RSS フィードの取得に失敗しました: {url}")
+        logger.error(e)
+        raise e
+
+
+@contextmanager
+def stream_rss(
+    url: str, etag: str | None = None, last_modified: str | None = None
+) -> Iterator[RssStreamResponse]:
+    """fetch_rss_conditional の streaming 版。本文を受信しながら読み出せる。
+    with の中で呼び出し側が投げた例外は、取得の失敗としてはログに残さない。"""
+    headers: dict[str, str] = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    with ExitStack() as stack:
+        try:
+            # タイムアウトは 300 秒 = 5 分
+            response = stack.enter_context(
+                http_client.get_client(url).stream(
+                    "GET", url, headers=headers, timeout=300
+                )
+            )
+            if response.status_code != 304:
+                response.raise_for_status()
+        except Exception as e:
+            logger.error(f"RSS フィードの取得に失敗しました: {url}")
+            logger.error(e)
+            raise e
+        if response.status_code == 304:
+            logger.info(f"RSS フィードは更新されていません: {url}")
+            yield RssStreamResponse(
+                iter(()),
+                etag=response.headers.get("ETag", etag),
+                last_modified=response.headers.get("Last-Modified", last_modified),
+                not_modified=True,
+            )
+            return
+        yield RssStreamResponse(
+            _iter_response_bytes(response, url),
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+
+
+def iter_rss_entries(
+    chunks: Iterator[bytes], parser: RssStreamParser
+) -> Iterator[FeedEntry]:
+    """断片を parser に渡しながら、閉じた item から順に FeedEntry を返す"""
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
@@ -1,16 +1,43 @@
+from collections.abc import Iterator
+from datetime import UTC, datetime
 from typing import Any
 
+from pydantic import BaseModel
 from sickle import Sickle
+from sickle.models import Record
+
+from src import http_client
+from src.logger import logger
 
 from .book import JPRO_REPOSITORY, OAI_PMH_URL_BASE
 
-sickle_client = Sickle(OAI_PMH_URL_BASE)
+
+class PooledSickle(Sickle):
+    """requests の代わりに共有の httpx.Client でリクエストする Sickle。
+    httpx.Response は Sickle が使う属性 (status_code, headers, text, content, encoding) を持つ。"""
+
+    def _request(self, kwargs):
+        client = http_client.get_client(self.endpoint)
+        if self.http_method == "GET":
+            return client.get(self.endpoint, params=kwargs, **self.request_args)
+        return client.post(self.endpoint, data=kwargs, **self.request_args)
+
+
+sickle_client = PooledSickle(OAI_PMH_URL_BASE)
+
+# OAI-PMH の identifier の接頭辞
+OAI_IDENTIFIER_PREFIX = "oai:ndlsearch.ndl.go.jp:"
+# from / until に指定する datestamp の書式 (UTC)
+OAI_DATESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+IDENTIFIER_TYPE_ISBN = "isbn"
+IDENTIFIER_TYPE_JP_E_CODE = "jp_e_code"
 
 
 def _get_metadata_by_identifier(repository: str, identifier: str) -> dict[str, Any]:
     if repository == "" or identifier == "":
         raise ValueError("repository and identifier should not be empty")
-    identifier = f"oai:ndlsearch.ndl.go.jp:{repository}-I{identifier}"
+    identifier = f"{OAI_IDENTIFIER_PREFIX}{repository}-I{identifier}"
     # dcndl が情報が多いのでそちらを利用
     record = sickle_client.GetRecord(metadataPrefix="dcndl", identifier=identifier)  # type: ignore
     metadata = record.metadata  # type: ignore
@@ -42,6 +69,107 @@ def get_metadata_by_jp_e_code(
     return _get_metadata_by_identifier(repository, jp_e_code)
 
 
+def parse_oai_identifier(oai_identifier: str) -> tuple[str, str]:
+    """OAI-PMH の identifier から (種別, ISBN or JP-eコード) を取り出す
+    例: oai:ndlsearch.ndl.go.jp:R100000137-I9784621310328 -> ("isbn", "9784621310328")
+    取り出せない場合は ("", "") を返す
+    """
+    if not oai_identifier.startswith(OAI_IDENTIFIER_PREFIX):
+        return "", ""
+    parts = oai_identifier[len(OAI_IDENTIFIER_PREFIX) :].split("-")
+    if len(parts) != 2 or not parts[1].startswith("I"):
+        return "", ""
+    signature = parts[1][1:]  # 先頭の1文字(I)を取り除く
+    if len(signature) == 13:
+        return IDENTIFIER_TYPE_ISBN, signature
+    if len(signature) == 20:
+        return IDENTIFIER_TYPE_JP_E_CODE, signature
+    return "", ""
+
+
+class HarvestedRecord(BaseModel):
+    identifier_type: str
+    identifier: str
+    datestamp: str
+    deleted: bool = False
+    metadata: dict[str, Any] = {}
+
+
+class HarvestedPage(BaseModel):
+    records: list[HarvestedRecord] = []
+    # 次のページを取得するための resumptionToken。最後のページでは None
+    next_resumption_token: str | None = None
+
+
+def list_record_pages(
+    from_date: datetime,
+    until_date: datetime,
+    repository: str = JPRO_REPOSITORY,
+    resumption_token: str | None = None,
+) -> Iterator[HarvestedPage]:
+    """ListRecords で repository (set) の from_date から until_date までに更新された書誌情報をページ単位で取得する
+    resumption_token を指定した場合はそのページから再開する
+    例: https://ndlsearch.ndl.go.jp/api/oaipmh?verb=ListRecords&metadataPrefix=dcndl&set=R100000137&from=2025-02-09T00:00:00Z&until=2025-02-10T00:00:00Z
+    """
+    if repository == "":
+        raise ValueError("repository should not be empty")
+    if from_date.tzinfo is None or until_date.tzinfo is None:
+        raise ValueError("from_date and until_date must be timezone-aware.")
+
+    ns = sickle_client.oai_namespace
+    token = resumption_token
+    while True:
+        if token:
+            params = {"verb": "ListRecords", "resumptionToken": token}
+        else:
+            params = {
+                "verb": "ListRecords",
+                # dcndl が情報が多いのでそちらを利用 (GetRecord と揃える)
+                "metadataPrefix": "dcndl",
+                "set": repository,
+                "from": from_date.astimezone(UTC).strftime(OAI_DATESTAMP_FORMAT),
+                "until": until_date.astimezone(UTC).strftime(OAI_DATESTAMP_FORMAT),
+            }
+        logger.info(f"ListRecords: {params}")
+        response = sickle_client.harvest(**params)  # type: ignore
+        # OAIResponse.xml はアクセスのたびにパースし直すので、1回だけ取り出して使い回す
+        tree = response.xml
+
+        error = tree.find(".//" + ns + "error")  # type: ignore
+        if error is not None:
+            code = error.attrib.get("code", "")
+            if code == "noRecordsMatch":
+                logger.info("ListRecords: no records match.")
+                return
+            raise ValueError(f"OAI-PMH error: {code} {error.text or ''}")
+
+        records: list[HarvestedRecord] = []
+        for element in tree.iterfind(".//" + ns + "record"):  # type: ignore
+            record = Record(element)
+            identifier_type, identifier = parse_oai_identifier(
+                record.header.identifier or ""
+            )
+            if identifier_type == "":
+                logger.warning(f"unknown identifier: {record.header.identifier}")
+                continue
+            records.append(
+                HarvestedRecord(
+                    identifier_type=identifier_type,
+                    identifier=identifier,
+                    datestamp=record.header.datestamp or "",
+                    deleted=record.deleted,
+                    metadata={} if record.deleted else record.metadata,
+                )
+            )
+
+        token_element = tree.find(".//" + ns + "resumptionToken")  # type: ignore
+        next_token = token_element.text if token_element is not None else None
+        yield HarvestedPage(records=records, next_resumption_token=next_token or None)
+        if not next_token:
+            return
+        token = next_token
+
+
 if __name__ == "__main__":
     isbn = "9784621310328"
     get_metadata_by_isbn(isbn)
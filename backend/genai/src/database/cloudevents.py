@@ -4,8 +4,7 @@ import uuid
 from datetime import UTC, datetime
 from typing import Any
 
-import httpx
-
+from src import http_client
 from src.logger import logger
 
 # Eventarc のエミュレータ用エンドポイント
@@ -57,7 +56,9 @@ def send_cloud_event(endpoint: str, event_body: dict[str, Any]) -> None:
 
         headers = {"Content-Type": "application/cloudevents+json"}
         # timeoutしがちなので、タイムアウトを長めに設定
-        response = httpx.post(endpoint, headers=headers, json=event_body, timeout=30)
+        response = http_client.get_client(endpoint).post(
+            endpoint, headers=headers, json=event_body, timeout=30
+        )
 
         if response.status_code < 300:
             logger.info("[INFO] CloudEvent sent successfully.")
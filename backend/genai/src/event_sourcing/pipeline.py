@@ -0,0 +1,225 @@
+# 段階 (stage) ごとにスレッドと有界キューで繋いだ producer/consumer パイプライン
+#
+# source -> [queue] -> stage 1 (N workers) -> [queue] -> stage 2 (M workers) -> ... -> 結果
+#
+# * キューは有界なので、遅い stage の手前で上流が待たされる (backpressure)
+# * stage ごとに並列数を設定できる
+# * stage ごとに処理件数・処理時間・入力待ち・出力待ちを計測するので、どこが律速か分かる
+# * 結果は source の順序で返す
+
+import queue
+import threading
+import time
+from collections.abc import Callable, Iterable
+from typing import Any
+
+from src.logger import logger
+
+# 各 stage に stop を伝えるための番兵
+_STOP = object()
+
+
+class StageStats:
+    """stage ごとのスループット計測値。複数の worker から更新される。"""
+
+    def __init__(self, name: str, concurrency: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.processed = 0
+        # 処理に使った時間 (全 worker の合計)
+        self.busy_seconds = 0.0
+        # 上流からの入力を待っていた時間 (全 worker の合計)
+        self.wait_input_seconds = 0.0
+        # 下流のキューが空くのを待っていた時間 (全 worker の合計)
+        self.wait_output_seconds = 0.0
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self._lock = threading.Lock()
+
+    def add(self, busy: float, wait_input: float, wait_output: float) -> None:
+        with self._lock:
+            self.processed += 1
+            self.busy_seconds += busy
+            self.wait_input_seconds += wait_input
+            self.wait_output_seconds += wait_output
+
+    @property
+    def elapsed_seconds(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def throughput(self) -> float:
+        """1秒あたりの処理件数"""
+        elapsed = self.elapsed_seconds
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def utilization(self) -> float:
+        """worker が処理に使っていた時間の割合。1 に近い stage が律速"""
+        capacity = self.elapsed_seconds * self.concurrency
+        return self.busy_seconds / capacity if capacity > 0 else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"[{self.name}] processed: {self.processed}, concurrency: {self.concurrency}, "
+            f"throughput: {self.throughput:.2f}/s, utilization: {self.utilization:.0%}, "
+            f"busy: {self.busy_seconds:.2f}s, wait_input: {self.wait_input_seconds:.2f}s, "
+            f"wait_output: {self.wait_output_seconds:.2f}s"
+        )
+
+
+class Stage:
+    """パイプラインの1段。func は1件を受け取り、次の段に渡す1件を返す。"""
+
+    def __init__(self, name: str, func: Callable[[Any], Any], concurrency: int = 1):
+        if name == "":
+            raise ValueError("name should not be empty.")
+        if concurrency < 1:
+            raise ValueError("concurrency must be positive.")
+        self.name = name
+        self.func = func
+        self.concurrency = concurrency
+
+
+class Pipeline:
+    """
+    Stage を有界キューで繋いで実行するパイプライン。
+    run(source) は source の各要素を全 stage に通した結果を、source の順序で返す。
+    どこかの stage で例外が発生した場合は、残りを破棄して最初の例外を run から送出する。
+    """
+
+    def __init__(self, stages: list[Stage], queue_size: int = 64, name: str = ""):
+        if len(stages) == 0:
+            raise ValueError("stages should not be empty.")
+        if queue_size < 1:
+            raise ValueError("queue_size must be positive.")
+        self.name = name
+        self.stages = stages
+        self.queue_size = queue_size
+        # source の読み出しも1つの stage として計測する
+        self.source_stats = StageStats("source", 1)
+        self.stats = [StageStats(s.name, s.concurrency) for s in stages]
+        self._error: BaseException | None = None
+        self._error_lock = threading.Lock()
+
+    def _set_error(self, e: BaseException) -> None:
+        with self._error_lock:
+            if self._error is None:
+                self._error = e
+
+    def run(self, source: Iterable[Any]) -> list[Any]:
+        # stage i の入力キュー。最後のキューが結果の出力先
+        queues: list[queue.Queue[Any]] = [
+            queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)
+        ]
+        results: dict[int, Any] = {}
+        remaining = [s.concurrency for s in self.stages]
+        remaining_lock = threading.Lock()
+
+        def worker(index: int) -> None:
+            stage = self.stages[index]
+            stats = self.stats[index]
+            in_q = queues[index]
+            out_q = queues[index + 1]
+            while True:
+                wait_start = time.monotonic()
+                item = in_q.get()
+                wait_input = time.monotonic() - wait_start
+                if item is _STOP:
+                    break
+                seq, payload = item
+                if self._error is not None:
+                    # 失敗した後は処理せずに読み捨てて、上流が止まらないようにする
+                    continue
+                busy_start = time.monotonic()
+                try:
+                    result = stage.func(payload)
+                except BaseException as e:
+                    logger.error(f"pipeline stage '{stage.name}' failed: {e}")
+                    self._set_error(e)
+                    continue
+                busy = time.monotonic() - busy_start
+                put_start = time.monotonic()
+                out_q.put((seq, result))
+                stats.add(busy, wait_input, time.monotonic() - put_start)
+
+            # 最後に終わった worker が下流に stop を伝える
+            with remaining_lock:
+                remaining[index] -= 1
+                last = remaining[index] == 0
+            if last:
+                stats.finished_at = time.monotonic()
+                downstream = (
+                    self.stages[index + 1].concurrency
+                    if index + 1 < len(self.stages)
+                    else 1
+                )
+                for _ in range(downstream):
+                    out_q.put(_STOP)
+
+        def collector() -> None:
+            out_q = queues[-1]
+            while True:
+                item = out_q.get()
+                if item is _STOP:
+                    break
+                seq, payload = item
+                results[seq] = payload
+
+        threads: list[threading.Thread] = []
+        for index, stage in enumerate(self.stages):
+            self.stats[index].started_at = time.monotonic()
+            for n in range(stage.concurrency):
+                threads.append(
+                    threading.Thread(
+                        target=worker,
+                        args=(index,),
+                        name=f"{self.name or 'pipeline'}_{stage.name}_{n}",
+                        daemon=True,
+                    )
+                )
+        collector_thread = threading.Thread(
+            target=collector, name=f"{self.name or 'pipeline'}_collector", daemon=True
+        )
+        for t in threads:
+            t.start()
+        collector_thread.start()
+
+        # source の読み出し (この thread で行う)
+        self.source_stats.started_at = time.monotonic()
+        count = 0
+        try:
+            iterator = iter(source)
+            while self._error is None:
+                busy_start = time.monotonic()
+                try:
+                    payload = next(iterator)
+                except StopIteration:
+                    break
+                busy = time.monotonic() - busy_start
+                put_start = time.monotonic()
+                queues[0].put((count, payload))
+                self.source_stats.add(busy, 0.0, time.monotonic() - put_start)
+                count += 1
+        except BaseException as e:
+            logger.error(f"pipeline source failed: {e}")
+            self._set_error(e)
+        finally:
+            self.source_stats.finished_at = time.monotonic()
+            for _ in range(self.stages[0].concurrency):
+                queues[0].put(_STOP)
+            for t in threads:
+                t.join()
+            collector_thread.join()
+
+        self.log_stats()
+        if self._error is not None:
+            raise self._error
+        return [results[seq] for seq in range(count)]
+
+    def log_stats(self) -> None:
+        logger.info(f"pipeline {self.name} stats:")
+        for stats in [self.source_stats, *self.stats]:
+            logger.info(stats.summary())
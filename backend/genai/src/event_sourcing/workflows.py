@@ -9,9 +9,11 @@
 # * Firestore -> LLM
 #
 # GCSのバケット以下のフォルダを定義する:
-# * rss (raw): lastBuildDateと検索キーワードを末尾に含めたファイル (更新される可能性がないので、削除しない)     : /rss/{lastBuildDate}_{keyword}.xml
-# * oai_pmh (raw): 1書籍ごとのデータ (更新されている可能性があるので、古いものから除去して良い)                : /oai_pmh/{book_id}.xml
+# * rss (raw): lastBuildDateと検索キーワードを末尾に含めたファイル (gc_cacheで、フィードごとに1日の最新のものだけを残す) : /rss/{lastBuildDate}_{keyword}.xml
+# * oai_pmh (raw): 1書籍ごとのデータ (identifierごとに1つのファイルを上書きするので、削除しない)                : /oai_pmh/{book_id}.xml
 # * combined masterdata (edited): rssとoai_pmhを結合して、ラジオ番組作成が可能な形式に変換したファイル      : /combined_masterdata/{lastBuildDate}_{keyword}.json
+#   (published の日付ごとに分割し、日付と書籍数の索引を置く                                          : /masterdata/{lastBuildDate}/{YYYYMMDD}.ndjson, _index.json)
+#   (作成途中のチェックポイント、断片、公開の marker は gc_cache で一定日数後に削除する : /masterdata/_checkpoint, _shards, _publish)
 # * radio audio data (edited): ラジオ番組の音声データ                                               : /radio_audio_data/{lastBuildDate}_{keyword}.mp3
 # * radio script data (edited): ラジオ番組の音声データに対応するスクリプトデータ                        : /radio_script_data/{lastBuildDate}_{keyword}.json
 #
@@ -21,36 +23,115 @@
 # ラジオ番組(スクリプト)を作成すれば、音声データを作成できる
 
 
+import asyncio
 import io
 import json
-import time
-from datetime import UTC, datetime
+import os
+import threading
+from collections.abc import Generator, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 from typing import Any
 
 import feedparser  # type: ignore
 from pydantic import BaseModel, RootModel
 
+from src.async_task.dispatcher import TaskDispatcher
+from src.blob import async_storage
 from src.blob.storage import (
     ISBN_DIR,
     JP_E_CODE_DIR,
-    XML_LATEST_ALL_DIR_BASE,
-    get_closest_cached_oai_pmh_file,
+    MASTERDATA_CHECKPOINT_DIR,
+    MASTERDATA_INDEX_FILE_NAME,
+    MASTERDATA_PUBLISH_DIR,
+    MASTERDATA_PUBLISH_RETENTION_DAYS,
+    MASTERDATA_SHARD_DIR,
+    MASTERDATA_WORK_RETENTION_DAYS,
+    RSS_RAW_DIR,
+    BatchUploader,
+    CacheGcResult,
+    OaiPmhCacheIndex,
+    claim_masterdata_publish,
+    complete_masterdata_publish,
+    content_digest,
+    delete_masterdata_checkpoint,
+    delete_masterdata_shards,
+    gc_cache_blobs,
+    gc_llm_response_cache,
+    gc_masterdata_work_blobs,
+    get_cached_oai_pmh_file_with_index,
     get_closest_cached_rss_file,
     get_json_file,
-    put_combined_json_file,
+    get_masterdata_checkpoint_segments,
+    get_masterdata_shard,
+    get_oai_pmh_harvest_state,
+    get_rss_validators,
+    get_rss_xml_file,
+    get_rss_xml_file_by_signature,
+    iter_cached_ndjson_file,
+    masterdata_partition_path,
+    oai_pmh_json_write,
+    put_blob_write,
+    put_masterdata_checkpoint_cursor,
+    put_masterdata_checkpoint_segment,
+    put_masterdata_index,
+    put_masterdata_shard,
+    put_oai_pmh_harvest_state,
     put_oai_pmh_json,
     put_rss_xml_file,
     put_tts_audio_file,
     put_tts_script_file,
+    release_masterdata_publish,
+    rss_cache_key,
+)
+from src.book.book import JPRO_REPOSITORY, latest_all, thumbnail
+from src.book.feed import (
+    FeedEntry,
+    RssFetchResult,
+    RssStreamParser,
+    convert_to_entry_item,
+    fetch_rss_conditional,
+    iter_rss_entries,
+    parse_rss,
+    stream_rss,
+)
+from src.book.oai_pmh import (
+    IDENTIFIER_TYPE_ISBN,
+    HarvestedRecord,
+    get_metadata_by_isbn,
+    get_metadata_by_jp_e_code,
+    list_record_pages,
 )
-from src.book.book import latest_all, thumbnail
-from src.book.feed import convert_to_entry_item, fetch_rss, parse_rss
-from src.book.oai_pmh import get_metadata_by_isbn, get_metadata_by_jp_e_code
 from src.event_sourcing.entity import radio_show as entity_radio_show
+from src.event_sourcing.pipeline import Pipeline, Stage
 from src.llm import agent, ng_word
 from src.logger import logger
 from src.tts import google as tts_google
-from src.utils import JST, get_now
+from src.utils import JST, TokenBucket, get_now
+
+# 書誌情報取得の並列数と、NDLへのリクエストのレート制限 (件/秒)
+FETCH_MAX_WORKERS = int(os.getenv("FETCH_MAX_WORKERS", "8"))
+FETCH_RATE_PER_SEC = float(os.getenv("FETCH_RATE_PER_SEC", "10"))
+# 書誌情報取得パイプラインの stage ごとの並列数 (未指定なら FETCH_MAX_WORKERS) と stage 間のキューの長さ
+FETCH_EXTRACT_WORKERS = int(os.getenv("FETCH_EXTRACT_WORKERS", "1"))
+FETCH_PROBE_WORKERS = int(os.getenv("FETCH_PROBE_WORKERS", str(FETCH_MAX_WORKERS)))
+FETCH_REMOTE_WORKERS = int(os.getenv("FETCH_REMOTE_WORKERS", str(FETCH_MAX_WORKERS)))
+FETCH_WRITE_WORKERS = int(os.getenv("FETCH_WRITE_WORKERS", str(FETCH_MAX_WORKERS)))
+FETCH_QUEUE_SIZE = int(os.getenv("FETCH_QUEUE_SIZE", "64"))
+# 作成途中の masterdata をチェックポイントとして保存する間隔 (書籍数)
+FETCH_CHECKPOINT_INTERVAL = int(os.getenv("FETCH_CHECKPOINT_INTERVAL", "50"))
+# latest_all を分割して実行する場合の、分割した書誌情報取得と結合の /async_task の kind
+KIND_LATEST_ALL_SHARD = "latest_all_shard"
+KIND_LATEST_ALL_MERGE = "latest_all_merge"
+# 結合タスクが断片の揃うのを待つ間隔 (秒) と最大回数
+MERGE_SHARDS_RETRY_SECONDS = 30
+MERGE_SHARDS_MAX_ATTEMPTS = 60
+# RSS を受信しながらパースするか
+RSS_STREAMING = os.getenv("RSS_STREAMING", "false") == "true"
+# キャッシュから streaming でパースする場合の読み出し単位
+RSS_STREAM_CHUNK_SIZE = 64 * 1024
+# high-water mark がない初回の harvest で遡る日数
+HARVEST_INITIAL_DAYS = 7
 
 
 class MstBook(BaseModel):
@@ -64,6 +145,16 @@ class MstBook(BaseModel):
     metadata: dict[str, Any] = {}
 
 
+class OaiPmhHarvestState(BaseModel):
+    repository: str
+    # ここまでの datestamp の更新は全てキャッシュ済み
+    high_water_mark: datetime | None = None
+    # harvest 途中で中断した場合の再開位置
+    from_date: datetime | None = None
+    until_date: datetime | None = None
+    resumption_token: str | None = None
+
+
 class MstBooks(RootModel[dict[str, MstBook]]):
     def __getitem__(self, key: str) -> MstBook:
         return self.root[key]
@@ -75,27 +166,319 @@ class MstBooks(RootModel[dict[str, MstBook]]):
         return len(self.root)
 
 
-def exec_fetch_rss_and_oai_pmh_workflow(
-    target_url: str,
-    prefix_dir: str,
-    suffix_dir: str,
-    broadcasted_at: datetime | None = None,
-) -> None:
-    """RSS、API系をcallしてGCSにキャッシュ、ラジオ番組作成が可能な最終1ファイルをGCSにアップロードする。ラジオ番組が作成開始される。"""
-    logger.info("start exec_run_agent_and_tts_workflow ...")
-    logger.info(
-        f"target_url: {target_url}, prefix_dir: {prefix_dir}, suffix_dir: {suffix_dir}, broadcasted_at: {broadcasted_at}"
+class MstBookRecord(BaseModel):
+    """NDJSON 形式の masterdata の1行。date (JST の published の日付) を先頭に置くので、
+    行全体をパースしなくても日付で絞り込める。"""
+
+    date: str
+    book: MstBook
+
+
+# NDJSON の各行の先頭。この後ろの10文字が date (YYYY-MM-DD)
+_MST_BOOK_RECORD_PREFIX = b'{"date":"'
+
+
+def to_masterdata_ndjson_line(book: MstBook) -> str:
+    """書籍を NDJSON 形式の masterdata の1行にする"""
+    record = MstBookRecord(
+        date=book.published.astimezone(JST).strftime("%Y-%m-%d"), book=book
     )
-    if target_url == "":
-        raise ValueError("target_url is empty.")
-    if prefix_dir == "" or suffix_dir == "":
-        raise ValueError("prefix_dir or suffix_dir is empty.")
-    if broadcasted_at is not None:
-        # must timezone-aware
-        if broadcasted_at.tzinfo is None:
-            raise ValueError("broadcasted_at must be timezone-aware.")
+    return record.model_dump_json()
 
-    utcnow = get_now()
+
+class MasterdataIndex(BaseModel):
+    """日付ごとに分割した masterdata の索引。dates は JST の published の日付 (YYYYMMDD) ごとの書籍数"""
+
+    signature: str
+    dates: dict[str, int] = {}
+
+    def count(self, target_date: date) -> int:
+        return self.dates.get(target_date.strftime("%Y%m%d"), 0)
+
+
+def partition_masterdata_lines(mst_map: dict[str, MstBook]) -> dict[str, list[str]]:
+    """mst_map を published (JST) の日付 (YYYYMMDD) ごとの NDJSON の行に分ける。
+    日付ごとの行の順序は mst_map のまま。"""
+    partitions: dict[str, list[str]] = {}
+    for book in mst_map.values():
+        day = book.published.astimezone(JST).strftime("%Y%m%d")
+        partitions.setdefault(day, []).append(to_masterdata_ndjson_line(book))
+    return partitions
+
+
+def iter_masterdata_books_for_date(
+    lines: Iterable[bytes], target_date: date
+) -> Iterator[MstBook]:
+    """NDJSON 形式の masterdata の行から、published (JST) が target_date の書籍だけを返す。
+    日付は行の先頭だけで判定し、対象日の行だけ MstBook として検証する。"""
+    target = target_date.strftime("%Y-%m-%d").encode("ascii")
+    prefix_len = len(_MST_BOOK_RECORD_PREFIX)
+    for line in lines:
+        if line.startswith(_MST_BOOK_RECORD_PREFIX):
+            record_date = line[prefix_len : prefix_len + len(target)]
+        else:
+            # キーの順序が異なる行は、パースして日付を取り出す
+            record_date = str(json.loads(line).get("date", "")).encode("ascii")
+        if record_date != target:
+            continue
+        yield MstBookRecord.model_validate_json(line).book
+
+
+def _rss_signature(last_build_date: datetime) -> str:
+    """RSS の更新日時から masterdata の signature を作る"""
+    return last_build_date.astimezone(JST).strftime("%Y%m%d_%H%M%S_0900")
+
+
+class MasterdataCheckpoint:
+    """
+    作成途中の masterdata のチェックポイント。rss_sig ごとに GCS に保存する。
+    fetch workflow が途中で止まっても、次回は保存済みの書籍を飛ばして残りだけを取得する。
+    rss_sig は RSS の更新日時が分かった時点で load で決める (streaming の場合は item より後になることがある)。
+    更新日時より先に item を受け取った場合は、load_fallback で fallback_sig (リクエストの日付から作ったもの) を使う。
+    保存では前回の保存から増えた書籍だけを segment としてアップロードし、segment の数 (カーソル) を更新する。
+    書籍の一覧を写し取るのは lock の中、シリアライズとアップロードは lock の外で行う。
+    """
+
+    def __init__(
+        self,
+        interval: int = FETCH_CHECKPOINT_INTERVAL,
+        fallback_sig: str | None = None,
+    ):
+        if interval < 1:
+            raise ValueError("interval must be positive.")
+        self.interval = interval
+        self.fallback_sig = fallback_sig
+        self.rss_sig: str | None = None
+        # keyはlink。チェックポイントから復元したものと、まだ保存していないもの
+        self._restored: dict[str, MstBook] = {}
+        self._pending: dict[str, MstBook] = {}
+        # 保存済みの segment の数。次の segment の番号になる
+        self._segments = 0
+        self._lock = threading.Lock()
+        # segment の番号とカーソルを順に進めるため、アップロードを1つずつにする
+        self._save_lock = threading.Lock()
+
+    def load(self, rss_sig: str) -> int:
+        """rss_sig を決めて、保存済みのチェックポイントがあれば読み込む。読み込んだ書籍数を返す。"""
+        with self._lock:
+            return self._load_locked(rss_sig)
+
+    def load_fallback(self) -> int:
+        """RSS の更新日時より先に item を受け取った場合に、fallback_sig でチェックポイントを読み込む"""
+        with self._lock:
+            if self.rss_sig is not None:
+                return len(self._restored)
+            if self.fallback_sig is None:
+                logger.warning(
+                    "RSS の更新日時より先に item を受け取りました。チェックポイントは保存しません"
+                )
+                return 0
+            logger.warning(
+                f"RSS の更新日時より先に item を受け取りました。チェックポイントは {self.fallback_sig} に保存します"
+            )
+            return self._load_locked(self.fallback_sig)
+
+    def _load_locked(self, rss_sig: str) -> int:
+        if self.rss_sig is not None:
+            return len(self._restored)
+        self.rss_sig = rss_sig
+        segments = get_masterdata_checkpoint_segments(self.rss_sig)
+        restored: dict[str, MstBook] = {}
+        for segment in segments:
+            restored.update(MstBooks.model_validate_json(segment).root)
+        self._restored = restored
+        # 続きの segment から保存する
+        self._segments = len(segments)
+        if len(segments) > 0:
+            logger.info(
+                f"masterdata checkpoint から {len(restored)} 件を復元しました: {self.rss_sig}"
+            )
+        return len(restored)
+
+    def restored(self, link: str) -> MstBook | None:
+        """チェックポイントから復元した書籍があれば返す"""
+        return self._restored.get(link)
+
+    def add(self, book: MstBook) -> MstBook:
+        """作成した書籍を記録し、interval 件ごとにチェックポイントを保存する"""
+        with self._lock:
+            self._pending[book.link] = book
+            should_save = len(self._pending) >= self.interval
+        if should_save:
+            self.save()
+        return book
+
+    def save(self) -> None:
+        with self._lock:
+            if self.rss_sig is None or len(self._pending) == 0:
+                return
+            rss_sig = self.rss_sig
+            books, self._pending = self._pending, {}
+        try:
+            with self._save_lock:
+                segment = self._segments
+                put_masterdata_checkpoint_segment(
+                    rss_sig, segment, MstBooks(books).model_dump_json()
+                )
+                # カーソルを更新するまでは、この segment は読まれない (次の保存で上書きする)
+                put_masterdata_checkpoint_cursor(rss_sig, segment + 1)
+                self._segments = segment + 1
+        except Exception:
+            # 保存できなかった分は次の保存に回す
+            with self._lock:
+                self._pending = books | self._pending
+            raise
+        logger.info(
+            f"masterdata checkpoint を保存しました: {rss_sig}, segment {segment}, {len(books)} 件"
+        )
+
+    def delete(self) -> None:
+        """masterdata のアップロードが完了したら不要になるので削除する"""
+        if self.rss_sig is not None:
+            delete_masterdata_checkpoint(self.rss_sig)
+
+
+class FetchPipelineConfig(BaseModel):
+    """書誌情報取得パイプラインの stage ごとの並列数と、stage 間のキューの長さ"""
+
+    extract_workers: int = FETCH_EXTRACT_WORKERS
+    probe_workers: int = FETCH_PROBE_WORKERS
+    fetch_workers: int = FETCH_REMOTE_WORKERS
+    write_workers: int = FETCH_WRITE_WORKERS
+    assemble_workers: int = 1
+    queue_size: int = FETCH_QUEUE_SIZE
+    checkpoint_interval: int = FETCH_CHECKPOINT_INTERVAL
+
+
+class _BookFetchJob:
+    """パイプラインの stage 間で受け渡す1書籍分の作業状態"""
+
+    def __init__(self, item: FeedEntry):
+        self.item = item
+        self.prefix_dir = ""
+        self.identifier = ""
+        self.thumbnail_link = ""
+        self.metadata: dict[str, Any] = {}
+        # キャッシュにあった場合は True
+        self.cached = False
+        # NDL から取得した場合は True (キャッシュに書き込む)
+        self.fetched = False
+        # チェックポイントから復元した場合は、以降の stage を飛ばす
+        self.book: MstBook | None = None
+
+
+def _extract_stage(
+    entry: FeedEntry | feedparser.FeedParserDict,
+    checkpoint: MasterdataCheckpoint,
+    parser: RssStreamParser | None = None,
+) -> _BookFetchJob:
+    """feed の item から書誌情報の識別子を取り出す。チェックポイント済みの item は復元する"""
+    item = entry if isinstance(entry, FeedEntry) else convert_to_entry_item(entry)
+    logger.info(f"item: {item}")
+    job = _BookFetchJob(item)
+    if checkpoint.rss_sig is None and parser is not None:
+        # streaming の場合は更新日時を読み込んだ時点でチェックポイントを読み込む。
+        # 更新日時より先に item が来る feed では、実行ごとに同じになるように fallback_sig を使う
+        if parser.items_before_last_build_date:
+            checkpoint.load_fallback()
+        elif parser.last_build_date is not None:
+            checkpoint.load(_rss_signature(parser.last_build_date))
+    job.book = checkpoint.restored(item.link)
+    if job.book is not None:
+        logger.info(f"チェックポイントから復元しました: {item.link}")
+        return job
+    if item.isbn != "":
+        job.prefix_dir = ISBN_DIR
+        job.identifier = item.isbn
+    elif item.jp_e_code != "":
+        job.prefix_dir = JP_E_CODE_DIR
+        job.identifier = item.jp_e_code
+    else:
+        logger.error(f"isbn または jp_e_code が取得できませんでした。: {item}")
+        return job
+    job.thumbnail_link = thumbnail(job.identifier)
+    return job
+
+
+def _probe_stage(job: _BookFetchJob, cache_index: OaiPmhCacheIndex) -> _BookFetchJob:
+    """キャッシュにあれば書誌情報を読み出す"""
+    if job.identifier == "" or job.book is not None:
+        return job
+    cached_metadata = get_cached_oai_pmh_file_with_index(
+        cache_index, job.identifier, job.prefix_dir
+    )
+    if cached_metadata is not None:
+        job.metadata = json.loads(cached_metadata.read().decode("utf-8"))
+        job.cached = True
+        logger.info(f"キャッシュから{job.prefix_dir} metadataを取得しました。")
+    return job
+
+
+def _fetch_stage(job: _BookFetchJob, rate_limiter: TokenBucket) -> _BookFetchJob:
+    """キャッシュになければ NDL から取得する"""
+    if job.identifier == "" or job.cached or job.book is not None:
+        return job
+    rate_limiter.acquire()
+    if job.prefix_dir == ISBN_DIR:
+        job.metadata = get_metadata_by_isbn(job.identifier)
+    else:
+        job.metadata = get_metadata_by_jp_e_code(job.identifier)
+    job.fetched = True
+    return job
+
+
+def _write_stage(
+    job: _BookFetchJob, cache_index: OaiPmhCacheIndex, uploader: BatchUploader
+) -> _BookFetchJob:
+    """NDL から取得した書誌情報のキャッシュを、アップロードのキューに積む"""
+    if not job.fetched:
+        return job
+    # 保存時に圧縮するので、空白のない compact な JSON にする
+    metadata_json_str = json.dumps(
+        job.metadata, ensure_ascii=False, separators=(",", ":")
+    )
+    # 期限切れで取得し直しても内容が同じなら、アップロードせずに確認日時だけ更新する
+    if cache_index.refresh_if_unchanged(
+        job.prefix_dir, job.identifier, content_digest(metadata_json_str)
+    ):
+        logger.info(
+            f"{job.prefix_dir} metadata に変更がないのでキャッシュを延長しました"
+        )
+        return job
+    # アップロードはバックグラウンドで行い、完了したら索引に記録する (masterdata の作成を待たせない)
+    prefix_dir, identifier = job.prefix_dir, job.identifier
+    uploader.submit(
+        oai_pmh_json_write(identifier, prefix_dir, metadata_json_str),
+        on_uploaded=lambda blob: cache_index.record(prefix_dir, identifier, blob),
+    )
+    return job
+
+
+def _assemble_stage(
+    job: _BookFetchJob, utcnow: datetime, checkpoint: MasterdataCheckpoint
+) -> MstBook:
+    """MstBook を組み立ててチェックポイントに記録する"""
+    if job.book is not None:
+        return job.book
+    item = job.item
+    book = MstBook(
+        title=item.title,
+        summary=item.summary,
+        isbn=item.isbn,
+        jp_e_code=item.jp_e_code,
+        link=item.link,
+        thumbnail_link=job.thumbnail_link,
+        published=item.published or utcnow,
+        metadata=job.metadata,
+    )
+    return checkpoint.add(book)
+
+
+def _load_feed_entries(
+    target_url: str, prefix_dir: str, suffix_dir: str, utcnow: datetime
+) -> tuple[list[feedparser.FeedParserDict], datetime]:
+    """RSS をキャッシュ (なければ NDL) から取得してパースし、feed の順序の entry と更新日時 (JST) を返す。
+    FeedEntry への変換はパイプラインの extract stage で行う。"""
     try:
         cached_xml = get_closest_cached_rss_file(utcnow, prefix_dir, suffix_dir)
     except ValueError as e:
@@ -103,12 +486,30 @@ def exec_fetch_rss_and_oai_pmh_workflow(
         cached_xml = None
 
     logger.info(f"start fetch_rss: {target_url}")
+    fetched: RssFetchResult | None = None
+    if cached_xml is None:
+        # 前回取得時の validator があれば条件付きリクエストにして、304 なら前回のキャッシュを使う
+        validators = get_rss_validators(prefix_dir, suffix_dir)
+        if validators is None:
+            fetched = fetch_rss_conditional(url=target_url)
+        else:
+            fetched = fetch_rss_conditional(
+                url=target_url,
+                etag=validators.etag,
+                last_modified=validators.last_modified,
+            )
+            if fetched.not_modified:
+                cached_xml = get_rss_xml_file(validators.blob_name)
+                if cached_xml is None:
+                    # キャッシュが消えていた場合は改めて取得する
+                    fetched = fetch_rss_conditional(url=target_url)
+
     feed: feedparser.FeedParserDict
     if cached_xml is None:
         # キャッシュが見つからなかった場合は、リクエストを送信する
-        raw_xml: str = fetch_rss(url=target_url)
-        if raw_xml == "":
+        if fetched is None or fetched.raw_xml == "":
             raise ValueError("RSS フィードの取得に失敗しました。")
+        raw_xml: str = fetched.raw_xml
         feed, last_build_date = parse_rss(raw_xml)
         if last_build_date is None:
             raise ValueError("RSS フィードの更新日時が取得できませんでした。")
@@ -117,13 +518,16 @@ def exec_fetch_rss_and_oai_pmh_workflow(
         last_build_date = last_build_date.astimezone(JST)
         # cache upload
         bs_xml = io.BytesIO(raw_xml.encode("utf-8"))
-        cached_url = put_rss_xml_file(
+        # 次回の条件付きリクエストのために validator も最新のキャッシュの pointer に記録する (読み出しと同じディレクトリに置く)
+        cached_blob = put_rss_xml_file(
             last_build_date=last_build_date,
-            prefix_dir=XML_LATEST_ALL_DIR_BASE,
+            prefix_dir=prefix_dir,
             file=bs_xml,
             suffix_dir=suffix_dir,
-        ).public_url
-        logger.info(f"RSSフィードを '{cached_url}' にキャッシュしました。")
+            etag=fetched.etag,
+            last_modified=fetched.last_modified,
+        )
+        logger.info(f"RSSフィードを '{cached_blob.public_url}' にキャッシュしました。")
     else:
         raw_xml = cached_xml.read().decode("utf-8")
         feed, last_build_date = parse_rss(raw_xml)
@@ -134,88 +538,635 @@ def exec_fetch_rss_and_oai_pmh_workflow(
         last_build_date = last_build_date.astimezone(JST)
         logger.info("キャッシュからRSSフィードを取得しました。")
 
-    # keyはlink
+    entries: list[feedparser.FeedParserDict] = [
+        entry
+        for entry in feed.get("entries", [])  # type: ignore
+        if entry is not None
+    ]
+    return entries, last_build_date
+
+
+def _stream_feed_entries(
+    target_url: str,
+    prefix_dir: str,
+    suffix_dir: str,
+    utcnow: datetime,
+    parser: RssStreamParser,
+) -> Generator[FeedEntry]:
+    """_load_feed_entries の streaming 版。RSS を受信しながらパースして、feed の順序で item を返す。
+    更新日時は parser.last_build_date に入る。NDL から取得した場合は、最後まで受信した後にキャッシュする。"""
+    try:
+        cached_xml = get_closest_cached_rss_file(utcnow, prefix_dir, suffix_dir)
+    except ValueError as e:
+        logger.error(f"RSS フィードのキャッシュ取得に失敗しました: {e}")
+        cached_xml = None
+
+    if cached_xml is None:
+        logger.info(f"start stream_rss: {target_url}")
+        # 前回取得時の validator があれば条件付きリクエストにして、304 なら前回のキャッシュを使う
+        validators = get_rss_validators(prefix_dir, suffix_dir)
+        for conditional in (validators is not None, False):
+            with stream_rss(
+                target_url,
+                etag=validators.etag if conditional and validators else None,
+                last_modified=validators.last_modified
+                if conditional and validators
+                else None,
+            ) as response:
+                if response.not_modified and validators is not None:
+                    cached_xml = get_rss_xml_file(validators.blob_name)
+                    if cached_xml is None:
+                        # キャッシュが消えていた場合は改めて取得する
+                        continue
+                    break
+
+                # キャッシュ用に生の XML だけは保持しておく
+                bs_xml = io.BytesIO()
+                for chunk in response.chunks:
+                    bs_xml.write(chunk)
+                    yield from parser.feed(chunk)
+                yield from parser.close()
+                if parser.last_build_date is None:
+                    raise ValueError("RSS フィードの更新日時が取得できませんでした。")
+
+                # cache upload
+                # 次回の条件付きリクエストのために validator も最新のキャッシュの pointer に記録する (読み出しと同じディレクトリに置く)
+                cached_blob = put_rss_xml_file(
+                    last_build_date=parser.last_build_date.astimezone(JST),
+                    prefix_dir=prefix_dir,
+                    file=bs_xml,
+                    suffix_dir=suffix_dir,
+                    etag=response.etag,
+                    last_modified=response.last_modified,
+                )
+                logger.info(
+                    f"RSSフィードを '{cached_blob.public_url}' にキャッシュしました。"
+                )
+                return
+
+    if cached_xml is None:
+        raise ValueError("RSS フィードの取得に失敗しました。")
+    logger.info("キャッシュからRSSフィードを取得しました。")
+    yield from iter_rss_entries(
+        iter(lambda: cached_xml.read(RSS_STREAM_CHUNK_SIZE), b""), parser
+    )
+
+
+def _resolve_pipeline_config(
+    max_workers: int | None, pipeline_config: FetchPipelineConfig | None
+) -> FetchPipelineConfig:
+    """max_workers を指定した場合は probe/fetch/write の並列数を上書きする"""
+    if max_workers is not None and max_workers < 1:
+        raise ValueError("max_workers must be positive.")
+    if pipeline_config is None:
+        pipeline_config = FetchPipelineConfig()
+    if max_workers is not None:
+        pipeline_config = pipeline_config.model_copy(
+            update={
+                "probe_workers": max_workers,
+                "fetch_workers": max_workers,
+                "write_workers": max_workers,
+            }
+        )
+    return pipeline_config
+
+
+def _run_fetch_pipeline(
+    entries: Iterable[FeedEntry | feedparser.FeedParserDict],
+    utcnow: datetime,
+    rate_per_sec: float,
+    pipeline_config: FetchPipelineConfig,
+    checkpoint: MasterdataCheckpoint,
+    parser: RssStreamParser | None = None,
+) -> dict[str, MstBook]:
+    """entries の書誌情報をパイプラインで取得し、feed の順序の mst_map (keyはlink) を返す。"""
+    # 最大1000件でアクセス集中するため、NDLへのリクエストはレート制限する
+    rate_limiter = TokenBucket(rate=rate_per_sec)
+    # キャッシュの有無はこの実行中は索引で判定し、索引の更新は最後にまとめて行う
+    cache_index = OaiPmhCacheIndex()
+    # キャッシュのアップロードはパイプラインとは別のスレッドで並行に行う
+    uploader = BatchUploader(
+        max_workers=pipeline_config.write_workers, upload=put_blob_write
+    )
+    logger.info(
+        f"start fetching metadata: {pipeline_config}, rate_per_sec: {rate_per_sec}"
+    )
+    pipeline = Pipeline(
+        [
+            Stage(
+                "extract",
+                lambda entry: _extract_stage(entry, checkpoint, parser),
+                pipeline_config.extract_workers,
+            ),
+            Stage(
+                "probe",
+                lambda job: _probe_stage(job, cache_index),
+                pipeline_config.probe_workers,
+            ),
+            Stage(
+                "fetch",
+                lambda job: _fetch_stage(job, rate_limiter),
+                pipeline_config.fetch_workers,
+            ),
+            Stage(
+                "write",
+                lambda job: _write_stage(job, cache_index, uploader),
+                pipeline_config.write_workers,
+            ),
+            Stage(
+                "assemble",
+                lambda job: _assemble_stage(job, utcnow, checkpoint),
+                pipeline_config.assemble_workers,
+            ),
+        ],
+        queue_size=pipeline_config.queue_size,
+        name="fetch_metadata",
+    )
+    # 結果は feed から読み出した順に返るので、mst_map の順序は feed の順序のまま決定的になる
+    try:
+        books: list[MstBook] = pipeline.run(entries)
+    except Exception:
+        # 次回の実行で残りだけを取得できるように、ここまでの結果を保存しておく
+        checkpoint.save()
+        raise
+    finally:
+        # キャッシュのアップロードの完了を待つ。失敗したものは次回取得し直すだけなので、失敗にはしない
+        uploader.join()
+    logger.info(f"fetched metadata: {len(books)} items")
+    # 索引の更新をまとめて反映する
+    cache_index.flush()
+    return {book.link: book for book in books}
+
+
+async def _put_masterdata_partitions(
+    rss_sig: str, partitions: dict[str, list[str]]
+) -> None:
+    """日付ごとの masterdata を並行にアップロードする"""
+    await asyncio.gather(
+        *(
+            async_storage.put_masterdata_partition(rss_sig, day, lines)
+            for day, lines in sorted(partitions.items())
+        )
+    )
+
+
+def _publish_key(broadcasted_at: datetime | None) -> str:
+    """同じ masterdata から同じ放送日時の番組を1回だけ作るための、marker のキー"""
+    if broadcasted_at is None:
+        return "none"
+    return broadcasted_at.astimezone(JST).strftime("%Y%m%d_%H%M%S")
+
+
+def _put_masterdata_and_create_radio_show(
+    rss_sig: str, mst_map: dict[str, MstBook], broadcasted_at: datetime | None
+) -> bool:
+    """masterdata をアップロードしてラジオ番組の作成を開始する。
+    タスクが重複して配信されても1回だけ行う。既に公開済みか、別のタスクが公開中の場合は何もせずに False を返す。"""
+    publish_key = _publish_key(broadcasted_at)
+    generation = claim_masterdata_publish(rss_sig, publish_key)
+    if generation is None:
+        logger.info(f"masterdata の公開を省略します: {rss_sig}, {publish_key}")
+        return False
+    try:
+        # 作成したcombined masterdataをGCSにアップロードする
+        # 番組作成時に対象日の書籍だけを取得できるように、published の日付ごとに分けた NDJSON にする
+        partitions = partition_masterdata_lines(mst_map)
+        asyncio.run(_put_masterdata_partitions(rss_sig, partitions))
+        # 索引は全ての日付をアップロードした後に置く (索引があれば masterdata は揃っている)
+        index = MasterdataIndex(
+            signature=rss_sig,
+            dates={day: len(lines) for day, lines in sorted(partitions.items())},
+        )
+        result_blob = put_masterdata_index(rss_sig, index.model_dump_json())
+        if result_blob is None:
+            raise ValueError("combined masterdata がアップロードできませんでした。")
+        logger.info(
+            f"combined masterdata を '{result_blob.name}' にアップロードしました。dates: {index.dates}"
+        )
+
+        # Firestore recordをここで creating で作成する
+        creating = entity_radio_show.new(result_blob.name, broadcasted_at)
+        logger.info(f"[COMMAND] radio_show.new creating: {creating}")
+    except Exception:
+        # 再配信で公開し直せるようにする
+        release_masterdata_publish(rss_sig, publish_key, generation)
+        raise
+    complete_masterdata_publish(rss_sig, publish_key, generation)
+
+    # 後続処理はeventarcが行う
+    return True
+
+
+def exec_fetch_rss_and_oai_pmh_workflow(
+    target_url: str,
+    prefix_dir: str,
+    suffix_dir: str,
+    broadcasted_at: datetime | None = None,
+    max_workers: int | None = None,
+    rate_per_sec: float = FETCH_RATE_PER_SEC,
+    streaming: bool = RSS_STREAMING,
+    pipeline_config: FetchPipelineConfig | None = None,
+) -> None:
+    """RSS、API系をcallしてGCSにキャッシュ、ラジオ番組作成が可能な最終1ファイルをGCSにアップロードする。ラジオ番組が作成開始される。
+
+    書誌情報は次の stage を有界キューで繋いだパイプラインで取得する。
+    feed のパース -> 識別子の取り出し (extract) -> キャッシュ確認 (probe) -> NDLへのリクエスト (fetch)
+    -> キャッシュのアップロード (write) -> MstBook の組み立て (assemble)
+    stage ごとの並列数は pipeline_config で指定する (max_workers を指定した場合は probe/fetch/write の並列数を上書きする)。
+    NDLへのリクエストは rate_per_sec 件/秒に制限する。
+    streaming の場合は RSS を受信しながらパースし、受信中の item から書誌情報の取得を始める。"""
+    logger.info("start exec_run_agent_and_tts_workflow ...")
+    logger.info(
+        f"target_url: {target_url}, prefix_dir: {prefix_dir}, suffix_dir: {suffix_dir}, broadcasted_at: {broadcasted_at}"
+    )
+    if target_url == "":
+        raise ValueError("target_url is empty.")
+    if prefix_dir == "" or suffix_dir == "":
+        raise ValueError("prefix_dir or suffix_dir is empty.")
+    if broadcasted_at is not None:
+        # must timezone-aware
+        if broadcasted_at.tzinfo is None:
+            raise ValueError("broadcasted_at must be timezone-aware.")
+    if rate_per_sec <= 0:
+        raise ValueError("rate_per_sec must be positive.")
+    pipeline_config = _resolve_pipeline_config(max_workers, pipeline_config)
+
+    utcnow = get_now()
+    # 前回の実行が途中で止まっていれば、チェックポイント済みの書籍は取得し直さない
+    # streaming で更新日時より先に item を受け取った場合は、リクエストの日付のチェックポイントを使う
+    checkpoint = MasterdataCheckpoint(
+        pipeline_config.checkpoint_interval,
+        fallback_sig=f"{prefix_dir}_{suffix_dir}_{utcnow.astimezone(JST):%Y%m%d}",
+    )
+    parser: RssStreamParser | None = None
+    entries: Iterable[FeedEntry | feedparser.FeedParserDict]
+    stream: Generator[FeedEntry] | None = None
+    last_build_date: datetime | None = None
+    if streaming:
+        # 受信しながらパースし、item が閉じたところから書誌情報の取得を始める
+        parser = RssStreamParser()
+        stream = _stream_feed_entries(
+            target_url, prefix_dir, suffix_dir, utcnow, parser
+        )
+        entries = stream
+    else:
+        entries, last_build_date = _load_feed_entries(
+            target_url, prefix_dir, suffix_dir, utcnow
+        )
+        checkpoint.load(_rss_signature(last_build_date))
+
+    try:
+        # keyはlink
+        mst_map = _run_fetch_pipeline(
+            entries, utcnow, rate_per_sec, pipeline_config, checkpoint, parser
+        )
+    finally:
+        if stream is not None:
+            # パイプラインが途中で失敗して読み切らなかった場合も、受信中の RSS の応答を閉じる
+            stream.close()
+
+    if parser is not None:
+        last_build_date = parser.last_build_date
+    if last_build_date is None:
+        raise ValueError("RSS フィードの更新日時が取得できませんでした。")
+
+    # ここで、entryMapを使って、combined masterdataを作成する
+    rss_sig = _rss_signature(last_build_date)
+    _put_masterdata_and_create_radio_show(rss_sig, mst_map, broadcasted_at)
+    # masterdata が完成したのでチェックポイントは不要
+    checkpoint.delete()
+
+    return
+
+
+class FetchShardTask(BaseModel):
+    """分割した書誌情報取得の1タスク分のデータ。/async_task の data としてそのまま送る。
+    Cloud Tasks の body の上限を超えないように item 自体は送らず、キャッシュした RSS の
+    item の範囲 [start, end) だけを送る。"""
+
+    rss_sig: str
+    prefix_dir: str
+    suffix_dir: str
+    shard: int
+    shards: int
+    start: int
+    end: int
+
+
+class MergeShardsTask(BaseModel):
+    """分割した masterdata を結合するタスクのデータ。/async_task の data としてそのまま送る"""
+
+    rss_sig: str
+    shards: int
+    broadcasted_at: datetime | None = None
+    # 断片が揃うまで再投入した回数
+    attempt: int = 0
+
+
+def split_into_shards(count: int, shards: int) -> list[tuple[int, int]]:
+    """feed の順序を保ったまま、count 件の item を件数がほぼ均等な shards 個の連続した区間 [start, end) に分ける"""
+    if shards < 1:
+        raise ValueError("shards must be positive.")
+    size, rest = divmod(count, shards)
+    result: list[tuple[int, int]] = []
+    start = 0
+    for i in range(shards):
+        end = start + size + (1 if i < rest else 0)
+        result.append((start, end))
+        start = end
+    return result
+
+
+def exec_fan_out_fetch_workflow(
+    target_url: str,
+    prefix_dir: str,
+    suffix_dir: str,
+    shards: int,
+    dispatcher: TaskDispatcher,
+    broadcasted_at: datetime | None = None,
+    merge_delay_seconds: int = MERGE_SHARDS_RETRY_SECONDS,
+) -> str:
+    """exec_fetch_rss_and_oai_pmh_workflow の fan-out 版。
+    RSS を取得して item を shards 個に分け、shard ごとの書誌情報取得タスク (KIND_LATEST_ALL_SHARD) と、
+    断片を結合して masterdata を作成するタスク (KIND_LATEST_ALL_MERGE) を dispatcher に投入する。
+
+    戻り値は rss_sig。"""
+    logger.info("start exec_fan_out_fetch_workflow ...")
+    if target_url == "":
+        raise ValueError("target_url is empty.")
+    if prefix_dir == "" or suffix_dir == "":
+        raise ValueError("prefix_dir or suffix_dir is empty.")
+    if shards < 1:
+        raise ValueError("shards must be positive.")
+    if broadcasted_at is not None and broadcasted_at.tzinfo is None:
+        raise ValueError("broadcasted_at must be timezone-aware.")
+
+    utcnow = get_now()
+    raw_entries, last_build_date = _load_feed_entries(
+        target_url, prefix_dir, suffix_dir, utcnow
+    )
+    rss_sig = _rss_signature(last_build_date)
+
+    # 各 shard は同じ RSS をキャッシュから読み直して、自分の範囲の item だけを取得する
+    for shard, (start, end) in enumerate(split_into_shards(len(raw_entries), shards)):
+        task = FetchShardTask(
+            rss_sig=rss_sig,
+            prefix_dir=prefix_dir,
+            suffix_dir=suffix_dir,
+            shard=shard,
+            shards=shards,
+            start=start,
+            end=end,
+        )
+        dispatcher.dispatch(KIND_LATEST_ALL_SHARD, task.model_dump(mode="json"))
+        logger.info(f"dispatched shard {shard}/{shards}: {end - start} items")
+    # 断片が揃っていなければ merge タスクは自身を再投入して待つ
+    merge = MergeShardsTask(
+        rss_sig=rss_sig, shards=shards, broadcasted_at=broadcasted_at
+    )
+    dispatcher.dispatch(
+        KIND_LATEST_ALL_MERGE,
+        merge.model_dump(mode="json"),
+        scheduled_seconds_from_now=merge_delay_seconds,
+    )
+    logger.info(f"dispatched merge task: {rss_sig}")
+    return rss_sig
+
+
+def exec_fetch_shard_workflow(
+    task: FetchShardTask,
+    rate_per_sec: float = FETCH_RATE_PER_SEC,
+    pipeline_config: FetchPipelineConfig | None = None,
+) -> None:
+    """分割された item の書誌情報を取得し、masterdata の断片としてアップロードする。
+    shard のタスクは並行に実行されるので、NDLへのリクエストは shard ごとに rate_per_sec / shards 件/秒に制限する。"""
+    logger.info(
+        f"start exec_fetch_shard_workflow: {task.rss_sig} {task.shard}/{task.shards}"
+    )
+    if task.shards < 1 or not (0 <= task.shard < task.shards):
+        raise ValueError(f"invalid shard: {task.shard}/{task.shards}")
+    if rate_per_sec <= 0:
+        raise ValueError("rate_per_sec must be positive.")
+    pipeline_config = _resolve_pipeline_config(None, pipeline_config)
+
+    if not (0 <= task.start <= task.end):
+        raise ValueError(f"invalid range: [{task.start}, {task.end})")
+
+    # fan-out 時にキャッシュした RSS を読む (NDL には取りに行かない)
+    cached_xml = get_rss_xml_file_by_signature(
+        task.rss_sig, task.prefix_dir, task.suffix_dir
+    )
+    if cached_xml is None:
+        raise ValueError(f"キャッシュした RSS フィードがありません: {task.rss_sig}")
+    feed, _ = parse_rss(cached_xml.read().decode("utf-8"))
+    raw_entries = [
+        entry
+        for entry in feed.get("entries", [])  # type: ignore
+        if entry is not None
+    ]
+    entries = [
+        convert_to_entry_item(entry) for entry in raw_entries[task.start : task.end]
+    ]
+
+    # shard も途中で止まった場合に残りだけを取得できるように、shard ごとにチェックポイントを取る
+    checkpoint = MasterdataCheckpoint(pipeline_config.checkpoint_interval)
+    checkpoint.load(f"{task.rss_sig}_shard{task.shard}")
+    mst_map = _run_fetch_pipeline(
+        entries,
+        get_now(),
+        rate_per_sec / task.shards,
+        pipeline_config,
+        checkpoint,
+    )
+    put_masterdata_shard(task.rss_sig, task.shard, MstBooks(mst_map).model_dump_json())
+    checkpoint.delete()
+    logger.info(f"finished shard {task.shard}/{task.shards}: {len(mst_map)} items")
+
+
+def exec_merge_shards_workflow(
+    task: MergeShardsTask,
+    dispatcher: TaskDispatcher,
+    retry_seconds: int = MERGE_SHARDS_RETRY_SECONDS,
+    max_attempts: int = MERGE_SHARDS_MAX_ATTEMPTS,
+) -> bool:
+    """masterdata の断片が揃っていれば shard の順に結合してアップロードし、ラジオ番組の作成を開始する。
+    揃っていなければ retry_seconds 後に自身を再投入し、max_attempts 回で諦める (例外にはしない)。
+    結合して公開した場合は True を返す。"""
+    logger.info(f"start exec_merge_shards_workflow: {task}")
+    if task.shards < 1:
+        raise ValueError("shards must be positive.")
+
     mst_map: dict[str, MstBook] = {}
-    for entry in feed.get("entries", []):  # type: ignore
-        if entry is None:
+    missing: list[int] = []
+    for shard in range(task.shards):
+        shard_json = get_masterdata_shard(task.rss_sig, shard)
+        if shard_json is None:
+            missing.append(shard)
             continue
+        mst_map.update(MstBooks.model_validate_json(shard_json).root)
 
-        item = convert_to_entry_item(entry)
-        logger.info(f"item: {item}")
-
-        # oai_pmh から書誌情報を取得する
-        metadata: dict[str, Any] = {}
-        thumbnail_link: str = ""
-        if item.isbn != "":
-            thumbnail_link = thumbnail(item.isbn)
-            cached_metadata = get_closest_cached_oai_pmh_file(item.isbn, ISBN_DIR)
-            if cached_metadata is None:
-                metadata = get_metadata_by_isbn(item.isbn)
-                # cacheする
-                metadata_json_str = json.dumps(metadata, ensure_ascii=False, indent=2)
-                cashed_url = put_oai_pmh_json(
-                    item.isbn,
-                    ISBN_DIR,
-                    metadata_json_str,
-                ).public_url
-                logger.info(f"isbn metadata を {cashed_url} にキャッシュしました")
-            else:
-                metadata = json.loads(cached_metadata.read().decode("utf-8"))
-                logger.info("キャッシュからisbn metadataを取得しました。")
-        elif item.jp_e_code != "":
-            thumbnail_link = thumbnail(item.jp_e_code)
-            cached_metadata = get_closest_cached_oai_pmh_file(
-                item.jp_e_code, JP_E_CODE_DIR
+    if len(missing) > 0:
+        if task.attempt + 1 >= max_attempts:
+            # 例外にすると Cloud Tasks が再配信し続けるので、ログに残して終える (残った断片は gc_cache で削除する)
+            logger.error(
+                f"masterdata の断片が揃いませんでした: {task.rss_sig}, missing: {missing}"
             )
-            if cached_metadata is None:
-                metadata = get_metadata_by_jp_e_code(item.jp_e_code)
-                # cacheする
-                metadata_json_str = json.dumps(metadata, ensure_ascii=False, indent=2)
-                cached_url = put_oai_pmh_json(
-                    item.jp_e_code,
-                    JP_E_CODE_DIR,
-                    metadata_json_str,
-                ).public_url
-                logger.info(f"jp_e_code metadata {cached_url} にキャッシュしました")
-            else:
-                metadata = json.loads(cached_metadata.read().decode("utf-8"))
-                logger.info("キャッシュからjp_e_code metadataを取得しました。")
-        else:
-            logger.error(f"isbn または jp_e_code が取得できませんでした。: {item}")
-
-        # mapに格納
-        mst_map[item.link] = MstBook(
-            title=item.title,
-            summary=item.summary,
-            isbn=item.isbn,
-            jp_e_code=item.jp_e_code,
-            link=item.link,
-            thumbnail_link=thumbnail_link,
-            published=item.published or utcnow,
-            metadata=metadata,
+            return False
+        logger.info(
+            f"masterdata の断片を待っています: {task.rss_sig}, missing: {missing}"
+        )
+        retry = task.model_copy(update={"attempt": task.attempt + 1})
+        dispatcher.dispatch(
+            KIND_LATEST_ALL_MERGE,
+            retry.model_dump(mode="json"),
+            scheduled_seconds_from_now=retry_seconds,
         )
+        return False
 
-        # 最大1000件でアクセス集中するため一定時間待つ
-        time.sleep(0.1)
+    # merge タスクが重複して配信されても、masterdata の公開とラジオ番組の作成は1回だけ行う
+    published = _put_masterdata_and_create_radio_show(
+        task.rss_sig, mst_map, task.broadcasted_at
+    )
+    delete_masterdata_shards(task.rss_sig, task.shards)
+    return published
 
-    # ここで、entryMapを使って、combined masterdataを作成する
-    rss_sig = last_build_date.strftime("%Y%m%d_%H%M%S_0900")
-    # 作成したcombined masterdataをGCSにアップロードする
-    # entityMapをまずはそのままjsonにしてみる
-    mst_books = MstBooks(mst_map)
-    mst_books_json_str = mst_books.model_dump_json(indent=2)
-    result_blob = put_combined_json_file(rss_sig, mst_books_json_str)
-    logger.info(f"combined masterdata を '{result_blob.name}' にアップロードしました。")
-    if result_blob is None:
-        raise ValueError("combined masterdata がアップロードできませんでした。")
-
-    # Firestore recordをここで creating で作成する
-    creating = entity_radio_show.new(result_blob.name, broadcasted_at)
-    logger.info(f"[COMMAND] radio_show.new creating: {creating}")
 
-    # 後続処理はeventarcが行う
+def exec_harvest_oai_pmh_workflow(
+    until_date: datetime | None = None,
+    repository: str = JPRO_REPOSITORY,
+    max_workers: int = FETCH_MAX_WORKERS,
+) -> int:
+    """OAI-PMH の ListRecords で repository (JPRO) の更新分をまとめて取得し、
+    GetRecord と同じキャッシュ (private/oai_pmh/{isbn|jp_e_code}) に書き込む。
+    前回の high-water mark から until_date までを取得し、完了したら high-water mark を進める。
+    ページごとに resumptionToken を保存するので、途中で中断しても次回はそのページから再開する。
 
-    return
+    戻り値はキャッシュした書誌情報の件数。"""
+    logger.info("start exec_harvest_oai_pmh_workflow ...")
+    if until_date is None:
+        until_date = get_now()
+    if until_date.tzinfo is None:
+        raise ValueError("until_date must be timezone-aware.")
+    if max_workers < 1:
+        raise ValueError("max_workers must be positive.")
+
+    state_json = get_oai_pmh_harvest_state(repository)
+    if state_json is None:
+        state = OaiPmhHarvestState(repository=repository)
+    else:
+        state = OaiPmhHarvestState.model_validate_json(state_json)
+    logger.info(f"harvest state: {state}")
+
+    resumption_token: str | None = None
+    if state.resumption_token and state.from_date and state.until_date:
+        # 中断した harvest を同じ期間で再開する
+        from_date = state.from_date
+        until_date = state.until_date
+        resumption_token = state.resumption_token
+        logger.info(f"resume harvest from resumptionToken: {resumption_token}")
+    elif state.high_water_mark is not None:
+        from_date = state.high_water_mark
+    else:
+        from_date = until_date - timedelta(days=HARVEST_INITIAL_DAYS)
+
+    if from_date >= until_date:
+        logger.info(f"nothing to harvest: from {from_date} until {until_date}")
+        return 0
+    logger.info(f"harvest {repository} from {from_date} until {until_date}")
+
+    count = 0
+    cache_index = OaiPmhCacheIndex()
+    with ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix="harvest_oai_pmh"
+    ) as executor:
+        for page in list_record_pages(
+            from_date, until_date, repository, resumption_token
+        ):
+            records = [r for r in page.records if not r.deleted]
+            # ページ内のキャッシュ書き込みが全て終わってから再開位置を進める
+            for _ in executor.map(
+                lambda r: _put_harvested_record(r, cache_index), records
+            ):
+                count += 1
+            cache_index.flush()
+            state = OaiPmhHarvestState(
+                repository=repository,
+                high_water_mark=state.high_water_mark,
+                from_date=from_date,
+                until_date=until_date,
+                resumption_token=page.next_resumption_token,
+            )
+            put_oai_pmh_harvest_state(repository, state.model_dump_json())
+            logger.info(f"harvested {count} records ...")
+
+    # 完了したので high-water mark を進める
+    state = OaiPmhHarvestState(repository=repository, high_water_mark=until_date)
+    put_oai_pmh_harvest_state(repository, state.model_dump_json())
+    logger.info(f"finished harvesting {count} records until {until_date}")
+    return count
+
+
+def _put_harvested_record(
+    record: HarvestedRecord, cache_index: OaiPmhCacheIndex
+) -> None:
+    prefix_dir = (
+        ISBN_DIR if record.identifier_type == IDENTIFIER_TYPE_ISBN else JP_E_CODE_DIR
+    )
+    metadata_json_str = json.dumps(
+        record.metadata, ensure_ascii=False, separators=(",", ":")
+    )
+    if cache_index.refresh_if_unchanged(
+        prefix_dir, record.identifier, content_digest(metadata_json_str)
+    ):
+        return
+    blob = put_oai_pmh_json(record.identifier, prefix_dir, metadata_json_str)
+    cache_index.record(prefix_dir, record.identifier, blob)
+
+
+def exec_gc_cache_workflow(dry_run: bool = False) -> list[CacheGcResult]:
+    """private/rss と private/llm_cache の古いキャッシュと、masterdata の作成途中のファイルを削除する。
+    RSS は日ごとに最も新しいものだけを残す。pointer など "_" で始まるものは削除しない。
+    OAI-PMH は identifier ごとに1つのファイルを上書きするので、削除するものがなく対象にしない。
+    LLM の応答は有効日数を過ぎたものと、合計サイズの上限を超えた古いものを削除する。
+    masterdata のチェックポイントと断片は、失敗したか放棄された実行で残ったものを、
+    signature ごとに一定日数更新がなければ削除する。公開の marker は重複したタスクが届かなくなるまで残す。
+    dry_run の場合は削除せずに件数だけ数える。"""
+    logger.info(f"start exec_gc_cache_workflow ... dry_run: {dry_run}")
+    results = [
+        gc_cache_blobs(RSS_RAW_DIR, rss_cache_key, dry_run=dry_run),
+        gc_llm_response_cache(dry_run=dry_run),
+        gc_masterdata_work_blobs(
+            MASTERDATA_CHECKPOINT_DIR, MASTERDATA_WORK_RETENTION_DAYS, dry_run=dry_run
+        ),
+        gc_masterdata_work_blobs(
+            MASTERDATA_SHARD_DIR, MASTERDATA_WORK_RETENTION_DAYS, dry_run=dry_run
+        ),
+        gc_masterdata_work_blobs(
+            MASTERDATA_PUBLISH_DIR, MASTERDATA_PUBLISH_RETENTION_DAYS, dry_run=dry_run
+        ),
+    ]
+    logger.info(
+        f"cache gc finished: deleted {sum(r.deleted for r in results)} objects, "
+        f"reclaimed {sum(r.reclaimed_bytes for r in results)} bytes"
+    )
+    return results
+
+
+def _load_masterdata_for_date(
+    index_blob_path: str, target_date: date
+) -> dict[str, MstBook]:
+    """日付ごとに分割した masterdata の索引を読み、target_date (JST) の書籍だけを取得する"""
+    index = MasterdataIndex.model_validate_json(get_json_file(index_blob_path))
+    if index.count(target_date) == 0:
+        # 対象日の書籍がなければ masterdata 自体は取得しない
+        logger.info(f"{target_date} の書籍は masterdata にありません: {index.dates}")
+        return {}
+    lines = iter_cached_ndjson_file(
+        masterdata_partition_path(index.signature, target_date.strftime("%Y%m%d"))
+    )
+    return {
+        book.link: book for book in iter_masterdata_books_for_date(lines, target_date)
+    }
 
 
 def exec_run_agent_and_tts_workflow(
@@ -234,24 +1185,37 @@ def exec_run_agent_and_tts_workflow(
         if exec_date.tzinfo is None:
             raise ValueError("broadcasted_at must be timezone-aware.")
 
-    # load masterdata
-    try:
-        mst_json = get_json_file(masterdata_blob_path)
-        mst_books_loaded = MstBooks.model_validate_json(mst_json)
-        logger.info("Success to load masterdata json.")
-    except Exception as e:
-        logger.error(f"masterdata の読み込みに失敗しました: {e}")
-        raise e
-
     # 以降はJSTでの処理
     exec_date_jst = datetime.now(JST)
     if exec_date is not None:
         # 実行対象の日時を上書き
         exec_date_jst = exec_date.astimezone(JST)
-    mst_map = mst_books_loaded.root
-    past, current, future = split_books(mst_map, exec_date_jst)
-    logger.info("Success to split books.")
-    logger.info(f"past: {len(past)}, current: {len(current)}, future: {len(future)}")
+
+    # load masterdata
+    current: dict[str, MstBook] = {}
+    try:
+        if masterdata_blob_path.endswith(f"/{MASTERDATA_INDEX_FILE_NAME}"):
+            # 索引から対象日の masterdata だけを取得する
+            current = _load_masterdata_for_date(
+                masterdata_blob_path, exec_date_jst.date()
+            )
+            logger.info(
+                f"Success to load masterdata partition. current: {len(current)}"
+            )
+        else:
+            # 以前の JSON 形式の masterdata
+            mst_json = get_json_file(masterdata_blob_path)
+            mst_books_loaded = MstBooks.model_validate_json(mst_json)
+            logger.info("Success to load masterdata json.")
+            mst_map = mst_books_loaded.root
+            past, current, future = split_books(mst_map, exec_date_jst)
+            logger.info("Success to split books.")
+            logger.info(
+                f"past: {len(past)}, current: {len(current)}, future: {len(future)}"
+            )
+    except Exception as e:
+        logger.error(f"masterdata の読み込みに失敗しました: {e}")
+        raise e
 
     if len(current) == 0:
         logger.error(f"{exec_date} に放送可能な書籍がありませんでした。")
@@ -280,7 +1244,16 @@ def exec_run_agent_and_tts_workflow(
 
     # agent: llm -> script
     logger.info("start agent call ...")
-    result = agent.call_agent_with_dataset(llm_context)
+    audio_content: bytes | None = None
+    result: str | None = None
+    if agent.LLM_STREAMING:
+        # 台本を受け取りながら、文ごとに読み上げる
+        result, audio_content = _stream_script_and_synthesize(llm_context)
+        if agent.extract_script_block(result) is None:
+            logger.warning("streaming response has no script. retry without streaming.")
+            result, audio_content = None, None
+    if result is None:
+        result = agent.call_agent_with_dataset(llm_context)
     logger.info(f"agent call result: {result}")
     # parse script
     script = agent.extract_script_block(result)
@@ -293,11 +1266,15 @@ def exec_run_agent_and_tts_workflow(
     script_public_url = script_blob.public_url
 
     # start: script -> audio
-    recorded = tts_google.synthesize(script)
-    if recorded is None:
+    if audio_content is None:
+        recorded = tts_google.synthesize(script)
+        if recorded is None:
+            raise ValueError("recorded が取得できませんでした。")
+        audio_content = recorded.audio_content
+    if not audio_content:
         raise ValueError("recorded が取得できませんでした。")
 
-    bs = io.BytesIO(recorded.audio_content)
+    bs = io.BytesIO(audio_content)
     audio_blob = put_tts_audio_file(radio_show_id, bs)
     audio_public_url = audio_blob.public_url
 
@@ -312,6 +1289,22 @@ def exec_run_agent_and_tts_workflow(
     return
 
 
+def _stream_script_and_synthesize(llm_context: str) -> tuple[str, bytes]:
+    """LLM の応答を受け取りながら台本の文ごとに読み上げを始め、応答全体と文の順につなげた音声を返す。
+    LLM と読み上げが重なるので、かかる時間は両者の合計ではなく、おおよそ長い方になる。"""
+    chunks: list[str] = []
+
+    def collect() -> Iterator[str]:
+        for chunk in agent.stream_script_with_dataset(llm_context):
+            chunks.append(chunk)
+            yield chunk
+
+    audio_content = tts_google.synthesize_sentences(
+        agent.iter_script_sentences(collect())
+    )
+    return "".join(chunks), audio_content
+
+
 def convert_to_book_prompt(mst_book: MstBook, number: int) -> str:
     """MstBookをLLMに渡すだけの情報にする"""
     # linkはいらない
@@ -0,0 +1,114 @@
+# 外部 (NDL, Eventarc エミュレータ) への HTTP 通信で共有する httpx.Client のレジストリ
+#
+# * 接続先ホストごとに1つの httpx.Client を作り、keep-alive で TCP/TLS の接続を使い回す
+# * ホストごとに同時接続数を制限する
+# * HTTP2_ENABLED を true にし、h2 (httpx[http2]) を別途インストールした場合だけ HTTP/2 を使う。既定は HTTP/1.1
+# * FastAPI の lifespan で open_registry / close_registry する。
+#   lifespan の外 (CLI、テスト) から呼ばれた場合は、最初の get_client で作成する
+
+import importlib.util
+import os
+import threading
+from urllib.parse import urlsplit
+
+import httpx
+
+from src.logger import logger
+
+# ホストごとの同時接続数の上限
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "16"))
+# 使い回すために保持しておく接続数と、その保持期間 (秒)
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "16"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+# 呼び出し側で指定しない場合のタイムアウト (秒)
+HTTP_DEFAULT_TIMEOUT = float(os.getenv("HTTP_DEFAULT_TIMEOUT", "60"))
+# HTTP/2 を使うか。h2 は依存関係に含めていないので、true にしてもインストールされていなければ HTTP/1.1 を使う
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false") == "true"
+if HTTP2_ENABLED and importlib.util.find_spec("h2") is None:
+    logger.warning("HTTP2_ENABLED is true but h2 is not installed. use HTTP/1.1.")
+    HTTP2_ENABLED = False
+
+
+class HttpClientRegistry:
+    """接続先ホスト (scheme://host:port) ごとに httpx.Client を保持する。複数スレッドから使える。"""
+
+    def __init__(
+        self,
+        max_connections_per_host: int = HTTP_MAX_CONNECTIONS_PER_HOST,
+        max_keepalive_connections: int = HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry: float = HTTP_KEEPALIVE_EXPIRY,
+        timeout: float = HTTP_DEFAULT_TIMEOUT,
+        http2: bool = HTTP2_ENABLED,
+    ):
+        if max_connections_per_host < 1:
+            raise ValueError("max_connections_per_host must be positive.")
+        self.limits = httpx.Limits(
+            max_connections=max_connections_per_host,
+            max_keepalive_connections=min(
+                max_keepalive_connections, max_connections_per_host
+            ),
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = timeout
+        self.http2 = http2
+        self._clients: dict[str, httpx.Client] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @staticmethod
+    def _host_key(url: str) -> str:
+        parts = urlsplit(url)
+        if parts.scheme == "" or parts.netloc == "":
+            raise ValueError(f"invalid url: {url}")
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def get(self, url: str) -> httpx.Client:
+        """url の接続先ホスト用の httpx.Client を返す。なければ作成する。"""
+        key = self._host_key(url)
+        with self._lock:
+            if self._closed:
+                raise ValueError("http client registry is already closed.")
+            client = self._clients.get(key)
+            if client is None:
+                client = httpx.Client(
+                    limits=self.limits, timeout=self.timeout, http2=self.http2
+                )
+                self._clients[key] = client
+                logger.info(f"created http client for {key} (http2: {self.http2})")
+            return client
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+        logger.info(f"closed {len(clients)} http clients")
+
+
+_registry: HttpClientRegistry | None = None
+_registry_lock = threading.Lock()
+
+
+def open_registry() -> HttpClientRegistry:
+    """アプリケーション全体で共有するレジストリを作成する。作成済みならそれを返す。"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = HttpClientRegistry()
+        return _registry
+
+
+def close_registry() -> None:
+    """共有しているレジストリの接続を全て閉じる。"""
+    global _registry
+    with _registry_lock:
+        registry, _registry = _registry, None
+    if registry is not None:
+        registry.close()
+
+
+def get_client(url: str) -> httpx.Client:
+    """url の接続先ホスト用に共有している httpx.Client を返す。"""
+    return open_registry().get(url)
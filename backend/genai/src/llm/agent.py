@@ -1,11 +1,20 @@
+import hashlib
+import json
 import os
 import re
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Any
 
 import litellm
 import tenacity
 import weave
 from lmnr import Laminar as L  # type: ignore
 from lmnr import observe  # type: ignore
+from pydantic import BaseModel
 from smolagents import LiteLLMModel, ToolCallingAgent  # type: ignore
 from tenacity import (
     retry,
@@ -14,7 +23,8 @@ from tenacity import (
     wait_exponential,
 )
 
-from src.llm.config import INSTRUCTION_PROMPT
+from src.blob.storage import get_llm_response, put_llm_response
+from src.llm.config import DIRECT_INSTRUCTION_PROMPT, INSTRUCTION_PROMPT
 from src.logger import logger
 
 # 必要に応じて最小文字数（またはトークン数）の閾値を設定
@@ -37,70 +47,561 @@ safety_settings = [
 
 # 正規表現パターン
 SCRIPT_PATTERN = re.compile(r"<script\b[^>]*>(.*?)</script>", re.DOTALL)
+SCRIPT_OPEN_PATTERN = re.compile(r"<script\b[^>]*>")
+SCRIPT_CLOSE_TAG = "</script>"
+# 読み上げの文の区切り
+SENTENCE_END_PATTERN = re.compile(r"[。！？!?\n]+")
+# 短い文は次の文とまとめて読み上げに渡す (読み上げの呼び出し回数を減らし、抑揚を保つ)
+SENTENCE_MIN_CHARS = 40
 
-if os.getenv("CI") == "true":
-    # CI 環境では weave と Laminar を初期化しない
-    # LiteLLM のデバッグログを有効化
-    # litellm._turn_on_debug()
-    pass
-else:
-    weave.init(project_name=os.getenv("WEAVE_PROJECT_NAME", ""))
-    L.initialize(project_api_key=os.getenv("LMNR_PROJECT_API_KEY"))
+# 使い回すために保持しておく agent の数 (同時に番組を作成する数の目安)
+LLM_AGENT_POOL_SIZE = int(os.getenv("LLM_AGENT_POOL_SIZE", "4"))
+# 再試行のたびに temperature に加える値
+TEMPERATURE_STEP = 0.03
 
+# LLM の呼び出し方。"agent" は smolagents の ToolCallingAgent、
+# "direct" は litellm の completion を1回だけ呼ぶ (agent の複数回の往復を省く。レイテンシとトークン数の比較用)
+LLM_MODE = os.getenv("LLM_MODE", "agent")
+LLM_MODES = ("agent", "direct")
 
-class TemperatureHolder:
-    def __init__(self, temperature: float):
-        self.temperature = temperature
+# 並行に生成する台本の候補の数。1 なら並行には生成せず、不合格なら待ってから順に再試行する
+LLM_HEDGE_CANDIDATES = int(os.getenv("LLM_HEDGE_CANDIDATES", "1"))
+# 並行に生成する場合に、1回の台本の作成で LLM を呼ぶ回数の上限 (コストの上限)
+LLM_HEDGE_MAX_CALLS = int(os.getenv("LLM_HEDGE_MAX_CALLS", "6"))
+# プロセス全体で同時に実行する hedge (他の候補と並行に始める候補) の上限。番組の作成が重なっても LLM への負荷を抑える
+LLM_HEDGE_MAX_CONCURRENCY = int(os.getenv("LLM_HEDGE_MAX_CONCURRENCY", "4"))
+# 不合格の候補が出た後、次の候補を始めるまで待つ秒数。不合格が続くたびに倍にする
+LLM_HEDGE_BACKOFF_SECONDS = float(os.getenv("LLM_HEDGE_BACKOFF_SECONDS", "1"))
 
+# 応答を少しずつ受け取り、台本を文ごとに読み上げに渡す (true / false)
+LLM_STREAMING = os.getenv("LLM_STREAMING", "false") == "true"
 
-temp_holder = TemperatureHolder(INITIAL_TEMPERATURE)
+# 同じ入力 (モデル、指示、dataset、temperature) の応答を保存しておき、LLM を呼ばずに返す
+LLM_RESPONSE_CACHE_ENABLED = os.getenv("LLM_RESPONSE_CACHE_ENABLED", "true") == "true"
+
+_tracing_initialized = False
+_tracing_lock = threading.Lock()
+
+
+def init_tracing() -> None:
+    """weave と Laminar を初期化する。初期化済みなら何もしない。
+    import 時ではなく、lifespan の開始時 (または最初の agent の呼び出し時) に行う。"""
+    global _tracing_initialized
+    with _tracing_lock:
+        if _tracing_initialized:
+            return
+        _tracing_initialized = True
+        if os.getenv("CI") == "true":
+            # CI 環境では weave と Laminar を初期化しない
+            # LiteLLM のデバッグログを有効化
+            # litellm._turn_on_debug()
+            return
+        weave.init(project_name=os.getenv("WEAVE_PROJECT_NAME", ""))
+        L.initialize(project_api_key=os.getenv("LMNR_PROJECT_API_KEY"))
+
+
+class SamplingParams(BaseModel):
+    """1回の番組作成で使うサンプリングのパラメータ。再試行ではこの値だけを変える"""
+
+    temperature: float = INITIAL_TEMPERATURE
+
+
+class AgentPool:
+    """
+    ToolCallingAgent (と LiteLLMModel) を作成済みのまま保持し、番組の作成ごとに貸し出す。複数スレッドから使える。
+    agent は実行中の記録 (memory) を持つので、1つの agent は同時に1つの番組の作成だけが使う。
+    空きがなければ新しく作成し、返却されたものは max_idle 個まで保持する。
+    """
+
+    def __init__(self, max_idle: int = LLM_AGENT_POOL_SIZE):
+        if max_idle < 0:
+            raise ValueError("max_idle must not be negative.")
+        self.max_idle = max_idle
+        self._idle: list[ToolCallingAgent] = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @staticmethod
+    def _build() -> ToolCallingAgent:
+        # use smolagents as llm agent
+        # see: https://cloud.google.com/vertex-ai/generative-ai/docs/learn/models#gemini-models
+        model = LiteLLMModel(
+            MODEL_ID,
+            temperature=INITIAL_TEMPERATURE,
+            config={"safety_settings": safety_settings},
+        )
+        return ToolCallingAgent(
+            tools=[],
+            model=model,
+            prompt_templates={
+                "system_prompt": INSTRUCTION_PROMPT,
+            },
+            max_steps=5,
+        )
+
+    def warm_up(self) -> None:
+        """max_idle 個まで agent を作成しておく。作成中に close された場合は保持しない"""
+        built = [self._build() for _ in range(self.max_idle - len(self._idle))]
+        with self._lock:
+            if self._closed:
+                return
+            self._idle.extend(built[: self.max_idle - len(self._idle)])
+        logger.info(f"llm agent pool is ready: {len(self._idle)} agents")
+
+    @contextmanager
+    def acquire(self, sampling: SamplingParams) -> Iterator[ToolCallingAgent]:
+        """sampling を設定した agent を貸し出す。with を抜けると返却される"""
+        with self._lock:
+            if self._closed:
+                raise ValueError("llm agent pool is already closed.")
+            agent = self._idle.pop() if self._idle else None
+        if agent is None:
+            agent = self._build()
+        # 貸し出している間はこのリクエストだけが使うので、model の設定を書き換えてよい
+        agent.model.kwargs["temperature"] = sampling.temperature
+        try:
+            yield agent
+        finally:
+            with self._lock:
+                if not self._closed and len(self._idle) < self.max_idle:
+                    self._idle.append(agent)
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            self._idle.clear()
+
+
+_pool: AgentPool | None = None
+_pool_lock = threading.Lock()
+
+
+def open_pool() -> AgentPool:
+    """アプリケーション全体で共有するプールを作成する。作成済みならそれを返す。"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = AgentPool()
+        return _pool
+
+
+def close_pool() -> None:
+    """共有しているプールを破棄する。"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
 
 
 def adjust_temperature(retry_state: tenacity.RetryCallState) -> None:
-    """リトライ前に微調整するコールバック"""
-    temp_holder.temperature += 0.03
+    """リトライ前に、そのリクエストの temperature だけを微調整するコールバック"""
+    sampling: SamplingParams = retry_state.kwargs["sampling"]
+    sampling.temperature += TEMPERATURE_STEP
     logger.info(
-        f"retry count: {retry_state.attempt_number}, updated temperature: {temp_holder.temperature}"
+        f"retry count: {retry_state.attempt_number}, updated temperature: {sampling.temperature}"
+    )
+
+
+def _completion_messages(dataset: str) -> list[dict[str, str]]:
+    """direct 用の指示と dataset を、1回の completion 用の messages にする"""
+    return [
+        {"role": "system", "content": DIRECT_INSTRUCTION_PROMPT},
+        {"role": "user", "content": "### dataset: \n" + dataset},
+    ]
+
+
+def _completion_kwargs(dataset: str, temperature: float) -> dict[str, Any]:
+    """litellm の completion の引数。agent (LiteLLMModel) と同じモデル、safety_settings にする"""
+    return {
+        "model": MODEL_ID,
+        "messages": _completion_messages(dataset),
+        "temperature": temperature,
+        "config": {"safety_settings": safety_settings},
+    }
+
+
+def _complete_with_agent(dataset: str, sampling: SamplingParams) -> str:
+    started = time.perf_counter()
+    with open_pool().acquire(sampling) as my_agent:
+        text = "### dataset: \n" + dataset
+        result = my_agent.run(task=text, stream=False)
+        tokens = my_agent.monitor.get_total_token_counts()
+    logger.info(
+        f"llm call (agent): {time.perf_counter() - started:.2f}s, "
+        f"input tokens: {tokens['input']}, output tokens: {tokens['output']}"
+    )
+    return result
+
+
+def _complete_direct(dataset: str, sampling: SamplingParams) -> str:
+    started = time.perf_counter()
+    response = litellm.completion(**_completion_kwargs(dataset, sampling.temperature))
+    logger.info(
+        f"llm call (direct): {time.perf_counter() - started:.2f}s, "
+        f"input tokens: {response.usage.prompt_tokens}, output tokens: {response.usage.completion_tokens}"
+    )
+    return response.choices[0].message.content or ""
+
+
+def _complete(dataset: str, sampling: SamplingParams) -> str:
+    if LLM_MODE == "direct":
+        return _complete_direct(dataset, sampling)
+    return _complete_with_agent(dataset, sampling)
+
+
+def _is_valid_response(result: str) -> bool:
+    """thinkタグもscriptタグもない応答は不合格"""
+    return not (
+        isinstance(result, str) and "<think>" not in result and "<script>" not in result
     )
 
 
-@observe(name="call_agent_with_dataset")
 @retry(
     retry=retry_if_exception_type(ValueError),
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=1, max=240),
     before_sleep=adjust_temperature,
 )
-def call_agent_with_dataset(dataset: str) -> str:
-    """あまりに短い応答が返ってきた場合は再試行する関数
-    リトライ設定は、最大3回、指数バックオフで最大240秒まで待機する。
+def _generate(dataset: str, *, sampling: SamplingParams) -> str:
+    result = _complete(dataset, sampling)
+
+    # thinkタグもscriptタグもない場合は再試行
+    if not _is_valid_response(result):
+        raise ValueError("No <think> or <script> tag found in the response.")
+
+    return result
+
+
+class HedgeStats:
+    """並行生成の計測値。最初の候補 (指定した temperature) 以外が採用された割合が、並行生成が役に立った割合。
+    採用されなかった呼び出しは、不合格だったもの (failed_calls) と、採用が決まった時点で実行中だったもの (wasted_calls) に分けて数える。
+    複数のスレッドから更新される。"""
+
+    def __init__(self):
+        self.requests = 0
+        # LLM を呼んだ回数 (採用されなかった候補を含む)
+        self.calls = 0
+        # 最初の候補が採用された回数と、それ以外の候補が採用された回数
+        self.wins_by_first = 0
+        self.wins_by_hedge = 0
+        # どの候補も合格しなかった回数
+        self.failures = 0
+        # 例外または tag がなく不合格だった呼び出しの数
+        self.failed_calls = 0
+        # 採用が決まった時点で実行中だった呼び出しの数。取り消せないので最後まで実行され、結果は捨てる
+        self.wasted_calls = 0
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        calls: int,
+        winner: int | None,
+        failed_calls: int = 0,
+        wasted_calls: int = 0,
+    ) -> None:
+        with self._lock:
+            self.requests += 1
+            self.calls += calls
+            self.failed_calls += failed_calls
+            self.wasted_calls += wasted_calls
+            if winner is None:
+                self.failures += 1
+            elif winner == 0:
+                self.wins_by_first += 1
+            else:
+                self.wins_by_hedge += 1
+
+    @property
+    def paid_off_ratio(self) -> float:
+        """並行生成が役に立った割合"""
+        return self.wins_by_hedge / self.requests if self.requests > 0 else 0.0
+
+    @property
+    def calls_per_request(self) -> float:
+        return self.calls / self.requests if self.requests > 0 else 0.0
+
+    @property
+    def wasted_ratio(self) -> float:
+        """LLM を呼んだうち、結果を捨てるだけになった呼び出しの割合"""
+        return self.wasted_calls / self.calls if self.calls > 0 else 0.0
+
+
+hedge_stats = HedgeStats()
+# 実行中の hedge の数をプロセス全体で LLM_HEDGE_MAX_CONCURRENCY までにする
+_hedge_slots = threading.BoundedSemaphore(max(1, LLM_HEDGE_MAX_CONCURRENCY))
+
+
+def _generate_hedged(dataset: str, temperature: float) -> str:
+    """
+    LLM_HEDGE_CANDIDATES 個の候補を temperature を少しずつ変えて並行に生成し、最初に合格したものを返す。
+    不合格の候補が出たら、LLM_HEDGE_BACKOFF_SECONDS (不合格が続くたびに倍) 待ってから、
+    LLM_HEDGE_MAX_CALLS 回まで次の候補 (さらに temperature を上げたもの) を始める。
+    他の候補の実行中に始める候補 (hedge) は、プロセス全体で LLM_HEDGE_MAX_CONCURRENCY 個までにする。
+    合格したら実行中の候補は待たずに返す。実行中の候補は取り消さない (LLM の呼び出しは中断できない) ので、
+    最後まで実行されて LLM の料金がかかり、結果は捨てられる。その数は hedge_stats.wasted_calls に記録する。
     """
-    # use smolagents as llm agent
-    # see: https://cloud.google.com/vertex-ai/generative-ai/docs/learn/models#gemini-models
-    model = LiteLLMModel(
-        MODEL_ID,
-        temperature=temp_holder.temperature,
-        config={"safety_settings": safety_settings},
+    candidates = max(1, min(LLM_HEDGE_CANDIDATES, LLM_HEDGE_MAX_CALLS))
+    executor = ThreadPoolExecutor(
+        max_workers=candidates, thread_name_prefix="llm_hedge"
     )
-    my_agent = ToolCallingAgent(
-        tools=[],
-        model=model,
-        prompt_templates={
-            "system_prompt": INSTRUCTION_PROMPT,
+    # 実行中の候補 -> 何番目の候補か
+    running: dict[Future[str], int] = {}
+    started = 0
+    failed = 0
+    winner: int | None = None
+    result = ""
+    last_error: Exception | None = None
+    # 次の候補を始めてよい時刻 (time.monotonic)
+    not_before = 0.0
+    slots = _hedge_slots
+
+    def start() -> bool:
+        """次の候補を始める。hedge の上限に達していて始められなければ False を返す"""
+        nonlocal started
+        hedge = len(running) > 0
+        if hedge and not slots.acquire(blocking=False):
+            return False
+        sampling = SamplingParams(temperature=temperature + TEMPERATURE_STEP * started)
+        future = executor.submit(_complete, dataset, sampling)
+        if hedge:
+            # 取り消されずに結果を捨てる場合も、実行が終わるまでは枠を使う
+            future.add_done_callback(lambda _: slots.release())
+        running[future] = started
+        started += 1
+        return True
+
+    def can_start() -> bool:
+        return (
+            winner is None
+            and len(running) < candidates
+            and started < LLM_HEDGE_MAX_CALLS
+        )
+
+    try:
+        start()
+        while can_start() and start():
+            pass
+        while winner is None and (running or started < LLM_HEDGE_MAX_CALLS):
+            delay = not_before - time.monotonic()
+            if running:
+                # backoff の間も、実行中の候補の結果は受け取る
+                done, _ = wait(
+                    running,
+                    timeout=delay if delay > 0 and can_start() else None,
+                    return_when=FIRST_COMPLETED,
+                )
+            else:
+                done = set()
+                if delay > 0:
+                    time.sleep(delay)
+            for future in done:
+                index = running.pop(future)
+                try:
+                    candidate = future.result()
+                except Exception as e:
+                    logger.warning(f"llm candidate {index} failed: {e}")
+                    last_error = e
+                    candidate = ""
+                if winner is None and _is_valid_response(candidate):
+                    winner, result = index, candidate
+                    continue
+                if candidate != "":
+                    logger.info(
+                        f"llm candidate {index} has no <think> or <script> tag."
+                    )
+                failed += 1
+                not_before = time.monotonic() + LLM_HEDGE_BACKOFF_SECONDS * 2 ** (
+                    failed - 1
+                )
+            if time.monotonic() >= not_before:
+                while can_start() and start():
+                    pass
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # 採用が決まった時点で実行中だった候補は、最後まで実行されて結果を捨てる
+    wasted = len(running)
+    hedge_stats.record(started, winner, failed, wasted)
+    logger.info(
+        f"llm hedge: {started} calls, winner: {winner}, failed: {failed}, wasted: {wasted}, "
+        f"paid off: {hedge_stats.wins_by_hedge}/{hedge_stats.requests} ({hedge_stats.paid_off_ratio:.2f}), "
+        f"calls per request: {hedge_stats.calls_per_request:.2f}, "
+        f"wasted ratio: {hedge_stats.wasted_ratio:.2f}"
+    )
+    if winner is None:
+        raise ValueError(
+            f"No <think> or <script> tag found in {started} candidates."
+        ) from last_error
+    return result
+
+
+def response_cache_key(
+    dataset: str, temperature: float, instruction_prompt: str | None = None
+) -> str:
+    """LLM の応答のキャッシュのキー。応答を変えうる入力 (モデル、指示、dataset、temperature) のハッシュ
+    instruction_prompt を省略した場合は LLM_MODE の指示を使う。"""
+    if instruction_prompt is None:
+        instruction_prompt = (
+            DIRECT_INSTRUCTION_PROMPT if LLM_MODE == "direct" else INSTRUCTION_PROMPT
+        )
+    payload = json.dumps(
+        {
+            "model_id": MODEL_ID,
+            "instruction_prompt": instruction_prompt,
+            "dataset": dataset,
+            "temperature": temperature,
         },
-        max_steps=5,
+        ensure_ascii=False,
+        sort_keys=True,
     )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
-    text = "### dataset: \n" + dataset
-    result = my_agent.run(task=text, stream=False)
 
-    # thinkタグもscriptタグもない場合は再試行
-    if isinstance(result, str) and "<think>" not in result and "<script>" not in result:
-        raise ValueError("No <think> or <script> tag found in the response.")
+def _get_cached_response(key: str) -> str | None:
+    try:
+        return get_llm_response(key)
+    except Exception:
+        # キャッシュが読めなくても LLM を呼べばよいので、失敗にはしない
+        logger.warning(f"failed to read cached llm response: {key}", exc_info=True)
+        return None
+
 
+def _put_cached_response(key: str, response: str) -> None:
+    try:
+        put_llm_response(key, response)
+    except Exception:
+        logger.warning(f"failed to cache llm response: {key}", exc_info=True)
+
+
+@observe(name="call_agent_with_dataset")
+def call_agent_with_dataset(
+    dataset: str, temperature: float = INITIAL_TEMPERATURE
+) -> str:
+    """あまりに短い応答が返ってきた場合は再試行する関数
+    リトライ設定は、最大3回、指数バックオフで最大240秒まで待機する。
+    LLM_MODE が agent の場合は agent を共有のプールから借り、direct の場合は completion を1回だけ呼ぶ。
+    LLM_HEDGE_CANDIDATES が 2 以上の場合は、待って再試行する代わりに複数の候補を並行に生成する。
+    temperature は呼び出しごとに指定でき、再試行ではその呼び出しの分だけを上げる。
+    同じ入力で <script> を含む応答を得たことがあれば、LLM を呼ばずにその応答を返す
+    (/add_radio_show の再配信や、LLM より後の処理で失敗した場合の再実行)。
+    """
+    if LLM_MODE not in LLM_MODES:
+        raise ValueError(f"LLM_MODE must be one of {LLM_MODES}: {LLM_MODE}")
+    key = (
+        response_cache_key(dataset, temperature) if LLM_RESPONSE_CACHE_ENABLED else None
+    )
+    if key is not None:
+        cached = _get_cached_response(key)
+        if cached is not None:
+            logger.info(f"llm response cache hit: {key}")
+            return cached
+
+    init_tracing()
+    if LLM_HEDGE_CANDIDATES > 1:
+        result = _generate_hedged(dataset, temperature)
+    else:
+        result = _generate(dataset, sampling=SamplingParams(temperature=temperature))
+    # 台本を取り出せる応答だけを保存する
+    if key is not None and extract_script_block(result) is not None:
+        _put_cached_response(key, result)
     return result
 
 
+def _stream_completion(dataset: str, temperature: float) -> Iterator[str]:
+    response = litellm.completion(
+        **_completion_kwargs(dataset, temperature), stream=True
+    )
+    for chunk in response:
+        content = chunk.choices[0].delta.content
+        if content:
+            yield content
+
+
+@observe(name="stream_script_with_dataset")
+def stream_script_with_dataset(
+    dataset: str, temperature: float = INITIAL_TEMPERATURE
+) -> Iterator[str]:
+    """
+    LLM の応答を受け取った分ずつ返す。再試行はしない (台本がなければ呼び出し側で call_agent_with_dataset に切り替える)。
+    同じ入力の応答がキャッシュにあれば、それを1つにまとめて返す。
+    最後まで読み出して <script> を含む応答だった場合はキャッシュに保存する。
+    """
+    key = (
+        response_cache_key(dataset, temperature, DIRECT_INSTRUCTION_PROMPT)
+        if LLM_RESPONSE_CACHE_ENABLED
+        else None
+    )
+    if key is not None:
+        cached = _get_cached_response(key)
+        if cached is not None:
+            logger.info(f"llm response cache hit: {key}")
+            yield cached
+            return
+
+    init_tracing()
+    parts: list[str] = []
+    for chunk in _stream_completion(dataset, temperature):
+        parts.append(chunk)
+        yield chunk
+    result = "".join(parts)
+    if key is not None and extract_script_block(result) is not None:
+        _put_cached_response(key, result)
+
+
+def iter_script_sentences(
+    chunks: Iterable[str], min_chars: int | None = None
+) -> Iterator[str]:
+    """
+    応答の断片から、最初の <script> ブロックの中身を文ごとに返す。
+    min_chars (省略時は SENTENCE_MIN_CHARS) に満たない文は次の文とまとめる。
+    文の区切りまで届いた分だけを返すので、応答を最後まで待たずに読み上げを始められる。
+    </script> の後も chunks は最後まで読む (呼び出し側で応答全体を集められるように)。
+    """
+    if min_chars is None:
+        min_chars = SENTENCE_MIN_CHARS
+    buffer = ""
+    in_script = False
+    done = False
+    pending = ""
+
+    for chunk in chunks:
+        if done:
+            continue
+        buffer += chunk
+        if not in_script:
+            match = SCRIPT_OPEN_PATTERN.search(buffer)
+            if match is None:
+                # タグが chunk をまたいでも見つけられるように、最後の "<" 以降だけを残す
+                start = buffer.rfind("<")
+                buffer = buffer[start:] if start >= 0 else ""
+                continue
+            buffer = buffer[match.end() :]
+            in_script = True
+        end = buffer.find(SCRIPT_CLOSE_TAG)
+        if end >= 0:
+            buffer = buffer[:end]
+            done = True
+        # 区切りまで届いた文だけを取り出し、残りは次の chunk を待つ
+        last_end = 0
+        for match in SENTENCE_END_PATTERN.finditer(buffer):
+            pending += buffer[last_end : match.end()]
+            last_end = match.end()
+            if len(pending.strip()) >= min_chars:
+                yield pending.strip()
+                pending = ""
+        buffer = buffer[last_end:]
+        if done:
+            pending += buffer
+            buffer = ""
+
+    if in_script:
+        # </script> で終わらなかった場合も、受け取った分は返す
+        rest = (pending + buffer).strip()
+        if rest:
+            yield rest
+
+
 def extract_script_block(text: str) -> str | None:
     """
     指定の文字列から最初に見つかった <script> タグブロック内の内容を抽出して返します。
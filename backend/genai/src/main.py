@@ -1,3 +1,5 @@
+import asyncio
+import os
 from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import Any
@@ -6,25 +8,53 @@ from zoneinfo import ZoneInfo
 import google.auth as gauth
 from cloudevents.http import from_http  # type: ignore
 from fastapi import FastAPI, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
-from src import utils
-from src.blob import storage
+from src import http_client, utils
+from src.async_task.dispatcher import CloudTasksDispatcher, TaskDispatcher
+from src.blob import async_storage, storage
 from src.book import book
 from src.database.firestore import db
 from src.event_sourcing import workflows
 from src.event_sourcing.entity import radio_show as entity_radio_show
+from src.llm import agent
 from src.logger import logger
 
 
+async def _warm_up_agent_pool(pool: agent.AgentPool) -> None:
+    """agent の作成は同期処理で時間がかかるので、event loop を止めないようにスレッドで行う"""
+    try:
+        await run_in_threadpool(pool.warm_up)
+    except Exception as e:
+        # 作成できなくても、番組作成のリクエストで改めて作成する
+        logger.error(f"llm agent pool の準備に失敗しました: {e}")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Starting server...")
     # リソースを確保する
+    # 外部への HTTP 通信は共有の httpx.Client で接続を使い回す
+    http_client.open_registry()
+    # LLM の tracing の初期化と agent の作成を、番組作成のリクエストより先に済ませる
+    agent.init_tracing()
+    pool = agent.open_pool()
+    warm_up_task: asyncio.Task[None] | None = None
+    if agent.LLM_MODE != "direct":
+        # direct では agent を使わないので作成しない
+        # 起動を待たせないように、agent はリクエストの受け付けと並行して作成する
+        warm_up_task = asyncio.create_task(_warm_up_agent_pool(pool))
     logger.info("Started server...")
     yield
     # リソースを解放する
     logger.info("Stopping server...")
+    if warm_up_task is not None:
+        await warm_up_task
+    http_client.close_registry()
+    agent.close_pool()
+    # 実行中の blob I/O の完了を待ってからスレッドプールを終了する
+    async_storage.shutdown_executor()
 
 
 # FastAPI アプリ作成
@@ -131,9 +161,11 @@ async def add_radio_show(request: Request):
             return Response(content="radio_show already created", status_code=204)
 
         # start workflow
+        # workflow は GCS や LLM への同期 I/O を含むので、イベントループを止めないようにスレッドで実行する
         masterdata_blob_path = doc.masterdata_blob_path
         broadcasted_at = doc.broadcasted_at
-        workflows.exec_run_agent_and_tts_workflow(
+        await run_in_threadpool(
+            workflows.exec_run_agent_and_tts_workflow,
             radio_show_id,
             masterdata_blob_path,
             broadcasted_at,
@@ -155,12 +187,114 @@ class AsyncTaskBody(BaseModel):
 
 KIND_LATEST_ALL = "latest_all"
 KIND_LATEST_WITH_KEYWORDS_BY_USER = "latest_with_keywords_by_user"
-# 追加案: OAI-PMHのデータを取得するのは非同期でないと時間がかかる...
+# OAI-PMHのデータを ListRecords でまとめて取得してキャッシュしておく
+KIND_HARVEST_OAI_PMH = "harvest_oai_pmh"
+# 古い OAI-PMH と RSS のキャッシュを削除する
+KIND_GC_CACHE = "gc_cache"
+# latest_all を分割して実行する場合の、shard ごとの書誌情報取得と結合
+KIND_LATEST_ALL_SHARD = workflows.KIND_LATEST_ALL_SHARD
+KIND_LATEST_ALL_MERGE = workflows.KIND_LATEST_ALL_MERGE
+
+# latest_all の書誌情報取得を分割するタスク数 (1 なら分割せずに1リクエストで実行する)
+LATEST_ALL_SHARDS = int(os.getenv("LATEST_ALL_SHARDS", "1"))
+
+# fan-out したタスクの投入先。get_task_dispatcher で最初に使う時に作る (テストでは差し替える)
+task_dispatcher: TaskDispatcher | None = None
+
+
+def get_task_dispatcher() -> TaskDispatcher:
+    """fan-out したタスクの投入先を返す。指定がなければ Cloud Tasks を使う"""
+    global task_dispatcher
+    if task_dispatcher is None:
+        task_dispatcher = CloudTasksDispatcher()
+    return task_dispatcher
 
 
 class DataForLatestAll(BaseModel):
     size: int | None = 300
     broadcasted_at: str | None = None
+    shards: int | None = None
+
+
+class DataForHarvestOaiPmh(BaseModel):
+    until: str | None = None
+
+
+class DataForGcCache(BaseModel):
+    dry_run: bool | None = False
+
+
+def _parse_utc_datetime(iso_format: str) -> datetime:
+    """ISO 8601 形式の文字列を UTC の datetime に変換する"""
+    dt = datetime.fromisoformat(iso_format)
+    # tzinfoが既にある場合はUTCに変換、ない場合はUTCとして解釈
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=ZoneInfo("UTC"))
+    return dt.astimezone(ZoneInfo("UTC"))
+
+
+def handle_async_task(kind: str, data: dict[str, Any] | None) -> None:
+    """/async_task の kind に応じて workflow を実行する。
+    LocalTaskDispatcher の handler としても使う。"""
+    if kind == KIND_LATEST_ALL:
+        broadcasted_at: datetime | None = None
+        size: int = 300
+        shards: int = LATEST_ALL_SHARDS
+        if data:
+            d = DataForLatestAll.construct(**data)
+            logger.info(f"data: {d}")
+            if d.broadcasted_at:
+                broadcasted_at = _parse_utc_datetime(d.broadcasted_at)
+
+            if d.size:
+                size = d.size
+            if d.shards:
+                shards = d.shards
+
+        # start latest_all workflow
+        url = book.latest_all(size=size)
+        if shards > 1:
+            # Fan-Outパターンで shard ごとのタスクに分散し、最後に結合する
+            workflows.exec_fan_out_fetch_workflow(
+                url,
+                storage.XML_LATEST_ALL_DIR_BASE,
+                str(size),
+                shards,
+                get_task_dispatcher(),
+                broadcasted_at,
+            )
+        else:
+            workflows.exec_fetch_rss_and_oai_pmh_workflow(
+                url, storage.XML_LATEST_ALL_DIR_BASE, str(size), broadcasted_at
+            )
+    elif kind == KIND_LATEST_ALL_SHARD:
+        shard_task = workflows.FetchShardTask.model_validate(data)
+        workflows.exec_fetch_shard_workflow(shard_task)
+    elif kind == KIND_LATEST_ALL_MERGE:
+        merge_task = workflows.MergeShardsTask.model_validate(data)
+        workflows.exec_merge_shards_workflow(merge_task, get_task_dispatcher())
+    elif kind == KIND_LATEST_WITH_KEYWORDS_BY_USER:
+        # start latest_with_keywords_by_user for each user workflow
+        pass
+    elif kind == KIND_HARVEST_OAI_PMH:
+        until: datetime | None = None
+        if data:
+            h = DataForHarvestOaiPmh.construct(**data)
+            logger.info(f"data: {h}")
+            if h.until:
+                until = _parse_utc_datetime(h.until)
+
+        # start harvest_oai_pmh workflow
+        workflows.exec_harvest_oai_pmh_workflow(until)
+    elif kind == KIND_GC_CACHE:
+        dry_run = False
+        if data:
+            g = DataForGcCache.construct(**data)
+            logger.info(f"data: {g}")
+            dry_run = bool(g.dry_run)
+
+        # start gc_cache workflow
+        workflows.exec_gc_cache_workflow(dry_run)
 
 
 # cloud scheduler からの非同期処理を一手に引き受けるエンドポイント
@@ -171,34 +305,8 @@ async def async_task(body: AsyncTaskBody):
         logger.info(f"async task kind: {body.kind}, data: {body.data}")
 
         # TODO: cloud schedulerからの定期的な非同期処理(eventarc経由ではない)
-        # NOTE: Fan-Outパターンで処理を分散するパターンも考えられる
-
-        if body.kind == KIND_LATEST_ALL:
-            broadcasted_at: datetime | None = None
-            size: int = 300
-            if body.data:
-                d = DataForLatestAll.construct(**body.data)
-                logger.info(f"data: {d}")
-                if d.broadcasted_at:
-                    dt = datetime.fromisoformat(d.broadcasted_at)
-                    # tzinfoが既にある場合はUTCに変換、ない場合はUTCとして解釈
-                    if dt.tzinfo is None:
-                        dt = dt.replace(tzinfo=ZoneInfo("UTC"))
-                    else:
-                        dt = dt.astimezone(ZoneInfo("UTC"))
-                    broadcasted_at = dt
-
-                if d.size:
-                    size = d.size
-
-            # start latest_all workflow
-            url = book.latest_all(size=size)
-            workflows.exec_fetch_rss_and_oai_pmh_workflow(
-                url, storage.XML_LATEST_ALL_DIR_BASE, str(size), broadcasted_at
-            )
-        elif body.kind == KIND_LATEST_WITH_KEYWORDS_BY_USER:
-            # start latest_with_keywords_by_user for each user workflow
-            pass
+        # workflow は同期 I/O を含むので、イベントループを止めないようにスレッドで実行する
+        await run_in_threadpool(handle_async_task, body.kind, body.data)
 
         return Response(status_code=204)
     except Exception as e:
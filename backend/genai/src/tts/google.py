@@ -1,5 +1,11 @@
+import os
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+
 from google.cloud import texttospeech  # type: ignore
 
+from src.logger import logger
+
 # TTS settings
 AUDIO_ENCODING = "MP3"
 LANGUAGE_CODE = "ja-JP"
@@ -9,6 +15,8 @@ EFFECTS_PROFILE_ID = ["handset-class-device"]
 SPEAKING_RATE = 1.1  # speed
 PITCH = 0.0
 VOLUME_GAIN_DB = 0.0
+# 文ごとに読み上げる場合 (synthesize_sentences) の同時リクエスト数
+TTS_MAX_CONCURRENCY = int(os.getenv("TTS_MAX_CONCURRENCY", "4"))
 
 # use python sdk
 # see: https://github.com/googleapis/google-cloud-python/tree/main/packages/google-cloud-texttospeech/docs
@@ -42,6 +50,23 @@ def synthesize(text: str):
     return response
 
 
+def synthesize_sentences(
+    sentences: Iterable[str], max_workers: int = TTS_MAX_CONCURRENCY
+) -> bytes:
+    """
+    文を受け取るたびに読み上げを始め、音声を文の順につなげて返す。
+    sentences は LLM の応答を読みながら作るジェネレータでよく、最後の文の読み上げが終わるまで待つ。
+    MP3 はフレームの連続なので、文ごとの音声をそのままつなげても1つの音声として再生できる。
+    """
+    with ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix="tts"
+    ) as executor:
+        futures = [executor.submit(synthesize, sentence) for sentence in sentences]
+        audio = b"".join(future.result().audio_content for future in futures)
+    logger.info(f"synthesized {len(futures)} sentences: {len(audio)} bytes")
+    return audio
+
+
 if __name__ == "__main__":
     text = """はい、皆さんこんにちは！ラジオパーソナリティのミーホです。
 今日のテーマは「創造性と伝統、未来を彩る二つの光」です。
@@ -1,3 +1,5 @@
+import threading
+import time
 import uuid
 from datetime import UTC, datetime, timedelta, tzinfo
 from zoneinfo import ZoneInfo
@@ -54,3 +56,36 @@ def is_consecutive_days(date_a: datetime, date_b: datetime) -> bool:
 def get_diff_days(date_a: datetime, date_b: datetime) -> int:
     """指定引数AはBの何日後か"""
     return (date_a.date() - date_b.date()).days
+
+
+class TokenBucket:
+    """トークンバケット方式のレート制限。複数スレッドから共有して使う想定。
+
+    rate: 1秒あたりに補充されるトークン数
+    capacity: バケットに貯められる最大トークン数 (バースト許容量)
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        if rate <= 0:
+            raise ValueError("rate should be positive.")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """トークンが取得できるまでブロックする"""
+        if tokens > self.capacity:
+            raise ValueError("tokens should not exceed capacity.")
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                elapsed = now - self._updated_at
+                self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+                self._updated_at = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_seconds = (tokens - self._tokens) / self.rate
+            time.sleep(wait_seconds)
@@ -0,0 +1,86 @@
+import threading
+import time
+
+import pytest
+
+from src.event_sourcing.pipeline import Pipeline, Stage
+
+
+def test_pipeline_keeps_source_order():
+    """
+    stage を並列に処理して完了順がばらばらでも、結果は source の順序で返ることをテストする。
+    """
+
+    def slow_double(x: int) -> int:
+        # 先に投入したものほど遅く終わる
+        time.sleep(0.001 * (20 - x))
+        return x * 2
+
+    pipeline = Pipeline(
+        [Stage("double", slow_double, 4), Stage("inc", lambda x: x + 1, 2)],
+        queue_size=2,
+    )
+    assert pipeline.run(range(20)) == [x * 2 + 1 for x in range(20)]
+
+    stats = {s.name: s for s in pipeline.stats}
+    assert pipeline.source_stats.processed == 20
+    assert stats["double"].processed == 20
+    assert stats["inc"].processed == 20
+
+
+def test_pipeline_stage_concurrency_is_bounded():
+    """
+    stage ごとに指定した並列数を超えて同時に処理しないことをテストする。
+    """
+    lock = threading.Lock()
+    running = {"fast": 0, "slow": 0}
+    max_running = {"fast": 0, "slow": 0}
+
+    def track(name: str, seconds: float):
+        def f(x: int) -> int:
+            with lock:
+                running[name] += 1
+                max_running[name] = max(max_running[name], running[name])
+            time.sleep(seconds)
+            with lock:
+                running[name] -= 1
+            return x
+
+        return f
+
+    pipeline = Pipeline(
+        [
+            Stage("fast", track("fast", 0.001), 1),
+            Stage("slow", track("slow", 0.02), 3),
+        ],
+        queue_size=2,
+    )
+    assert pipeline.run(range(12)) == list(range(12))
+    assert max_running["fast"] == 1
+    assert 1 < max_running["slow"] <= 3
+
+
+def test_pipeline_raises_stage_error():
+    """
+    stage の例外は run から送出され、スレッドが残らないことをテストする。
+    """
+
+    def fail_on_three(x: int) -> int:
+        if x == 3:
+            raise ValueError("boom")
+        return x
+
+    pipeline = Pipeline(
+        [Stage("check", fail_on_three, 2), Stage("pass", lambda x: x, 2)],
+        queue_size=1,
+    )
+    with pytest.raises(ValueError, match="boom"):
+        pipeline.run(range(100))
+    assert not any(t.name.startswith("pipeline_") for t in threading.enumerate())
+
+
+def test_pipeline_validates_arguments():
+    with pytest.raises(ValueError):
+        Pipeline([])
+    with pytest.raises(ValueError):
+        Stage("zero", lambda x: x, 0)
@@ -1,9 +1,33 @@
+import asyncio
+import io
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from types import SimpleNamespace
 from zoneinfo import ZoneInfo
 
 import pytest
 
-from src.event_sourcing.workflows import MstBook, convert_to_book_prompt, split_books
+import src.main as main_module
+from src.async_task import google as async_task_google
+from src.async_task.dispatcher import LocalTaskDispatcher, TaskDispatcher
+from src.blob import storage as storage_module
+from src.blob.local import LocalBucket
+from src.blob.storage import RssCacheValidators
+from src.book.feed import RssFetchResult, RssStreamResponse
+from src.book.oai_pmh import HarvestedPage
+from src.event_sourcing import workflows
+from src.event_sourcing.workflows import (
+    MstBook,
+    MstBookRecord,
+    MstBooks,
+    convert_to_book_prompt,
+    split_books,
+    split_into_shards,
+)
 
 
 def test_split_books_classification():
@@ -400,3 +424,1225 @@ def test_metadata_unsupported_type(caplog):
         "metadata に未対応の型が含まれています: 300" in record.message
         for record in caplog.records
     )
+
+
+def _dummy_rss_xml(isbns: list[str]) -> str:
+    items = "".join(
+        f"""<item>
+<title>Book {isbn}</title>
+<link>https://ndlsearch.ndl.go.jp/books/R100000137-I{isbn}</link>
+<description>summary {isbn}</description>
+<guid isPermaLink="true">https://ndlsearch.ndl.go.jp/books/R100000137-I{isbn}</guid>
+<pubDate>Tue, 11 Feb 2025 10:00:00 +0900</pubDate>
+</item>"""
+        for isbn in isbns
+    )
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0"><channel>
+<title>dummy</title>
+<lastBuildDate>Tue, 11 Feb 2025 12:00:00 +0900</lastBuildDate>
+{items}
+</channel></rss>"""
+
+
+def _combined_books(lines: list[str]) -> MstBooks:
+    """NDJSON 形式の masterdata の行を MstBooks に戻す"""
+    books = [MstBookRecord.model_validate_json(line).book for line in lines]
+    return MstBooks({book.link: book for book in books})
+
+
+def _checkpoint_segments(env, signature):
+    """fetch_workflow_env に保存したチェックポイントの、カーソルまでの segment"""
+    checkpoint = env.checkpoints.get(signature)
+    if checkpoint is None:
+        return []
+    return [checkpoint["segments"][i] for i in range(checkpoint["cursor"])]
+
+
+def _checkpointed_books(env, signature):
+    """fetch_workflow_env に保存したチェックポイントの書籍を、segment を順に重ねて返す"""
+    books = {}
+    for segment in _checkpoint_segments(env, signature):
+        books.update(MstBooks.model_validate_json(segment).root)
+    return MstBooks(books)
+
+
+@pytest.fixture
+def fetch_workflow_env(monkeypatch):
+    """exec_fetch_rss_and_oai_pmh_workflow の外部依存 (GCS, NDL, Firestore) を差し替える"""
+    isbns = [f"978000000{i:04d}" for i in range(30)]
+    env = SimpleNamespace(
+        isbns=isbns,
+        rss_xml=_dummy_rss_xml(isbns),
+        cached_isbns=set(isbns[::3]),
+        fetched=[],
+        uploaded={},
+        combined={},
+        partitions={},
+        max_concurrency=0,
+        recorded=[],
+        flushed=False,
+        checkpoints={},
+        fail_isbn=None,
+        shards={},
+        published={},
+        radio_shows=[],
+        rss_reads=[],
+    )
+    lock = threading.Lock()
+    running = {"count": 0}
+
+    def fake_get_closest_cached_rss_file(utcnow, prefix_dir, suffix_dir):
+        return io.BytesIO(env.rss_xml.encode("utf-8"))
+
+    def fake_get_rss_xml_file_by_signature(signature, prefix_dir, suffix_dir):
+        env.rss_reads.append((signature, prefix_dir, suffix_dir))
+        return io.BytesIO(env.rss_xml.encode("utf-8"))
+
+    class FakeCacheIndex:
+        def record(self, prefix_dir, identifier, blob):
+            env.recorded.append(identifier)
+
+        def refresh_if_unchanged(self, prefix_dir, identifier, digest):
+            return False
+
+        def flush(self):
+            env.flushed = True
+
+    def fake_get_cached_oai_pmh_file_with_index(index, identifier, prefix_dir):
+        if identifier in env.cached_isbns:
+            return io.BytesIO(json.dumps({"cached": identifier}).encode("utf-8"))
+        return None
+
+    def fake_get_metadata_by_isbn(isbn):
+        if isbn == env.fail_isbn:
+            raise TimeoutError(f"dummy timeout: {isbn}")
+        with lock:
+            running["count"] += 1
+            env.max_concurrency = max(env.max_concurrency, running["count"])
+        # 完了順がばらばらになるように待つ
+        time.sleep(random.uniform(0, 0.02))
+        with lock:
+            running["count"] -= 1
+            env.fetched.append(isbn)
+        return {"fetched": isbn}
+
+    def fake_put_blob_write(write):
+        signature = write.blob_path.rsplit("/", 1)[1].removesuffix(".json")
+        env.uploaded[signature] = write.payload
+        return SimpleNamespace(name=write.blob_path)
+
+    def fake_put_masterdata_partition(signature, day, lines):
+        env.partitions[(signature, day)] = list(lines)
+
+    def fake_put_masterdata_index(signature, json_str):
+        # 索引の日付順に、日付ごとの masterdata を1つに戻して記録する
+        index = workflows.MasterdataIndex.model_validate_json(json_str)
+        env.combined[signature] = [
+            line for day in index.dates for line in env.partitions[(signature, day)]
+        ]
+        return SimpleNamespace(name=f"private/masterdata/{signature}/_index.json")
+
+    monkeypatch.setattr(
+        workflows, "get_closest_cached_rss_file", fake_get_closest_cached_rss_file
+    )
+    monkeypatch.setattr(workflows, "OaiPmhCacheIndex", FakeCacheIndex)
+    monkeypatch.setattr(
+        workflows,
+        "get_rss_xml_file_by_signature",
+        fake_get_rss_xml_file_by_signature,
+    )
+    monkeypatch.setattr(
+        workflows,
+        "get_cached_oai_pmh_file_with_index",
+        fake_get_cached_oai_pmh_file_with_index,
+    )
+    monkeypatch.setattr(workflows, "get_metadata_by_isbn", fake_get_metadata_by_isbn)
+    monkeypatch.setattr(workflows, "put_blob_write", fake_put_blob_write)
+    # 日付ごとの masterdata は async_storage 経由でアップロードする
+    monkeypatch.setattr(
+        storage_module, "put_masterdata_partition", fake_put_masterdata_partition
+    )
+    monkeypatch.setattr(workflows, "put_masterdata_index", fake_put_masterdata_index)
+    monkeypatch.setattr(
+        workflows.entity_radio_show,
+        "new",
+        lambda path, broadcasted_at: env.radio_shows.append((path, broadcasted_at)),
+    )
+
+    def fake_claim_masterdata_publish(signature, key):
+        if (signature, key) in env.published:
+            return None
+        env.published[(signature, key)] = "running"
+        return 1
+
+    monkeypatch.setattr(
+        workflows, "claim_masterdata_publish", fake_claim_masterdata_publish
+    )
+    monkeypatch.setattr(
+        workflows,
+        "complete_masterdata_publish",
+        lambda signature, key, generation: env.published.__setitem__(
+            (signature, key), "done"
+        ),
+    )
+    monkeypatch.setattr(
+        workflows,
+        "release_masterdata_publish",
+        lambda signature, key, generation: env.published.pop((signature, key), None),
+    )
+
+    def fake_put_masterdata_checkpoint_segment(signature, segment, json_str):
+        checkpoint = env.checkpoints.setdefault(
+            signature, {"segments": {}, "cursor": 0}
+        )
+        checkpoint["segments"][segment] = json_str
+
+    def fake_put_masterdata_checkpoint_cursor(signature, segments):
+        env.checkpoints[signature]["cursor"] = segments
+
+    monkeypatch.setattr(
+        workflows,
+        "put_masterdata_checkpoint_segment",
+        fake_put_masterdata_checkpoint_segment,
+    )
+    monkeypatch.setattr(
+        workflows,
+        "put_masterdata_checkpoint_cursor",
+        fake_put_masterdata_checkpoint_cursor,
+    )
+    monkeypatch.setattr(
+        workflows,
+        "get_masterdata_checkpoint_segments",
+        lambda signature: _checkpoint_segments(env, signature),
+    )
+    monkeypatch.setattr(
+        workflows,
+        "delete_masterdata_checkpoint",
+        lambda signature: env.checkpoints.pop(signature, None),
+    )
+    monkeypatch.setattr(
+        workflows,
+        "put_masterdata_shard",
+        lambda signature, shard, json_str: env.shards.__setitem__(
+            (signature, shard), json_str
+        ),
+    )
+    monkeypatch.setattr(
+        workflows,
+        "get_masterdata_shard",
+        lambda signature, shard: env.shards.get((signature, shard)),
+    )
+
+    def fake_delete_masterdata_shards(signature, shards):
+        for shard in range(shards):
+            env.shards.pop((signature, shard), None)
+
+    monkeypatch.setattr(
+        workflows, "delete_masterdata_shards", fake_delete_masterdata_shards
+    )
+    return env
+
+
+def test_exec_fetch_rss_and_oai_pmh_workflow_concurrent_keeps_order(
+    fetch_workflow_env,
+):
+    """
+    書誌情報の取得を並行に行っても、masterdata の順序は feed の順序のままであることをテストする。
+    """
+    env = fetch_workflow_env
+    workflows.exec_fetch_rss_and_oai_pmh_workflow(
+        "http://dummy.url", "latest_all", "30", max_workers=4, rate_per_sec=1000
+    )
+
+    assert len(env.combined) == 1
+    mst_books = _combined_books(next(iter(env.combined.values())))
+    assert [mst_books[link].isbn for link in mst_books] == env.isbns
+    # キャッシュがあるものはリクエストもアップロードもしない
+    uncached = [isbn for isbn in env.isbns if isbn not in env.cached_isbns]
+    assert sorted(env.fetched) == uncached
+    assert sorted(env.uploaded) == uncached
+    # 取得したものは索引に記録され、最後にまとめて反映される
+    assert sorted(env.recorded) == uncached
+    assert env.flushed
+    for link in mst_books:
+        book = mst_books[link]
+        if book.isbn in env.cached_isbns:
+            assert book.metadata == {"cached": book.isbn}
+        else:
+            assert book.metadata == {"fetched": book.isbn}
+    assert 1 < env.max_concurrency <= 4
+
+
+def test_exec_fetch_rss_and_oai_pmh_workflow_not_modified_uses_cache(
+    fetch_workflow_env, monkeypatch
+):
+    """
+    同日のキャッシュがなくても、条件付きリクエストが 304 なら前回のキャッシュを使うことをテストする。
+    """
+    env = fetch_workflow_env
+    requests = []
+    put_rss_calls = []
+
+    def fake_fetch_rss_conditional(url, etag=None, last_modified=None):
+        requests.append((etag, last_modified))
+        return RssFetchResult(etag=etag, last_modified=last_modified, not_modified=True)
+
+    monkeypatch.setattr(
+        workflows, "get_closest_cached_rss_file", lambda *args, **kwargs: None
+    )
+    monkeypatch.setattr(
+        workflows,
+        "get_rss_validators",
+        lambda prefix_dir, suffix_dir: RssCacheValidators(
+            blob_name="private/rss/latest_all_30/20250210_120000_0900.xml",
+            etag='"v1"',
+        ),
+    )
+    monkeypatch.setattr(workflows, "fetch_rss_conditional", fake_fetch_rss_conditional)
+    monkeypatch.setattr(
+        workflows,
+        "get_rss_xml_file",
+        lambda blob_path: io.BytesIO(env.rss_xml.encode("utf-8")),
+    )
+    monkeypatch.setattr(
+        workflows, "put_rss_xml_file", lambda **kwargs: put_rss_calls.append(kwargs)
+    )
+
+    workflows.exec_fetch_rss_and_oai_pmh_workflow(
+        "http://dummy.url", "latest_all", "30", rate_per_sec=1000
+    )
+
+    assert requests == [('"v1"', None)]
+    assert put_rss_calls == []
+    assert len(env.combined) == 1
+
+
+def test_exec_fetch_rss_and_oai_pmh_workflow_keyword_feed_reuses_validators(
+    fetch_workflow_env, monkeypatch, tmp_path
+):
+    """
+    keyword の feed でも、RSS のキャッシュと validator を読み出しと同じディレクトリに書き、
+    翌日の実行では条件付きリクエストの 304 で前回のキャッシュを使うことをテストする。
+    """
+    env = fetch_workflow_env
+    bucket = LocalBucket(tmp_path)
+    monkeypatch.setattr(storage_module, "_get_bucket", lambda: bucket)
+    monkeypatch.setattr(
+        workflows,
+        "get_closest_cached_rss_file",
+        storage_module.get_closest_cached_rss_file,
+    )
+    requests = []
+
+    def fake_fetch_rss_conditional(url, etag=None, last_modified=None):
+        requests.append(etag)
+        if etag == '"v1"':
+            return RssFetchResult(etag=etag, not_modified=True)
+        return RssFetchResult(raw_xml=env.rss_xml, etag='"v1"')
+
+    monkeypatch.setattr(workflows, "fetch_rss_conditional", fake_fetch_rss_conditional)
+
+    for day in [11, 12]:
+        monkeypatch.setattr(
+            workflows,
+            "get_now",
+            lambda day=day: datetime(2025, 2, day, 3, 0, 0, tzinfo=ZoneInfo("UTC")),
+        )
+        workflows.exec_fetch_rss_and_oai_pmh_workflow(
+            "http://dummy.url", "keyword_tech", "30", rate_per_sec=1000
+        )
+
+    assert requests == [None, '"v1"']
+    assert sorted(b.name for b in bucket.list_blobs(prefix="private/rss/")) == [
+        "private/rss/keyword_tech_30/20250211_120000_0900.xml",
+        "private/rss/keyword_tech_30/_latest.json",
+    ]
+
+
+def test_exec_fetch_rss_and_oai_pmh_workflow_streaming(fetch_workflow_env, monkeypatch):
+    """
+    streaming の場合も、受信しながら取得した masterdata が feed の順序になり、
+    受信し終わった RSS がキャッシュされることをテストする。
+    """
+    env = fetch_workflow_env
+    raw = env.rss_xml.encode("utf-8")
+    put_rss_calls = []
+
+    @contextmanager
+    def fake_stream_rss(url, etag=None, last_modified=None):
+        yield RssStreamResponse(
+            iter([raw[i : i + 100] for i in range(0, len(raw), 100)]), etag='"v2"'
+        )
+
+    def fake_put_rss_xml_file(
+        last_build_date, prefix_dir, file, suffix_dir, etag, last_modified
+    ):
+        put_rss_calls.append((last_build_date, file.getvalue(), etag))
+        return SimpleNamespace(name="private/rss/dummy.xml", public_url="gs://dummy")
+
+    monkeypatch.setattr(
+        workflows, "get_closest_cached_rss_file", lambda *args, **kwargs: None
+    )
+    monkeypatch.setattr(
+        workflows, "get_rss_validators", lambda prefix_dir, suffix_dir: None
+    )
+    monkeypatch.setattr(workflows, "stream_rss", fake_stream_rss)
+    monkeypatch.setattr(workflows, "put_rss_xml_file", fake_put_rss_xml_file)
+
+    workflows.exec_fetch_rss_and_oai_pmh_workflow(
+        "http://dummy.url",
+        "latest_all",
+        "30",
+        max_workers=4,
+        rate_per_sec=1000,
+        streaming=True,
+    )
+
+    assert len(put_rss_calls) == 1
+    assert put_rss_calls[0][0] == datetime(
+        2025, 2, 11, 12, 0, 0, tzinfo=ZoneInfo("Asia/Tokyo")
+    )
+    assert put_rss_calls[0][1] == raw
+    # validator は RSS のキャッシュと一緒に記録する
+    assert put_rss_calls[0][2] == '"v2"'
+    assert list(env.combined) == ["20250211_120000_0900"]
+    mst_books = _combined_books(env.combined["20250211_120000_0900"])
+    assert [mst_books[link].isbn for link in mst_books] == env.isbns
+
+
+def test_exec_fetch_rss_and_oai_pmh_workflow_streaming_closes_response_on_failure(
+    fetch_workflow_env, monkeypatch
+):
+    """
+    streaming で RSS を受信し終わる前にパイプラインが失敗しても、受信中の応答を閉じることをテストする。
+    """
+    env = fetch_workflow_env
+    raw = env.rss_xml.encode("utf-8")
+    # isbns[0] はキャッシュにあるので、NDL から取得する isbns[1] までを先に受信する
+    first_item_end = raw.index(b"</item>", raw.index(b"</item>") + 1) + len(b"</item>")
+    failed = threading.Event()
+    closed = []
+
+    def chunks():
+        yield raw[:first_item_end]
+        # item の取得が失敗するまで、残りは受信しない
+        failed.wait(5)
+        time.sleep(0.1)
+        yield raw[first_item_end : first_item_end + 100]
+        yield raw[first_item_end + 100 :]
+
+    @contextmanager
+    def fake_stream_rss(url, etag=None, last_modified=None):
+        try:
+            yield RssStreamResponse(chunks())
+        finally:
+            closed.append(True)
+
+    fetch_metadata = workflows.get_metadata_by_isbn
+
+    def failing_get_metadata_by_isbn(isbn):
+        try:
+            return fetch_metadata(isbn)
+        except TimeoutError:
+            failed.set()
+            raise
+
+    monkeypatch.setattr(
+        workflows, "get_closest_cached_rss_file", lambda *args, **kwargs: None
+    )
+    monkeypatch.setattr(
+        workflows, "get_rss_validators", lambda prefix_dir, suffix_dir: None
+    )
+    monkeypatch.setattr(workflows, "stream_rss", fake_stream_rss)
+    monkeypatch.setattr(workflows, "get_metadata_by_isbn", failing_get_metadata_by_isbn)
+    monkeypatch.setattr(
+        workflows,
+        "put_rss_xml_file",
+        lambda **kwargs: SimpleNamespace(public_url="gs://dummy"),
+    )
+    env.fail_isbn = env.isbns[1]
+
+    with pytest.raises(TimeoutError):
+        workflows.exec_fetch_rss_and_oai_pmh_workflow(
+            "http://dummy.url", "latest_all", "30", rate_per_sec=1000, streaming=True
+        )
+    assert closed == [True]
+
+
+def test_exec_fetch_rss_and_oai_pmh_workflow_streaming_checkpoint_without_last_build_date(
+    fetch_workflow_env, monkeypatch
+):
+    """
+    streaming で更新日時より先に item を受け取った場合も、リクエストの日付のチェックポイントに保存して、
+    再実行ではチェックポイント済みの書籍を取得し直さないことをテストする。
+    """
+    env = fetch_workflow_env
+    last_build_date = "<lastBuildDate>Tue, 11 Feb 2025 12:00:00 +0900</lastBuildDate>\n"
+    raw = (
+        env.rss_xml.replace(last_build_date, "")
+        .replace("</channel>", last_build_date + "</channel>")
+        .encode("utf-8")
+    )
+
+    @contextmanager
+    def fake_stream_rss(url, etag=None, last_modified=None):
+        yield RssStreamResponse(
+            iter([raw[i : i + 100] for i in range(0, len(raw), 100)])
+        )
+
+    monkeypatch.setattr(
+        workflows, "get_closest_cached_rss_file", lambda *args, **kwargs: None
+    )
+    monkeypatch.setattr(
+        workflows, "get_rss_validators", lambda prefix_dir, suffix_dir: None
+    )
+    monkeypatch.setattr(workflows, "stream_rss", fake_stream_rss)
+    monkeypatch.setattr(
+        workflows,
+        "put_rss_xml_file",
+        lambda *args, **kwargs: SimpleNamespace(
+            name="private/rss/dummy.xml", public_url="gs://dummy"
+        ),
+    )
+    monkeypatch.setattr(
+        workflows,
+        "get_now",
+        lambda: datetime(2025, 2, 11, 3, 0, 0, tzinfo=ZoneInfo("UTC")),
+    )
+    config = workflows.FetchPipelineConfig(
+        probe_workers=2, fetch_workers=2, write_workers=2, checkpoint_interval=5
+    )
+
+    env.fail_isbn = env.isbns[20]
+    with pytest.raises(TimeoutError):
+        workflows.exec_fetch_rss_and_oai_pmh_workflow(
+            "http://dummy.url",
+            "latest_all",
+            "30",
+            rate_per_sec=1000,
+            streaming=True,
+            pipeline_config=config,
+        )
+    assert list(env.checkpoints) == ["latest_all_30_20250211"]
+    checkpointed = _checkpointed_books(env, "latest_all_30_20250211")
+    done = {checkpointed[link].isbn for link in checkpointed}
+    assert len(done) > 0
+
+    env.fail_isbn = None
+    env.fetched.clear()
+    workflows.exec_fetch_rss_and_oai_pmh_workflow(
+        "http://dummy.url",
+        "latest_all",
+        "30",
+        rate_per_sec=1000,
+        streaming=True,
+        pipeline_config=config,
+    )
+
+    assert done.isdisjoint(env.fetched)
+    mst_books = _combined_books(env.combined["20250211_120000_0900"])
+    assert [mst_books[link].isbn for link in mst_books] == env.isbns
+    assert env.checkpoints == {}
+
+
+def _checkpoint_book(i: int) -> MstBook:
+    return MstBook(
+        title=f"Book {i}",
+        summary="",
+        isbn="",
+        jp_e_code="",
+        link=f"link{i}",
+        thumbnail_link="",
+        published=datetime(2025, 2, 11, tzinfo=ZoneInfo("UTC")),
+    )
+
+
+def test_masterdata_checkpoint_uploads_only_new_books_outside_lock(monkeypatch):
+    """チェックポイントは前回から増えた書籍だけを segment としてアップロードし、その間は lock を持たない"""
+    checkpoint = workflows.MasterdataCheckpoint(interval=2)
+    saved = []
+    cursors = []
+
+    def fake_put_masterdata_checkpoint_segment(signature, segment, json_str):
+        assert not checkpoint._lock.locked()
+        saved.append(
+            (signature, segment, list(MstBooks.model_validate_json(json_str).root))
+        )
+
+    monkeypatch.setattr(
+        workflows, "get_masterdata_checkpoint_segments", lambda signature: []
+    )
+    monkeypatch.setattr(
+        workflows,
+        "put_masterdata_checkpoint_segment",
+        fake_put_masterdata_checkpoint_segment,
+    )
+    monkeypatch.setattr(
+        workflows,
+        "put_masterdata_checkpoint_cursor",
+        lambda signature, segments: cursors.append(segments),
+    )
+    checkpoint.load("sig")
+    for i in range(5):
+        checkpoint.add(_checkpoint_book(i))
+    checkpoint.save()
+
+    assert saved == [
+        ("sig", 0, ["link0", "link1"]),
+        ("sig", 1, ["link2", "link3"]),
+        ("sig", 2, ["link4"]),
+    ]
+    assert cursors == [1, 2, 3]
+
+
+def test_masterdata_checkpoint_resumes_after_saved_segments(monkeypatch):
+    """復元したチェックポイントの続きの segment から保存し、保存に失敗した書籍は次の保存に回す"""
+    segments = [
+        MstBooks({"link0": _checkpoint_book(0)}).model_dump_json(),
+        MstBooks({"link1": _checkpoint_book(1)}).model_dump_json(),
+    ]
+    saved = []
+    fail = {"count": 1}
+
+    def fake_put_masterdata_checkpoint_segment(signature, segment, json_str):
+        if fail["count"] > 0:
+            fail["count"] -= 1
+            raise TimeoutError("upload failed")
+        saved.append((segment, list(MstBooks.model_validate_json(json_str).root)))
+
+    monkeypatch.setattr(
+        workflows, "get_masterdata_checkpoint_segments", lambda signature: segments
+    )
+    monkeypatch.setattr(
+        workflows,
+        "put_masterdata_checkpoint_segment",
+        fake_put_masterdata_checkpoint_segment,
+    )
+    monkeypatch.setattr(
+        workflows, "put_masterdata_checkpoint_cursor", lambda signature, n: None
+    )
+    checkpoint = workflows.MasterdataCheckpoint(interval=10)
+
+    assert checkpoint.load("sig") == 2
+    assert checkpoint.restored("link1") is not None
+    checkpoint.add(_checkpoint_book(2))
+    with pytest.raises(TimeoutError):
+        checkpoint.save()
+    checkpoint.add(_checkpoint_book(3))
+    checkpoint.save()
+
+    assert saved == [(2, ["link2", "link3"])]
+
+
+def test_exec_harvest_oai_pmh_workflow_resumes_and_advances_high_water_mark(
+    monkeypatch,
+):
+    """
+    中断した harvest は保存された resumptionToken から再開し、完了後に high-water mark を進めることをテストする。
+    """
+    from_date = datetime(2025, 2, 1, 0, 0, 0, tzinfo=ZoneInfo("UTC"))
+    until_date = datetime(2025, 2, 9, 0, 0, 0, tzinfo=ZoneInfo("UTC"))
+    states = [
+        workflows.OaiPmhHarvestState(
+            repository="R100000137",
+            high_water_mark=from_date,
+            from_date=from_date,
+            until_date=until_date,
+            resumption_token="token-1",
+        ).model_dump_json()
+    ]
+    uploaded = {}
+    calls = []
+
+    class FakeCacheIndex:
+        def record(self, prefix_dir, identifier, blob):
+            pass
+
+        def refresh_if_unchanged(self, prefix_dir, identifier, digest):
+            return False
+
+        def flush(self):
+            pass
+
+    def fake_list_record_pages(from_, until, repository, resumption_token):
+        calls.append((from_, until, resumption_token))
+        yield HarvestedPage(
+            records=[
+                workflows.HarvestedRecord(
+                    identifier_type="isbn",
+                    identifier="9784621310328",
+                    datestamp="2025-02-08T00:00:00Z",
+                    metadata={"title": ["a"]},
+                ),
+                workflows.HarvestedRecord(
+                    identifier_type="jp_e_code",
+                    identifier="09D154490010d0000000",
+                    datestamp="2025-02-08T00:00:00Z",
+                    deleted=True,
+                ),
+            ],
+            next_resumption_token=None,
+        )
+
+    monkeypatch.setattr(workflows, "list_record_pages", fake_list_record_pages)
+    monkeypatch.setattr(workflows, "OaiPmhCacheIndex", FakeCacheIndex)
+    monkeypatch.setattr(
+        workflows, "get_oai_pmh_harvest_state", lambda repository: states[-1]
+    )
+    monkeypatch.setattr(
+        workflows,
+        "put_oai_pmh_harvest_state",
+        lambda repository, json_str: states.append(json_str),
+    )
+    monkeypatch.setattr(
+        workflows,
+        "put_oai_pmh_json",
+        lambda signature, prefix_dir, json_str: uploaded.update(
+            {f"{prefix_dir}/{signature}": json.loads(json_str)}
+        ),
+    )
+
+    count = workflows.exec_harvest_oai_pmh_workflow(
+        datetime(2025, 2, 10, 0, 0, 0, tzinfo=ZoneInfo("UTC"))
+    )
+
+    assert count == 1
+    # 中断時の期間と token で再開する
+    assert calls == [(from_date, until_date, "token-1")]
+    # 削除されたレコードはキャッシュしない
+    assert uploaded == {"isbn/9784621310328": {"title": ["a"]}}
+    final_state = workflows.OaiPmhHarvestState.model_validate_json(states[-1])
+    assert final_state.high_water_mark == until_date
+    assert final_state.resumption_token is None
+
+
+def test_exec_fetch_rss_and_oai_pmh_workflow_resumes_from_checkpoint(
+    fetch_workflow_env,
+):
+    """
+    途中で失敗した場合はそこまでの masterdata がチェックポイントに残り、
+    再実行ではチェックポイント済みの書籍を取得し直さずに完成させることをテストする。
+    """
+    env = fetch_workflow_env
+    config = workflows.FetchPipelineConfig(
+        probe_workers=2, fetch_workers=2, write_workers=2, checkpoint_interval=5
+    )
+    env.fail_isbn = env.isbns[20]
+    with pytest.raises(TimeoutError):
+        workflows.exec_fetch_rss_and_oai_pmh_workflow(
+            "http://dummy.url",
+            "latest_all",
+            "30",
+            rate_per_sec=1000,
+            pipeline_config=config,
+        )
+    assert env.combined == {}
+    assert list(env.checkpoints) == ["20250211_120000_0900"]
+    checkpointed = _checkpointed_books(env, "20250211_120000_0900")
+    done = {checkpointed[link].isbn for link in checkpointed}
+    assert len(done) > 0
+    assert env.fail_isbn not in done
+
+    env.fail_isbn = None
+    env.fetched.clear()
+    workflows.exec_fetch_rss_and_oai_pmh_workflow(
+        "http://dummy.url",
+        "latest_all",
+        "30",
+        rate_per_sec=1000,
+        pipeline_config=config,
+    )
+
+    # チェックポイント済みの書籍は取得し直さない
+    assert done.isdisjoint(env.fetched)
+    assert env.isbns[20] in env.fetched
+    mst_books = _combined_books(env.combined["20250211_120000_0900"])
+    assert [mst_books[link].isbn for link in mst_books] == env.isbns
+    # 完成したらチェックポイントは削除される
+    assert env.checkpoints == {}
+
+
+def test_put_masterdata_partitions_uploads_concurrently(monkeypatch):
+    """日付ごとの masterdata は async_storage で並行にアップロードする"""
+    lock = threading.Lock()
+    running = {"count": 0, "max": 0}
+    uploaded = []
+
+    def slow_put_masterdata_partition(signature, day, lines):
+        with lock:
+            running["count"] += 1
+            running["max"] = max(running["max"], running["count"])
+        time.sleep(0.05)
+        with lock:
+            running["count"] -= 1
+            uploaded.append((signature, day, lines))
+
+    monkeypatch.setattr(
+        storage_module, "put_masterdata_partition", slow_put_masterdata_partition
+    )
+    partitions = {f"2025021{i}": [f'{{"n":{i}}}'] for i in range(4)}
+
+    asyncio.run(workflows._put_masterdata_partitions("sig", partitions))
+
+    assert sorted(uploaded) == [
+        ("sig", day, lines) for day, lines in sorted(partitions.items())
+    ]
+    assert running["max"] > 1
+
+
+def test_split_into_shards_keeps_order():
+    assert split_into_shards(10, 3) == [(0, 4), (4, 7), (7, 10)]
+    # item より shard が多い場合は空の shard になる
+    assert split_into_shards(2, 3) == [(0, 1), (1, 2), (2, 2)]
+    with pytest.raises(ValueError):
+        split_into_shards(10, 0)
+
+
+def test_latest_all_fan_out_and_merge_with_local_dispatcher(
+    fetch_workflow_env, monkeypatch
+):
+    """
+    latest_all を shard に分けて投入し、結合タスクが断片を feed の順序で1つの masterdata にすることを、
+    Cloud Tasks の代わりに LocalTaskDispatcher で検証する。
+    """
+    env = fetch_workflow_env
+    dispatcher = LocalTaskDispatcher(main_module.handle_async_task)
+    sent = []
+    dispatch = dispatcher.dispatch
+
+    def recording_dispatch(kind, data=None, scheduled_seconds_from_now=None):
+        sent.append((kind, data))
+        dispatch(kind, data, scheduled_seconds_from_now)
+
+    monkeypatch.setattr(dispatcher, "dispatch", recording_dispatch)
+    monkeypatch.setattr(main_module, "task_dispatcher", dispatcher)
+    monkeypatch.setattr(main_module.book, "latest_all", lambda size: "http://dummy.url")
+    new_calls = []
+    monkeypatch.setattr(
+        workflows.entity_radio_show,
+        "new",
+        lambda path, broadcasted_at: new_calls.append((path, broadcasted_at)),
+    )
+
+    main_module.handle_async_task(
+        main_module.KIND_LATEST_ALL,
+        {"size": 30, "shards": 3, "broadcasted_at": "2025-02-12T09:00:00+09:00"},
+    )
+    # fan-out では書誌情報を取得しない
+    assert env.fetched == []
+    assert len(dispatcher) == 4
+    # shard のタスクには item を載せず、キャッシュした RSS の範囲だけを送る
+    shard_data = [
+        data for kind, data in sent if kind == main_module.KIND_LATEST_ALL_SHARD
+    ]
+    assert all("entries" not in data for data in shard_data)
+    assert [(d["start"], d["end"]) for d in shard_data] == [(0, 10), (10, 20), (20, 30)]
+
+    dispatcher.run_until_empty()
+
+    assert dispatcher.executed == [
+        main_module.KIND_LATEST_ALL_SHARD,
+        main_module.KIND_LATEST_ALL_SHARD,
+        main_module.KIND_LATEST_ALL_SHARD,
+        main_module.KIND_LATEST_ALL_MERGE,
+    ]
+    assert env.rss_reads == [("20250211_120000_0900", "latest_all", "30")] * 3
+    assert list(env.combined) == ["20250211_120000_0900"]
+    mst_books = _combined_books(env.combined["20250211_120000_0900"])
+    assert [mst_books[link].isbn for link in mst_books] == env.isbns
+    uncached = [isbn for isbn in env.isbns if isbn not in env.cached_isbns]
+    assert sorted(env.fetched) == uncached
+    assert new_calls == [
+        (
+            "private/masterdata/20250211_120000_0900/_index.json",
+            datetime(2025, 2, 12, 0, 0, 0, tzinfo=ZoneInfo("UTC")),
+        )
+    ]
+    # 結合した断片は削除される
+    assert env.shards == {}
+
+
+def test_merge_shards_waits_for_missing_shards(fetch_workflow_env):
+    """
+    断片が揃っていない場合、結合タスクは masterdata を作らずに自身を再投入することをテストする。
+    """
+    env = fetch_workflow_env
+    dispatched = []
+    dispatcher = LocalTaskDispatcher(lambda kind, data: dispatched.append((kind, data)))
+    env.shards[("20250211_120000_0900", 0)] = MstBooks({}).model_dump_json()
+    task = workflows.MergeShardsTask(rss_sig="20250211_120000_0900", shards=2)
+
+    assert not workflows.exec_merge_shards_workflow(task, dispatcher)
+    assert env.combined == {}
+    dispatcher.run_until_empty()
+    assert dispatched[0][0] == workflows.KIND_LATEST_ALL_MERGE
+    assert dispatched[0][1]["attempt"] == 1
+
+    # 最大回数に達したら、Cloud Tasks が再配信しないように例外にせず終える
+    dispatched.clear()
+    assert not workflows.exec_merge_shards_workflow(
+        task.model_copy(update={"attempt": 9}), dispatcher, max_attempts=10
+    )
+    dispatcher.run_until_empty()
+    assert dispatched == []
+    assert env.combined == {}
+
+
+def test_merge_shards_publishes_once_for_duplicate_delivery(fetch_workflow_env):
+    """
+    結合タスクが重複して配信されても、masterdata の公開とラジオ番組の作成は1回だけ行うことをテストする。
+    """
+    env = fetch_workflow_env
+    dispatcher = LocalTaskDispatcher(lambda kind, data: None)
+    broadcasted_at = datetime(2025, 2, 12, 6, 0, 0, tzinfo=ZoneInfo("Asia/Tokyo"))
+    task = workflows.MergeShardsTask(
+        rss_sig="20250211_120000_0900", shards=1, broadcasted_at=broadcasted_at
+    )
+    shard = MstBooks({}).model_dump_json()
+
+    env.shards[(task.rss_sig, 0)] = shard
+    assert workflows.exec_merge_shards_workflow(task, dispatcher)
+    env.shards[(task.rss_sig, 0)] = shard
+    assert not workflows.exec_merge_shards_workflow(task, dispatcher)
+
+    assert len(env.radio_shows) == 1
+    assert env.published == {(task.rss_sig, "20250212_060000"): "done"}
+    # 公開しなかった場合も、断片は削除する
+    assert env.shards == {}
+
+
+def test_merge_shards_releases_publish_on_failure(fetch_workflow_env, monkeypatch):
+    """
+    公開に失敗した場合は marker を外して、再配信で公開し直せることをテストする。
+    """
+    env = fetch_workflow_env
+    dispatcher = LocalTaskDispatcher(lambda kind, data: None)
+    task = workflows.MergeShardsTask(rss_sig="20250211_120000_0900", shards=1)
+    env.shards[(task.rss_sig, 0)] = MstBooks({}).model_dump_json()
+    monkeypatch.setattr(workflows, "put_masterdata_index", lambda signature, s: None)
+
+    with pytest.raises(ValueError):
+        workflows.exec_merge_shards_workflow(task, dispatcher)
+    assert env.published == {}
+    assert env.radio_shows == []
+    # 断片は残るので、再配信で結合し直せる
+    assert (task.rss_sig, 0) in env.shards
+
+
+def test_masterdata_ndjson_filters_books_by_date():
+    """
+    NDJSON 形式の masterdata から、published (JST) が対象日の書籍だけを取り出せることをテストする。
+    対象日以外の行は MstBook として検証しない。
+    """
+    utc = ZoneInfo("UTC")
+    mst_map = {
+        f"link{i}": MstBook(
+            title=f"Book {i}",
+            summary="",
+            isbn=str(i),
+            jp_e_code="",
+            link=f"link{i}",
+            thumbnail_link="",
+            # JST では 2/10, 2/11, 2/11, 2/12
+            published=published,
+        )
+        for i, published in enumerate(
+            [
+                datetime(2025, 2, 10, 10, 0, 0, tzinfo=utc),
+                datetime(2025, 2, 10, 15, 0, 0, tzinfo=utc),
+                datetime(2025, 2, 11, 14, 0, 0, tzinfo=utc),
+                datetime(2025, 2, 11, 15, 0, 0, tzinfo=utc),
+            ]
+        )
+    }
+    lines = [
+        workflows.to_masterdata_ndjson_line(book).encode("utf-8")
+        for book in mst_map.values()
+    ]
+    assert all(line.startswith(b'{"date":"') for line in lines)
+    # 対象日以外の行は壊れていても読み飛ばす
+    lines[0] = lines[0][:30]
+
+    books = list(
+        workflows.iter_masterdata_books_for_date(lines, datetime(2025, 2, 11).date())
+    )
+    assert [b.link for b in books] == ["link1", "link2"]
+    assert books[0] == mst_map["link1"]
+
+    # キーの順序が異なる行も日付で絞り込める
+    other_order = json.dumps(
+        {"book": json.loads(mst_map["link3"].model_dump_json()), "date": "2025-02-12"}
+    ).encode("utf-8")
+    books = list(
+        workflows.iter_masterdata_books_for_date(
+            [other_order], datetime(2025, 2, 12).date()
+        )
+    )
+    assert [b.link for b in books] == ["link3"]
+
+
+def test_partition_masterdata_lines_by_published_date():
+    """
+    masterdata を published (JST) の日付ごとに分け、日付ごとには元の順序を保つことをテストする。
+    """
+    utc = ZoneInfo("UTC")
+    published = [
+        datetime(2025, 2, 10, 15, 0, 0, tzinfo=utc),  # JST 2/11
+        datetime(2025, 2, 10, 14, 0, 0, tzinfo=utc),  # JST 2/10
+        datetime(2025, 2, 11, 3, 0, 0, tzinfo=utc),  # JST 2/11
+    ]
+    mst_map = {
+        f"link{i}": MstBook(
+            title=f"Book {i}",
+            summary="",
+            isbn=str(i),
+            jp_e_code="",
+            link=f"link{i}",
+            thumbnail_link="",
+            published=p,
+        )
+        for i, p in enumerate(published)
+    }
+
+    partitions = workflows.partition_masterdata_lines(mst_map)
+
+    assert sorted(partitions) == ["20250210", "20250211"]
+    assert [b.link for b in _combined_books(partitions["20250211"]).root.values()] == [
+        "link0",
+        "link2",
+    ]
+    assert _combined_books(partitions["20250210"]).root["link1"] == mst_map["link1"]
+
+
+def test_exec_run_agent_reads_only_target_date_partition(monkeypatch):
+    """
+    日付ごとに分割した masterdata では、索引から対象日の masterdata だけを取得することをテストする。
+    対象日の書籍がなければ masterdata は取得しない。
+    """
+    book = MstBook(
+        title="Target",
+        summary="",
+        isbn="1",
+        jp_e_code="",
+        link="link-target",
+        thumbnail_link="",
+        published=datetime(2025, 2, 11, 3, 0, 0, tzinfo=ZoneInfo("UTC")),
+    )
+    partitions = workflows.partition_masterdata_lines({book.link: book})
+    index = workflows.MasterdataIndex(
+        signature="20250211_120000_0900", dates={"20250211": 1}
+    )
+    index_path = "private/masterdata/20250211_120000_0900/_index.json"
+    monkeypatch.setattr(
+        workflows, "get_json_file", lambda path: index.model_dump_json()
+    )
+    read_paths = []
+
+    def fake_iter_cached_ndjson_file(path):
+        read_paths.append(path)
+        return iter(line.encode("utf-8") for line in partitions["20250211"])
+
+    monkeypatch.setattr(
+        workflows, "iter_cached_ndjson_file", fake_iter_cached_ndjson_file
+    )
+
+    class StopAfterLoad(Exception):
+        pass
+
+    contexts = []
+
+    def fake_call_agent_with_dataset(llm_context):
+        contexts.append(llm_context)
+        raise StopAfterLoad()
+
+    monkeypatch.setattr(
+        workflows.agent, "call_agent_with_dataset", fake_call_agent_with_dataset
+    )
+
+    with pytest.raises(StopAfterLoad):
+        workflows.exec_run_agent_and_tts_workflow(
+            "radio-show-id",
+            index_path,
+            datetime(2025, 2, 11, 12, 0, 0, tzinfo=ZoneInfo("Asia/Tokyo")),
+        )
+    assert read_paths == ["private/masterdata/20250211_120000_0900/20250211.ndjson"]
+    assert "title:Target" in contexts[0]
+
+    # 索引にない日付は masterdata を取得せずに終了する
+    workflows.exec_run_agent_and_tts_workflow(
+        "radio-show-id",
+        index_path,
+        datetime(2025, 2, 12, 12, 0, 0, tzinfo=ZoneInfo("Asia/Tokyo")),
+    )
+    assert len(read_paths) == 1
+    assert len(contexts) == 1
+
+
+def test_exec_run_agent_streams_script_into_tts(monkeypatch):
+    """
+    LLM_STREAMING では、台本を受け取りながら文ごとに読み上げ、音声を文の順につなげてアップロードすることをテストする。
+    """
+    book = MstBook(
+        title="Target",
+        summary="",
+        isbn="1",
+        jp_e_code="",
+        link="link-target",
+        thumbnail_link="",
+        published=datetime(2025, 2, 11, 3, 0, 0, tzinfo=ZoneInfo("UTC")),
+    )
+    lines = [workflows.to_masterdata_ndjson_line(book).encode("utf-8")]
+    index = workflows.MasterdataIndex(
+        signature="20250211_120000_0900", dates={"20250211": 1}
+    )
+    monkeypatch.setattr(
+        workflows, "get_json_file", lambda path: index.model_dump_json()
+    )
+    monkeypatch.setattr(workflows, "iter_cached_ndjson_file", lambda path: iter(lines))
+    monkeypatch.setattr(workflows.agent, "LLM_STREAMING", True)
+    chunks = [
+        "<think>考え</think><scr",
+        "ipt>一つ目の文です。二つ",
+        "目の文です。</script>",
+    ]
+    monkeypatch.setattr(
+        workflows.agent,
+        "stream_script_with_dataset",
+        lambda llm_context: iter(chunks),
+    )
+    monkeypatch.setattr(workflows.agent, "SENTENCE_MIN_CHARS", 1)
+
+    def fail_call_agent_with_dataset(llm_context):
+        raise AssertionError("call_agent_with_dataset should not be called")
+
+    monkeypatch.setattr(
+        workflows.agent, "call_agent_with_dataset", fail_call_agent_with_dataset
+    )
+    synthesized = []
+
+    def fake_synthesize(text):
+        synthesized.append(text)
+        return SimpleNamespace(audio_content=f"[{text}]".encode())
+
+    monkeypatch.setattr(workflows.tts_google, "synthesize", fake_synthesize)
+    uploaded = {}
+    monkeypatch.setattr(
+        workflows,
+        "put_tts_script_file",
+        lambda radio_show_id, script: (
+            uploaded.update(script=script) or SimpleNamespace(public_url="script-url")
+        ),
+    )
+    monkeypatch.setattr(
+        workflows,
+        "put_tts_audio_file",
+        lambda radio_show_id, bs: (
+            uploaded.update(audio=bs.read()) or SimpleNamespace(public_url="audio-url")
+        ),
+    )
+    published = []
+    monkeypatch.setattr(
+        workflows.entity_radio_show,
+        "publish",
+        lambda *args, **kwargs: published.append(args),
+    )
+
+    workflows.exec_run_agent_and_tts_workflow(
+        "radio-show-id",
+        "private/masterdata/20250211_120000_0900/_index.json",
+        datetime(2025, 2, 11, 12, 0, 0, tzinfo=ZoneInfo("Asia/Tokyo")),
+    )
+
+    assert uploaded["script"] == "一つ目の文です。二つ目の文です。"
+    assert sorted(synthesized) == sorted(["一つ目の文です。", "二つ目の文です。"])
+    assert uploaded["audio"] == "[一つ目の文です。][二つ目の文です。]".encode()
+    assert published[0][:3] == ("radio-show-id", "audio-url", "script-url")
+
+
+def test_gc_cache_async_task(monkeypatch):
+    """/async_task の gc_cache で RSS と LLM の応答のキャッシュと、masterdata の作成途中のファイルの GC を実行することをテストする"""
+    calls = []
+
+    def fake_gc_cache_blobs(prefix, key_func, dry_run=False):
+        calls.append((prefix, key_func, dry_run))
+        return workflows.CacheGcResult(prefix=prefix, deleted=1, reclaimed_bytes=10)
+
+    def fake_gc_llm_response_cache(dry_run=False):
+        calls.append(("llm", dry_run))
+        return workflows.CacheGcResult(prefix="llm", deleted=1, reclaimed_bytes=10)
+
+    monkeypatch.setattr(workflows, "gc_cache_blobs", fake_gc_cache_blobs)
+
+    def fake_gc_masterdata_work_blobs(base_dir, max_age_days, dry_run=False):
+        calls.append((base_dir, max_age_days, dry_run))
+        return workflows.CacheGcResult(prefix=base_dir)
+
+    monkeypatch.setattr(workflows, "gc_llm_response_cache", fake_gc_llm_response_cache)
+    monkeypatch.setattr(
+        workflows, "gc_masterdata_work_blobs", fake_gc_masterdata_work_blobs
+    )
+
+    main_module.handle_async_task(main_module.KIND_GC_CACHE, {"dry_run": True})
+
+    assert calls == [
+        (workflows.RSS_RAW_DIR, workflows.rss_cache_key, True),
+        ("llm", True),
+        (
+            workflows.MASTERDATA_CHECKPOINT_DIR,
+            workflows.MASTERDATA_WORK_RETENTION_DAYS,
+            True,
+        ),
+        (
+            workflows.MASTERDATA_SHARD_DIR,
+            workflows.MASTERDATA_WORK_RETENTION_DAYS,
+            True,
+        ),
+        (
+            workflows.MASTERDATA_PUBLISH_DIR,
+            workflows.MASTERDATA_PUBLISH_RETENTION_DAYS,
+            True,
+        ),
+    ]
+
+
+def test_cloud_tasks_client_is_created_on_first_dispatch(monkeypatch):
+    """Cloud Tasks のクライアントは import 時や dispatcher の作成時ではなく、最初の投入時に作る"""
+    created = []
+    created_tasks = []
+
+    class FakeCloudTasksClient:
+        def __init__(self):
+            created.append(self)
+
+        def queue_path(self, project_id, location, queue):
+            return f"{project_id}/{location}/{queue}"
+
+        def create_task(self, request):
+            created_tasks.append(request)
+            return request.task
+
+    monkeypatch.setattr(
+        async_task_google.tasks, "CloudTasksClient", FakeCloudTasksClient
+    )
+    monkeypatch.setattr(async_task_google, "_cloudtasks_client", None)
+    monkeypatch.setattr(main_module, "task_dispatcher", None)
+
+    dispatcher = main_module.get_task_dispatcher()
+    assert main_module.get_task_dispatcher() is dispatcher
+    assert created == []
+
+    dispatcher.dispatch("dummy", {"a": 1})
+    dispatcher.dispatch("dummy", {"a": 2})
+    assert len(created) == 1
+    assert len(created_tasks) == 2
+
+
+def test_task_dispatcher_without_dispatch_cannot_be_created():
+    """dispatch を実装していない dispatcher は、最初のタスクではなく作成時に失敗する"""
+
+    class IncompleteDispatcher(TaskDispatcher):
+        pass
+
+    with pytest.raises(TypeError):
+        IncompleteDispatcher()  # type: ignore[abstract]
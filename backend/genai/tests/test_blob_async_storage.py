@@ -0,0 +1,77 @@
+import asyncio
+import threading
+import time
+
+from src.blob import async_storage
+from src.blob import storage as gcs_module
+from tests.test_blob_storage import FakeBucket
+
+
+def test_async_storage_uses_same_paths(monkeypatch):
+    """async 版でも同期版と同じパスにアップロードし、同じファイルを読み出せる"""
+    bucket = FakeBucket()
+    monkeypatch.setattr(gcs_module, "_get_bucket", lambda: bucket)
+
+    async def run():
+        blob = await async_storage.put_combined_json_file("sig", '{"a": 1}')
+        return blob, await async_storage.get_json_file(blob.name)
+
+    blob, json_str = asyncio.run(run())
+    assert blob.name == "private/masterdata/sig.json"
+    assert json_str == '{"a": 1}'
+    async_storage.shutdown_executor()
+
+
+def test_async_upload_blob_string_keeps_metadata(monkeypatch):
+    """async 版のアップロードでも、同期版と同じパスと metadata で置く"""
+    bucket = FakeBucket()
+    monkeypatch.setattr(gcs_module, "_get_bucket", lambda: bucket)
+
+    blob = asyncio.run(
+        async_storage.upload_blob_string(
+            "private/x.json", "{}", {"Cache-Control": "no-store"}, "application/json"
+        )
+    )
+    assert blob.name == "private/x.json"
+    assert blob.metadata == {"Cache-Control": "no-store"}
+    async_storage.shutdown_executor()
+
+
+def test_async_storage_runs_concurrently_without_blocking_loop(monkeypatch):
+    """複数の blob 操作を gather で並行に待て、その間もイベントループは止まらない"""
+    lock = threading.Lock()
+    running = {"count": 0, "max": 0}
+
+    def slow_get_json_file(blob_path: str) -> str:
+        with lock:
+            running["count"] += 1
+            running["max"] = max(running["max"], running["count"])
+        time.sleep(0.05)
+        with lock:
+            running["count"] -= 1
+        return blob_path
+
+    monkeypatch.setattr(gcs_module, "get_json_file", slow_get_json_file)
+
+    async def run():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.005)
+
+        task = asyncio.create_task(ticker())
+        results = await asyncio.gather(
+            *(async_storage.get_json_file(f"path/{i}") for i in range(4))
+        )
+        task.cancel()
+        return results, ticks
+
+    results, ticks = asyncio.run(run())
+    assert results == [f"path/{i}" for i in range(4)]
+    assert running["max"] > 1
+    # I/O の間もループが回っている
+    assert ticks > 1
+    async_storage.shutdown_executor()
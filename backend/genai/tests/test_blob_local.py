@@ -0,0 +1,132 @@
+import gzip
+import io
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+from src.blob import storage as gcs_module
+from src.blob.local import LocalBucket
+
+
+@pytest.fixture
+def local_bucket(tmp_path, monkeypatch):
+    """blob.storage の保存先をローカルディスクにする"""
+    bucket = LocalBucket(tmp_path)
+    monkeypatch.setattr(gcs_module, "_get_bucket", lambda: bucket)
+    return bucket
+
+
+def test_upload_and_download_keep_metadata(tmp_path):
+    """内容と metadata を保存し、別のインスタンスからも同じように読み出せる"""
+    bucket = LocalBucket(tmp_path)
+    blob = bucket.blob("private/a/b.json")
+    blob.metadata = {"custom_time": "2025-02-09T00:00:00+00:00"}
+    blob.upload_from_string('{"a":1}', content_type="application/json")
+    assert blob.generation is not None
+    assert blob.time_created is not None
+
+    reopened = LocalBucket(tmp_path).get_blob("private/a/b.json")
+    assert reopened is not None
+    assert reopened.download_as_bytes() == b'{"a":1}'
+    assert reopened.metadata == {"custom_time": "2025-02-09T00:00:00+00:00"}
+    assert reopened.content_type == "application/json"
+    assert reopened.generation == blob.generation
+    assert reopened.time_created == blob.time_created
+    # 一時ファイルは残らない
+    assert [p.name for p in (tmp_path / "objects" / "private" / "a").iterdir()] == [
+        "b.json"
+    ]
+
+
+def test_generation_match_and_missing_objects(tmp_path):
+    """if_generation_match は GCS と同じく、0 は存在しないこと、それ以外は現在の generation と一致することを要求する"""
+    bucket = LocalBucket(tmp_path)
+    blob = bucket.blob("x.json")
+    blob.upload_from_string("1", if_generation_match=0)
+    first = blob.generation
+    with pytest.raises(PreconditionFailed):
+        bucket.blob("x.json").upload_from_string("2", if_generation_match=0)
+    bucket.blob("x.json").upload_from_string("2", if_generation_match=first)
+    assert bucket.get_blob("x.json").generation > first
+
+    # 古い generation を指定した読み出しは NotFound
+    with pytest.raises(NotFound):
+        bucket.blob("x.json", generation=first).download_as_bytes()
+    assert bucket.get_blob("missing.json") is None
+    with pytest.raises(NotFound):
+        bucket.blob("missing.json").download_as_bytes()
+    bucket.blob("x.json").delete()
+    with pytest.raises(NotFound):
+        bucket.blob("x.json").delete()
+    with pytest.raises(ValueError):
+        bucket.blob("../outside.json").upload_from_string("x")
+
+
+def test_list_blobs_by_string_prefix(tmp_path):
+    """prefix はディレクトリの区切りに関係なく前方一致で、名前の順に返す"""
+    bucket = LocalBucket(tmp_path)
+    for name in [
+        "private/rss/latest_all_30/20250209_120000_0900.xml",
+        "private/rss/latest_all_30/20250209_090000_0900.xml",
+        "private/rss/latest_all_30/20250210_090000_0900.xml",
+        "private/rss/latest_all_300/20250209_090000_0900.xml",
+    ]:
+        bucket.blob(name).upload_from_string(name)
+
+    names = [
+        b.name for b in bucket.list_blobs(prefix="private/rss/latest_all_30/20250209")
+    ]
+    assert names == [
+        "private/rss/latest_all_30/20250209_090000_0900.xml",
+        "private/rss/latest_all_30/20250209_120000_0900.xml",
+    ]
+    assert len(list(bucket.list_blobs(prefix="private/rss/latest_all_30"))) == 4
+    blobs = list(bucket.list_blobs(prefix="private/", max_results=2))
+    assert len(blobs) == 2
+    assert all(b.time_created is not None for b in blobs)
+
+
+def test_gzip_content_encoding(tmp_path):
+    """gzip で保存したものは、raw_download なら圧縮したまま、そうでなければ展開して読める"""
+    bucket = LocalBucket(tmp_path)
+    blob = bucket.blob("c.json")
+    blob.content_encoding = "gzip"
+    blob.upload_from_file(io.BytesIO(gzip.compress(b"hello\nworld\n")))
+
+    assert bucket.blob("c.json").download_as_bytes() == b"hello\nworld\n"
+    raw = bucket.blob("c.json").download_as_bytes(raw_download=True)
+    assert gzip.decompress(raw) == b"hello\nworld\n"
+    with bucket.blob("c.json").open("rb") as stream:
+        assert list(stream) == [b"hello\n", b"world\n"]
+
+
+def test_storage_functions_on_local_backend(local_bucket):
+    """blob.storage の関数が、ローカルディスクの backend でも GCS と同じように動く"""
+    lines = ['{"date":"2025-02-11","n":1}']
+    blob = gcs_module.put_masterdata_partition("sig", "20250211", lines)
+    assert list(gcs_module.iter_cached_ndjson_file(blob.name)) == [lines[0].encode()]
+
+    gcs_module.put_rss_xml_file(
+        datetime(2025, 2, 9, 12, 0, 0, tzinfo=ZoneInfo("Asia/Tokyo")),
+        "latest_all",
+        io.BytesIO(b"<rss></rss>"),
+        "30",
+        etag='"v1"',
+    )
+    cached = gcs_module.get_closest_cached_rss_file(
+        datetime(2025, 2, 9, 5, 0, 0, tzinfo=ZoneInfo("UTC")), "latest_all", "30"
+    )
+    assert cached is not None
+    assert cached.read() == b"<rss></rss>"
+
+    index = gcs_module.OaiPmhCacheIndex()
+    blob = gcs_module.put_oai_pmh_json("9784621310328", "isbn", '{"a":1}')
+    index.record("isbn", "9784621310328", blob)
+    assert index.flush() == 1
+    result = gcs_module.get_cached_oai_pmh_file_with_index(
+        gcs_module.OaiPmhCacheIndex(), "9784621310328", "isbn"
+    )
+    assert result is not None
+    assert result.read() == b'{"a":1}'
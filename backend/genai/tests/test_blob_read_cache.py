@@ -0,0 +1,53 @@
+from src.blob.read_cache import BlobReadCache
+
+
+def test_memory_and_disk_tiers(tmp_path):
+    """メモリになくてもディスクから読め、generation が違うものは別のものとして扱う"""
+    cache = BlobReadCache(tmp_path, memory_max_bytes=1024, disk_max_bytes=1024)
+    cache.put("private/masterdata/a.json", 1, b"one")
+    assert cache.get("private/masterdata/a.json", 1) == b"one"
+    assert cache.get("private/masterdata/a.json", 2) is None
+    assert cache.get("private/masterdata/b.json", 1) is None
+
+    reopened = BlobReadCache(tmp_path, memory_max_bytes=1024, disk_max_bytes=1024)
+    assert reopened.get("private/masterdata/a.json", 1) == b"one"
+    # 一時ファイルは残らない
+    assert not [p for p in tmp_path.iterdir() if p.name.startswith(".tmp_")]
+
+
+def test_evicts_least_recently_used(tmp_path):
+    """上限を超えたら、最も長く使っていないものから追い出す"""
+    cache = BlobReadCache(tmp_path, memory_max_bytes=8, disk_max_bytes=8)
+    cache.put("a", 1, b"aaaa")
+    cache.put("b", 1, b"bbbb")
+    # a を使ったので、次に追い出すのは b
+    assert cache.get("a", 1) == b"aaaa"
+    cache.put("c", 1, b"cccc")
+
+    assert cache.get("a", 1) == b"aaaa"
+    assert cache.get("b", 1) is None
+    assert cache.get("c", 1) == b"cccc"
+    assert len(list(tmp_path.iterdir())) == 2
+
+    # 上限より大きいものは置かない
+    cache.put("d", 1, b"ddddddddd")
+    assert cache.get("d", 1) is None
+    assert cache.get("a", 1) == b"aaaa"
+
+
+def test_memory_only(tmp_path):
+    """ディレクトリを指定しなければメモリにだけ置く"""
+    cache = BlobReadCache(None, memory_max_bytes=1024, disk_max_bytes=1024)
+    cache.put("a", 1, b"aaaa")
+    assert cache.get("a", 1) == b"aaaa"
+    assert BlobReadCache(None, 1024, 1024).get("a", 1) is None
+
+
+def test_contains_any_generation(tmp_path):
+    """メモリとディスクのどちらかに、いずれかの generation があれば保持している"""
+    cache = BlobReadCache(tmp_path, memory_max_bytes=0, disk_max_bytes=1024)
+    assert not cache.contains("a")
+    cache.put("a", 3, b"aaaa")
+    assert cache.contains("a")
+    assert not cache.contains("b")
+    assert BlobReadCache(None, 1024, 0).contains("a") is False
@@ -1,11 +1,20 @@
+import gzip
 import io
 import os
+import threading
+import time
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
 import pytest
+import requests
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage as gcs
 
 from src.blob import storage as gcs_module
+from src.blob.local import LocalBucket
+from src.blob.read_cache import BlobReadCache
 
 
 class FakeBlob:
@@ -13,6 +22,9 @@ class FakeBlob:
         self.name = name
         self.metadata = {}
         self.time_created = time_created
+        self.generation = None
+        self.size = len(content) if content is not None else None
+        self.content_encoding = None
         self._content = content  # バイト列で保持
 
     def download_as_string(self):
@@ -20,13 +32,28 @@ class FakeBlob:
             raise Exception("No content")
         return self._content
 
-    def download_to_file(self, file_obj: io.BytesIO):
+    def download_as_bytes(self, raw_download=False):
+        if self._content is None:
+            raise NotFound("No content")
+        return self._content
+
+    def open(self, mode="rb", raw_download=False):
+        return io.BytesIO(self.download_as_string())
+
+    def download_to_file(self, file_obj: io.BytesIO, raw_download=False):
         if self._content is None:
             raise Exception("No content")
         file_obj.write(self._content)
 
-    def upload_from_string(self, s, content_type=None, predefined_acl=None):
+    def upload_from_string(
+        self, s, content_type=None, predefined_acl=None, if_generation_match=None
+    ):
+        if if_generation_match is not None and if_generation_match != (
+            self.generation or 0
+        ):
+            raise PreconditionFailed("generation mismatch")
         self._content = s.encode("utf-8")
+        self.generation = (self.generation or 0) + 1
 
     def upload_from_file(self, file, content_type=None, predefined_acl=None):
         file.seek(0)
@@ -37,8 +64,9 @@ class FakeBucket:
     def __init__(self):
         # 辞書形式で blob_path -> FakeBlob を保持
         self._blobs = {}
+        self.list_calls = []
 
-    def blob(self, blob_path: str) -> FakeBlob:
+    def blob(self, blob_path: str, generation=None) -> FakeBlob:
         if blob_path in self._blobs:
             return self._blobs[blob_path]
         else:
@@ -46,7 +74,14 @@ class FakeBucket:
             self._blobs[blob_path] = new_blob
             return new_blob
 
-    def list_blobs(self, prefix: str, max_results=None):
+    def get_blob(self, blob_path: str):
+        blob = self._blobs.get(blob_path)
+        if blob is None or blob._content is None:
+            return None
+        return blob
+
+    def list_blobs(self, prefix: str, max_results=None, **kwargs):
+        self.list_calls.append({"prefix": prefix, "max_results": max_results, **kwargs})
         # prefix で始まる blob を抽出
         results = [
             blob for name, blob in self._blobs.items() if name.startswith(prefix)
@@ -65,6 +100,8 @@ def fake_bucket(monkeypatch):
     """
     bucket = FakeBucket()
     monkeypatch.setattr(gcs_module, "_get_bucket", lambda: bucket)
+    # 読み出しのキャッシュをテストごとに空にする
+    monkeypatch.setattr(gcs_module, "_read_cache", BlobReadCache(None, 1024 * 1024, 0))
     return bucket
 
 
@@ -85,8 +122,9 @@ def test_put_combined_json_file(fake_bucket, fixed_now, monkeypatch):
     assert blob.name == expected_blob_path, "Blob のパスが正しく生成されている"
     # メタデータにキャッシュ設定等が含まれていることをチェック
     assert blob.metadata.get("Cache-Control") == "public, max-age=300"
-    # アップロードしたコンテンツが正しく保存されている
-    assert blob._content == json_str.encode("utf-8")
+    # アップロードしたコンテンツが gzip で圧縮して保存されている
+    assert blob.content_encoding == "gzip"
+    assert gzip.decompress(blob._content) == json_str.encode("utf-8")
 
 
 def test_get_json_file(fake_bucket):
@@ -102,6 +140,34 @@ def test_get_json_file(fake_bucket):
     assert result == test_content, "取得した JSON の内容が一致する"
 
 
+def test_get_json_file_reads_compressed_and_uncompressed(fake_bucket, monkeypatch):
+    """gzip で保存した masterdata も、圧縮していない既存の masterdata も読み出せる"""
+    json_str = '{"key": "値"}'
+    blob = gcs_module.put_combined_json_file("compressed", json_str)
+    assert gcs_module.get_json_file(blob.name) == json_str
+
+    monkeypatch.setattr(gcs_module, "BLOB_JSON_COMPRESSION", "none")
+    blob = gcs_module.put_combined_json_file("uncompressed", json_str)
+    assert blob.content_encoding is None
+    assert blob._content == json_str.encode("utf-8")
+    assert gcs_module.get_json_file(blob.name) == json_str
+
+
+def test_put_masterdata_partition_and_index(fake_bucket):
+    """日付ごとの masterdata と索引を signature のディレクトリ以下に置く"""
+    blob = gcs_module.put_masterdata_partition("sig", "20250211", ['{"n":1}'])
+    assert blob.name == f"{gcs_module.MASTERDATA_DIR}/sig/20250211.ndjson"
+    assert blob.content_encoding == "gzip"
+    assert list(gcs_module.iter_cached_ndjson_file(blob.name)) == [b'{"n":1}']
+
+    index_blob = gcs_module.put_masterdata_index("sig", '{"signature":"sig"}')
+    assert index_blob.name == gcs_module.masterdata_index_path("sig")
+    assert index_blob.name == f"{gcs_module.MASTERDATA_DIR}/sig/_index.json"
+    assert gcs_module.get_json_file(index_blob.name) == '{"signature":"sig"}'
+    with pytest.raises(ValueError):
+        gcs_module.put_masterdata_partition("sig", "20250211", [])
+
+
 def test_put_tts_audio_file(fake_bucket):
     signature = "audio_test"
     file_content = b"audio data"
@@ -134,6 +200,9 @@ def test_put_rss_xml_file(fake_bucket, monkeypatch):
     assert blob._content == xml_content.encode("utf-8"), (
         "XML の内容が正しくアップロードされている"
     )
+    # signature で同じファイルを読める
+    cached = gcs_module.get_rss_xml_file_by_signature(signature, prefix_dir, suffix_dir)
+    assert cached is not None and cached.read() == xml_content.encode("utf-8")
 
 
 def test_put_oai_pmh_json(fake_bucket, fixed_now, monkeypatch):
@@ -145,8 +214,8 @@ def test_put_oai_pmh_json(fake_bucket, fixed_now, monkeypatch):
     blob = gcs_module.put_oai_pmh_json(signature, prefix_dir, json_str)
     expected_blob_path = f"{gcs_module.OAI_PMH_RAW_DIR}/{prefix_dir}/{signature}.json"
     assert blob.name == expected_blob_path, "OAI-PMH JSON のパスが正しい"
-    assert blob._content == json_str.encode("utf-8"), (
-        "JSON の内容が正しくアップロードされている"
+    assert gzip.decompress(blob._content) == json_str.encode("utf-8"), (
+        "JSON の内容が gzip で圧縮してアップロードされている"
     )
 
 
@@ -184,6 +253,105 @@ def test_get_closest_cached_rss_file(fake_bucket):
     assert result_content == b"new rss content"
 
 
+def test_put_rss_xml_file_updates_latest_pointer(fake_bucket):
+    """RSS をアップロードすると _latest.json が最新のキャッシュを指し、古いキャッシュでは上書きしない"""
+    jst = ZoneInfo("Asia/Tokyo")
+    newer = gcs_module.put_rss_xml_file(
+        datetime(2025, 2, 9, 12, 0, 0, tzinfo=jst),
+        "latest_all",
+        io.BytesIO(b"<rss>new</rss>"),
+        "30",
+        etag='"v2"',
+    )
+    pointer = gcs_module.get_rss_validators("latest_all", "30")
+    assert pointer is not None
+    assert pointer.blob_name == newer.name
+    assert pointer.etag == '"v2"'
+
+    # 後からアップロードされても、古い lastBuildDate のキャッシュは pointer にしない
+    gcs_module.put_rss_xml_file(
+        datetime(2025, 2, 9, 9, 0, 0, tzinfo=jst),
+        "latest_all",
+        io.BytesIO(b"<rss>old</rss>"),
+        "30",
+        etag='"v1"',
+    )
+    pointer = gcs_module.get_rss_validators("latest_all", "30")
+    assert pointer is not None
+    assert pointer.blob_name == newer.name
+    assert pointer.etag == '"v2"'
+
+
+def test_put_rss_validators_retries_on_concurrent_update(fake_bucket, monkeypatch):
+    """pointer の更新が他と競合した場合は、読み直して更新し直す"""
+    pointer_path = f"{gcs_module.RSS_RAW_DIR}/latest_all_30/_latest.json"
+    original_get_blob = fake_bucket.get_blob
+    calls = {"count": 0}
+
+    def racing_get_blob(blob_path):
+        blob = original_get_blob(blob_path)
+        calls["count"] += 1
+        if calls["count"] == 1:
+            # 読み出した直後に、他のワークフローが pointer を更新する
+            fake_bucket.blob(pointer_path).upload_from_string(
+                gcs_module.RssCacheValidators(
+                    blob_name=f"{gcs_module.RSS_RAW_DIR}/latest_all_30/20250209_090000_0900.xml"
+                ).model_dump_json()
+            )
+        return blob
+
+    monkeypatch.setattr(fake_bucket, "get_blob", racing_get_blob)
+    validators = gcs_module.RssCacheValidators(
+        blob_name=f"{gcs_module.RSS_RAW_DIR}/latest_all_30/20250209_120000_0900.xml"
+    )
+
+    assert gcs_module.put_rss_validators("latest_all", "30", validators) is not None
+    assert calls["count"] == 2
+    assert gcs_module.get_rss_validators("latest_all", "30") == validators
+
+
+def test_get_closest_cached_rss_file_uses_latest_pointer(fake_bucket):
+    """pointer があれば一覧せずに最新のキャッシュを取得し、別の日のキャッシュなら None を返す"""
+
+    def fail_list_blobs(prefix, max_results=None):
+        raise AssertionError("list_blobs should not be called")
+
+    fake_bucket.list_blobs = fail_list_blobs
+    gcs_module.put_rss_xml_file(
+        datetime(2025, 2, 9, 12, 0, 0, tzinfo=ZoneInfo("Asia/Tokyo")),
+        "latest_all",
+        io.BytesIO(b"<rss>latest</rss>"),
+        "30",
+    )
+
+    result = gcs_module.get_closest_cached_rss_file(
+        datetime(2025, 2, 9, 5, 0, 0, tzinfo=ZoneInfo("UTC")), "latest_all", "30"
+    )
+    assert result is not None
+    assert result.read() == b"<rss>latest</rss>"
+    assert (
+        gcs_module.get_closest_cached_rss_file(
+            datetime(2025, 2, 10, 5, 0, 0, tzinfo=ZoneInfo("UTC")), "latest_all", "30"
+        )
+        is None
+    )
+
+
+def test_get_closest_cached_rss_file_without_pointer_scans_whole_day(fake_bucket):
+    """pointer がない場合は同日のキャッシュを全て一覧し、11件以上あっても最新を見つける"""
+    prefix_base = f"{gcs_module.RSS_RAW_DIR}/latest_all_non"
+    for hour in range(12):
+        blob = fake_bucket.blob(f"{prefix_base}/20250209_{hour:02d}0000_0900.xml")
+        blob.time_created = datetime(2025, 2, 9, hour, 0, 0, tzinfo=ZoneInfo("UTC"))
+        blob._content = f"rss {hour}".encode()
+
+    result = gcs_module.get_closest_cached_rss_file(
+        datetime(2025, 2, 9, 0, 0, 0, tzinfo=ZoneInfo("UTC")), "latest_all"
+    )
+    assert result is not None
+    assert result.read() == b"rss 11"
+
+
 def test_get_closest_cached_oai_pmh_file(fake_bucket, monkeypatch):
     target_isbn = "9784621310328"
     prefix_dir = "isbn"
@@ -211,3 +379,587 @@ def test_get_closest_cached_oai_pmh_file(fake_bucket, monkeypatch):
     assert result_io is not None, "有効な OAI-PMH キャッシュが取得できる"
     result_content = result_io.read()
     assert result_content == b"new oai content"
+
+
+def test_oai_pmh_cache_index_lookup_without_listing(fake_bucket, monkeypatch):
+    """索引に記録した後は list_blobs を呼ばずにキャッシュを取得できること"""
+    fixed_now = datetime(2025, 2, 9, 0, 0, 0, tzinfo=ZoneInfo("UTC"))
+    monkeypatch.setattr(gcs_module, "get_now", lambda: fixed_now)
+    prefix_dir = "isbn"
+    target_isbn = "9784621310328"
+
+    blob = gcs_module.put_oai_pmh_json(target_isbn, prefix_dir, '{"a": 1}')
+    blob.time_created = datetime(2025, 2, 8, 0, 0, 0, tzinfo=ZoneInfo("UTC"))
+    index = gcs_module.OaiPmhCacheIndex()
+    index.record(prefix_dir, target_isbn, blob)
+    assert index.flush() == 1
+
+    def fail_list_blobs(*args, **kwargs):
+        raise AssertionError("list_blobs should not be called")
+
+    monkeypatch.setattr(fake_bucket, "list_blobs", fail_list_blobs)
+    # 新しい実行では索引を読み込み直す
+    index = gcs_module.OaiPmhCacheIndex()
+    result_io = gcs_module.get_cached_oai_pmh_file_with_index(
+        index, target_isbn, prefix_dir
+    )
+    assert result_io is not None
+    assert result_io.read() == b'{"a": 1}'
+
+    # 7日より古いものはキャッシュとして扱わない
+    monkeypatch.setattr(
+        gcs_module,
+        "get_now",
+        lambda: datetime(2025, 2, 20, 0, 0, 0, tzinfo=ZoneInfo("UTC")),
+    )
+    assert (
+        gcs_module.get_cached_oai_pmh_file_with_index(index, target_isbn, prefix_dir)
+        is None
+    )
+
+
+def test_oai_pmh_cache_index_loads_shards_without_global_lock(monkeypatch):
+    """別の shard は並行に読み込み、同じ shard は1度だけ読み込む"""
+    index = gcs_module.OaiPmhCacheIndex()
+    identifiers = {}
+    for i in range(100):
+        identifiers.setdefault(index._shard_of(str(i)), []).append(str(i))
+        if len(identifiers) == 2 and all(len(v) >= 2 for v in identifiers.values()):
+            break
+    (a, a2), (b, _) = [ids[:2] for ids in identifiers.values()][:2]
+    # 2つの shard の読み込みが同時に進まなければ待ちきれずに失敗する
+    barrier = threading.Barrier(2, timeout=5)
+    downloads = []
+
+    def fake_download_shard(prefix_dir, shard):
+        downloads.append(shard)
+        if len(downloads) <= 2:
+            barrier.wait()
+        return {}, 0
+
+    monkeypatch.setattr(
+        gcs_module.OaiPmhCacheIndex,
+        "_download_shard",
+        staticmethod(fake_download_shard),
+    )
+    errors = []
+
+    def lookup(identifier):
+        try:
+            index.lookup("isbn", identifier)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=lookup, args=(i,)) for i in [a, b, a2]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sorted(downloads) == sorted([index._shard_of(a), index._shard_of(b)])
+
+
+def test_oai_pmh_cache_index_refreshes_unchanged_content(fake_bucket, monkeypatch):
+    """期限切れのキャッシュでも内容が同じなら、アップロードせずに確認日時の更新だけで使えること"""
+    created = datetime(2025, 2, 1, 0, 0, 0, tzinfo=ZoneInfo("UTC"))
+    later = datetime(2025, 2, 20, 0, 0, 0, tzinfo=ZoneInfo("UTC"))
+    monkeypatch.setattr(gcs_module, "get_now", lambda: created)
+    prefix_dir = "isbn"
+    target_isbn = "9784621310328"
+    json_str = '{"a":1}'
+
+    blob = gcs_module.put_oai_pmh_json(target_isbn, prefix_dir, json_str)
+    blob.time_created = created
+    assert blob.metadata[
+        gcs_module.CONTENT_DIGEST_METADATA_KEY
+    ] == gcs_module.content_digest(json_str)
+    index = gcs_module.OaiPmhCacheIndex()
+    index.record(prefix_dir, target_isbn, blob)
+    index.flush()
+
+    monkeypatch.setattr(gcs_module, "get_now", lambda: later)
+    index = gcs_module.OaiPmhCacheIndex()
+    assert (
+        gcs_module.get_cached_oai_pmh_file_with_index(index, target_isbn, prefix_dir)
+        is None
+    )
+    # 内容が変わっていれば確認日時は更新しない
+    assert not index.refresh_if_unchanged(
+        prefix_dir, target_isbn, gcs_module.content_digest('{"a":2}')
+    )
+    assert index.refresh_if_unchanged(
+        prefix_dir, target_isbn, gcs_module.content_digest(json_str)
+    )
+    assert index.flush() == 1
+
+    index = gcs_module.OaiPmhCacheIndex()
+    entry = index.lookup(prefix_dir, target_isbn)
+    assert entry.time_created == created
+    assert entry.verified_at == later
+    result_io = gcs_module.get_cached_oai_pmh_file_with_index(
+        index, target_isbn, prefix_dir
+    )
+    assert result_io is not None
+    assert result_io.read() == json_str.encode("utf-8")
+
+
+def test_put_rss_xml_file_skips_unchanged_content(fake_bucket, monkeypatch):
+    """最新のキャッシュと同じ内容の RSS はアップロードせず、validator だけ更新すること"""
+    last_build_date = datetime(2025, 2, 9, 12, 0, 0, tzinfo=ZoneInfo("Asia/Tokyo"))
+    first = gcs_module.put_rss_xml_file(
+        last_build_date, "latest_all", io.BytesIO(b"<rss></rss>"), "30", etag='"v1"'
+    )
+    uploads = []
+    monkeypatch.setattr(
+        gcs_module,
+        "_upload_blob_file",
+        lambda *args, **kwargs: uploads.append(args),
+    )
+
+    blob = gcs_module.put_rss_xml_file(
+        last_build_date, "latest_all", io.BytesIO(b"<rss></rss>"), "30", etag='"v2"'
+    )
+
+    assert uploads == []
+    assert blob.name == first.name
+    pointer = gcs_module.get_rss_validators("latest_all", "30")
+    assert pointer is not None
+    assert pointer.etag == '"v2"'
+    assert pointer.digest == gcs_module.content_digest(b"<rss></rss>")
+
+
+def test_oai_pmh_cache_index_flush_merges_concurrent_updates(fake_bucket):
+    """別の実行が先に索引を更新していても、flush でマージされること"""
+    prefix_dir = "isbn"
+    # 同じ shard に入る identifier を2つ用意する
+    shard = gcs_module.OaiPmhCacheIndex._shard_of("9784621310328")
+    other = next(
+        f"978462131{i:04d}"
+        for i in range(10000)
+        if gcs_module.OaiPmhCacheIndex._shard_of(f"978462131{i:04d}") == shard
+        and f"978462131{i:04d}" != "9784621310328"
+    )
+
+    index_a = gcs_module.OaiPmhCacheIndex()
+    index_b = gcs_module.OaiPmhCacheIndex()
+    index_a.record(prefix_dir, "9784621310328", FakeBlob("a.json"))
+    index_b.record(prefix_dir, other, FakeBlob("b.json"))
+    index_a.flush()
+    index_b.flush()
+
+    index = gcs_module.OaiPmhCacheIndex()
+    assert index.lookup(prefix_dir, "9784621310328").blob_name == "a.json"
+    assert index.lookup(prefix_dir, other).blob_name == "b.json"
+
+
+def test_gc_cache_blobs_keeps_newest_per_key(tmp_path, monkeypatch):
+    """キーごとに最も新しいキャッシュだけを残し、"_" で始まる pointer などは削除しない"""
+    bucket = LocalBucket(tmp_path)
+    monkeypatch.setattr(gcs_module, "_get_bucket", lambda: bucket)
+    monkeypatch.setattr(gcs_module, "CACHE_GC_DELETE_BATCH_SIZE", 2)
+    base = gcs_module.RSS_RAW_DIR
+    # 古い順に書き込む
+    for name in [
+        f"{base}/latest_all_30/20250209_090000_0900.xml",
+        f"{base}/latest_all_30/20250209_100000_0900.xml",
+        f"{base}/latest_all_30/20250209_110000_0900.xml",
+        f"{base}/latest_all_30/20250210_090000_0900.xml",
+        f"{base}/latest_book_30/20250209_090000_0900.xml",
+        f"{base}/latest_all_30/_latest.json",
+        f"{base}/_checkpoint/20250209.json",
+    ]:
+        bucket.blob(name).upload_from_string("x" * 10)
+
+    dry = gcs_module.gc_cache_blobs(base, gcs_module.rss_cache_key, dry_run=True)
+    assert (dry.scanned, dry.kept, dry.deleted) == (5, 3, 2)
+    assert len(list(bucket.list_blobs(prefix=base))) == 7
+
+    result = gcs_module.gc_cache_blobs(base, gcs_module.rss_cache_key)
+
+    assert (result.deleted, result.reclaimed_bytes) == (2, 20)
+    assert sorted(b.name for b in bucket.list_blobs(prefix=base)) == [
+        f"{base}/_checkpoint/20250209.json",
+        f"{base}/latest_all_30/20250209_110000_0900.xml",
+        f"{base}/latest_all_30/20250210_090000_0900.xml",
+        f"{base}/latest_all_30/_latest.json",
+        f"{base}/latest_book_30/20250209_090000_0900.xml",
+    ]
+
+
+def test_gc_cache_blobs_counts_only_deleted_blobs(tmp_path, monkeypatch):
+    """削除できなかったもの (一覧の後に書き換えられたものなど) は削除した数とサイズに含めない"""
+    bucket = LocalBucket(tmp_path)
+    monkeypatch.setattr(gcs_module, "_get_bucket", lambda: bucket)
+    base = gcs_module.RSS_RAW_DIR
+    for name in [
+        f"{base}/latest_all_30/20250209_090000_0900.xml",
+        f"{base}/latest_all_30/20250209_100000_0900.xml",
+        f"{base}/latest_all_30/20250209_110000_0900.xml",
+    ]:
+        bucket.blob(name).upload_from_string("x" * 10)
+    delete_blobs = gcs_module.delete_blobs
+
+    def overwrite_then_delete(blobs):
+        # 一覧の後に1件が書き換えられた
+        bucket.blob(blobs[0].name).upload_from_string("y" * 10)
+        return delete_blobs(blobs)
+
+    monkeypatch.setattr(gcs_module, "delete_blobs", overwrite_then_delete)
+
+    result = gcs_module.gc_cache_blobs(base, gcs_module.rss_cache_key)
+
+    assert (result.deleted, result.reclaimed_bytes) == (1, 10)
+    assert len(list(bucket.list_blobs(prefix=f"{base}/latest_all_30"))) == 2
+
+
+def test_delete_blobs_returns_only_successful_batch_responses(monkeypatch):
+    """GCS の batch request では、2xx の応答のものだけを削除できたものとして返す"""
+    requests_sent = []
+
+    class FakeSession:
+        """batch request を受け取り、削除ごとに 204, 404, 503 を返す"""
+
+        def request(self, method, url, data=None, headers=None, **kwargs):
+            requests_sent.append((method, url, data))
+            parts = "".join(
+                f"--batch_x\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{i}>\r\n\r\n"
+                f"HTTP/1.1 {status} X\r\nContent-Length: 0\r\n\r\n\r\n"
+                for i, status in enumerate([204, 404, 503])
+            )
+            response = requests.Response()
+            response.status_code = 200
+            response.headers["content-type"] = "multipart/mixed; boundary=batch_x"
+            response._content = (parts + "--batch_x--\r\n").encode("utf-8")
+            return response
+
+    client = gcs.Client(
+        project="test", credentials=AnonymousCredentials(), _http=FakeSession()
+    )
+    bucket = client.bucket("bucket")
+    monkeypatch.setattr(gcs_module, "_get_bucket", lambda: bucket)
+    blobs = [bucket.blob(name, generation=1) for name in "abc"]
+
+    assert [b.name for b in gcs_module.delete_blobs(blobs)] == ["a"]
+    # 3件の削除を1回の batch request で送る
+    assert len(requests_sent) == 1
+    assert requests_sent[0][1].endswith("/batch/storage/v1")
+
+
+def test_gc_cache_blobs_keeps_newest_rss_per_day(tmp_path, monkeypatch):
+    """RSS のキャッシュは日ごとに最も新しいものだけを残し、pointer は削除しない"""
+    bucket = LocalBucket(tmp_path)
+    monkeypatch.setattr(gcs_module, "_get_bucket", lambda: bucket)
+    jst = ZoneInfo("Asia/Tokyo")
+    for day, hour in [(9, 9), (9, 12), (10, 9), (10, 8)]:
+        gcs_module.put_rss_xml_file(
+            datetime(2025, 2, day, hour, 0, 0, tzinfo=jst),
+            "latest_all",
+            io.BytesIO(f"<rss>{day} {hour}</rss>".encode()),
+            "30",
+        )
+
+    result = gcs_module.gc_cache_blobs(gcs_module.RSS_RAW_DIR, gcs_module.rss_cache_key)
+
+    assert result.deleted == 2
+    prefix = f"{gcs_module.RSS_RAW_DIR}/latest_all_30"
+    # 同日の中では後から書き込んだものを残す
+    assert sorted(b.name for b in bucket.list_blobs(prefix=prefix)) == [
+        f"{prefix}/20250209_120000_0900.xml",
+        f"{prefix}/20250210_080000_0900.xml",
+        f"{prefix}/_latest.json",
+    ]
+
+
+def test_masterdata_checkpoint_segments(tmp_path, monkeypatch):
+    """チェックポイントはカーソルまでの segment を順に読み、削除では segment とカーソルをまとめて消す"""
+    bucket = LocalBucket(tmp_path)
+    monkeypatch.setattr(gcs_module, "_get_bucket", lambda: bucket)
+    assert gcs_module.get_masterdata_checkpoint_segments("sig") == []
+
+    for segment in range(2):
+        gcs_module.put_masterdata_checkpoint_segment(
+            "sig", segment, f'{{"n":{segment}}}'
+        )
+        gcs_module.put_masterdata_checkpoint_cursor("sig", segment + 1)
+    # カーソルを更新する前に止まった segment は読まない
+    gcs_module.put_masterdata_checkpoint_segment("sig", 2, '{"n":2}')
+
+    assert gcs_module.get_masterdata_checkpoint_segments("sig") == [
+        '{"n":0}',
+        '{"n":1}',
+    ]
+    # 別の signature のチェックポイントは消さない
+    gcs_module.put_masterdata_checkpoint_segment("sig2", 0, '{"n":0}')
+    gcs_module.delete_masterdata_checkpoint("sig")
+    assert gcs_module.get_masterdata_checkpoint_segments("sig") == []
+    assert [b.name for b in bucket.list_blobs(prefix=gcs_module.MASTERDATA_DIR)] == [
+        f"{gcs_module.MASTERDATA_CHECKPOINT_DIR}/sig2/0.json"
+    ]
+    gcs_module.delete_masterdata_checkpoint("sig")
+
+
+def test_masterdata_publish_marker(tmp_path, monkeypatch):
+    """公開済みや公開中の marker があれば claim できず、lease を過ぎた marker や release した marker は claim し直せる"""
+    bucket = LocalBucket(tmp_path)
+    monkeypatch.setattr(gcs_module, "_get_bucket", lambda: bucket)
+    monkeypatch.setattr(gcs_module, "MASTERDATA_PUBLISH_LEASE_SECONDS", 60)
+    now = datetime(2025, 2, 11, 12, 0, 0, tzinfo=ZoneInfo("Asia/Tokyo"))
+    monkeypatch.setattr(gcs_module, "get_now", lambda: now)
+
+    generation = gcs_module.claim_masterdata_publish("sig", "none")
+    assert generation is not None
+    # 公開中
+    assert gcs_module.claim_masterdata_publish("sig", "none") is None
+    # 失敗したら release して claim し直せる
+    gcs_module.release_masterdata_publish("sig", "none", generation)
+    generation = gcs_module.claim_masterdata_publish("sig", "none")
+    assert generation is not None
+
+    # lease を過ぎたら引き継ぐ。元のタスクは完了を書けない
+    now = now + timedelta(seconds=61)
+    taken = gcs_module.claim_masterdata_publish("sig", "none")
+    assert taken is not None and taken != generation
+    gcs_module.complete_masterdata_publish("sig", "none", generation)
+    gcs_module.complete_masterdata_publish("sig", "none", taken)
+
+    # 公開済みなら lease に関係なく claim できない
+    now = now + timedelta(days=1)
+    assert gcs_module.claim_masterdata_publish("sig", "none") is None
+    # 別の放送日時は別に公開する
+    assert gcs_module.claim_masterdata_publish("sig", "20250212_060000") is not None
+
+
+def test_batch_uploader_uploads_concurrently_with_retries():
+    """積んだ書き込みを並行にアップロードし、失敗したものは再試行して、積んだ順の結果を返す"""
+    lock = threading.Lock()
+    running = {"count": 0, "max": 0}
+    attempts: dict[str, int] = {}
+
+    def fake_upload(write):
+        with lock:
+            running["count"] += 1
+            running["max"] = max(running["max"], running["count"])
+            attempts[write.blob_path] = attempts.get(write.blob_path, 0) + 1
+            attempt = attempts[write.blob_path]
+        time.sleep(0.01)
+        with lock:
+            running["count"] -= 1
+        if write.blob_path == "flaky" and attempt == 1:
+            raise TimeoutError("dummy timeout")
+        if write.blob_path == "broken":
+            raise TimeoutError("always fails")
+        return FakeBlob(write.blob_path)
+
+    uploaded = []
+    uploader = gcs_module.BatchUploader(
+        max_workers=4, max_attempts=2, retry_wait_seconds=0, upload=fake_upload
+    )
+    paths = [f"p{i}" for i in range(8)] + ["flaky", "broken"]
+    for path in paths:
+        uploader.submit(
+            gcs_module.BlobWrite(blob_path=path, payload="{}", metadata={}),
+            on_uploaded=lambda blob: uploaded.append(blob.name),
+        )
+
+    results = uploader.join()
+
+    assert [r.blob_path for r in results] == paths
+    assert running["max"] > 1
+    flaky, broken = results[-2:]
+    assert flaky.ok and flaky.attempts == 2
+    assert not broken.ok and broken.attempts == 2 and broken.blob is None
+    assert sorted(uploaded) == sorted(paths[:-1])
+    with pytest.raises(ValueError):
+        uploader.submit(gcs_module.BlobWrite(blob_path="late", payload="", metadata={}))
+
+
+def test_oai_pmh_json_write_matches_put_oai_pmh_json(fake_bucket):
+    """BatchUploader に積む書き込みは put_oai_pmh_json と同じパスに同じ内容を置く"""
+    write = gcs_module.oai_pmh_json_write("9784621310328", "isbn", '{"a":1}')
+    blob = gcs_module.put_blob_write(write)
+    assert blob.name == f"{gcs_module.OAI_PMH_RAW_DIR}/isbn/9784621310328.json"
+    assert gzip.decompress(blob._content) == b'{"a":1}'
+    assert blob.metadata[gcs_module.CONTENT_DIGEST_METADATA_KEY] == (
+        gcs_module.content_digest('{"a":1}')
+    )
+
+
+def test_list_blob_listings_requests_only_needed_fields(fake_bucket):
+    """一覧は必要なフィールドとページの区切りだけを要求し、軽量な BlobListing を返す"""
+    created = datetime(2025, 2, 9, 0, 0, 0, tzinfo=ZoneInfo("UTC"))
+    blob = fake_bucket.blob("private/oai_pmh/isbn/9784621310328.json")
+    blob._content = b"{}"
+    blob.size = 2
+    blob.generation = 5
+    blob.time_created = created
+
+    listings = list(
+        gcs_module.list_blob_listings("private/oai_pmh/isbn/", page_size=50)
+    )
+
+    assert listings == [
+        gcs_module.BlobListing(
+            name="private/oai_pmh/isbn/9784621310328.json",
+            generation=5,
+            time_created=created,
+            size=2,
+        )
+    ]
+    call = fake_bucket.list_calls[-1]
+    assert call["page_size"] == 50
+    assert call["fields"] == "items(name,generation,timeCreated,size),nextPageToken"
+    with pytest.raises(ValueError):
+        list(gcs_module.list_blob_listings(""))
+
+
+def test_get_json_file_uses_read_cache_per_generation(tmp_path, monkeypatch):
+    """同じ generation はダウンロードせずにキャッシュから返し、置き換えられたら新しい内容を読む"""
+    bucket = LocalBucket(tmp_path / "bucket")
+    monkeypatch.setattr(gcs_module, "_get_bucket", lambda: bucket)
+    monkeypatch.setattr(
+        gcs_module,
+        "_read_cache",
+        BlobReadCache(tmp_path / "cache", 1024 * 1024, 1024 * 1024),
+    )
+    downloads = []
+    metadata_gets = []
+    download_blob_bytes = gcs_module._download_blob_bytes
+    get_blob = bucket.get_blob
+
+    def counting_download_blob_bytes(blob):
+        downloads.append(blob.name)
+        return download_blob_bytes(blob)
+
+    def counting_get_blob(blob_name, **kwargs):
+        metadata_gets.append(blob_name)
+        return get_blob(blob_name, **kwargs)
+
+    monkeypatch.setattr(
+        gcs_module, "_download_blob_bytes", counting_download_blob_bytes
+    )
+    monkeypatch.setattr(bucket, "get_blob", counting_get_blob)
+
+    blob = gcs_module.put_combined_json_file("sig", '{"a": 1}')
+    # 初めて読む場合は metadata を取得せずにダウンロードだけを行う
+    assert gcs_module.get_json_file(blob.name) == '{"a": 1}'
+    assert (downloads, metadata_gets) == ([blob.name], [])
+    # 2回目は metadata だけを取得して、ダウンロードしない
+    assert gcs_module.get_json_file(blob.name) == '{"a": 1}'
+    assert (downloads, metadata_gets) == ([blob.name], [blob.name])
+
+    # 別のプロセス (メモリが空) でもディスクから読める
+    monkeypatch.setattr(
+        gcs_module,
+        "_read_cache",
+        BlobReadCache(tmp_path / "cache", 1024 * 1024, 1024 * 1024),
+    )
+    assert gcs_module.get_json_file(blob.name) == '{"a": 1}'
+    assert downloads == [blob.name]
+
+    gcs_module.put_combined_json_file("sig", '{"a": 2}')
+    assert gcs_module.get_json_file(blob.name) == '{"a": 2}'
+    assert downloads == [blob.name, blob.name]
+
+    with pytest.raises(NotFound):
+        gcs_module.get_json_file("private/masterdata/missing.json")
+
+
+def test_iter_cached_ndjson_file_reads_partition_once(tmp_path, monkeypatch):
+    """日付ごとの masterdata は、同じ generation ならダウンロードせずにキャッシュから読む"""
+    bucket = LocalBucket(tmp_path / "bucket")
+    monkeypatch.setattr(gcs_module, "_get_bucket", lambda: bucket)
+    monkeypatch.setattr(gcs_module, "_read_cache", BlobReadCache(None, 1024 * 1024, 0))
+    downloads = []
+    download_blob_bytes = gcs_module._download_blob_bytes
+
+    def counting_download_blob_bytes(blob):
+        downloads.append(blob.name)
+        return download_blob_bytes(blob)
+
+    monkeypatch.setattr(
+        gcs_module, "_download_blob_bytes", counting_download_blob_bytes
+    )
+
+    lines = ['{"n":1}', '{"n":2}']
+    blob = gcs_module.put_masterdata_partition("sig", "20250211", lines)
+    for _ in range(2):
+        assert list(gcs_module.iter_cached_ndjson_file(blob.name)) == [
+            b'{"n":1}',
+            b'{"n":2}',
+        ]
+    assert downloads == [blob.name]
+
+
+def test_gc_masterdata_work_blobs_deletes_abandoned_signatures(fixed_now, monkeypatch):
+    """signature ごとに全てのファイルが古いものだけを削除し、更新中のチェックポイントは一部も削除しない"""
+    base = gcs_module.MASTERDATA_CHECKPOINT_DIR
+    old = fixed_now - timedelta(days=8)
+    listings = [
+        gcs_module.BlobListing(name=f"{base}/failed/0.json", time_created=old, size=10),
+        gcs_module.BlobListing(
+            name=f"{base}/failed/_cursor.json", time_created=old, size=5
+        ),
+        gcs_module.BlobListing(name=f"{base}/legacy.json", time_created=old, size=20),
+        gcs_module.BlobListing(
+            name=f"{base}/running/0.json", time_created=old, size=10
+        ),
+        gcs_module.BlobListing(
+            name=f"{base}/running/1.json", time_created=fixed_now, size=10
+        ),
+    ]
+    deleted = []
+    monkeypatch.setattr(gcs_module, "get_now", lambda: fixed_now)
+    monkeypatch.setattr(
+        gcs_module, "list_blob_listings", lambda prefix, page_size: iter(listings)
+    )
+    monkeypatch.setattr(
+        gcs_module, "_delete_listings", lambda blobs: deleted.extend(blobs) or blobs
+    )
+
+    dry = gcs_module.gc_masterdata_work_blobs(base, 7, dry_run=True)
+    assert (dry.scanned, dry.kept, dry.deleted, dry.reclaimed_bytes) == (5, 2, 3, 35)
+    assert deleted == []
+
+    result = gcs_module.gc_masterdata_work_blobs(base, 7)
+    assert (result.kept, result.deleted) == (2, 3)
+    assert sorted(b.name for b in deleted) == [
+        f"{base}/failed/0.json",
+        f"{base}/failed/_cursor.json",
+        f"{base}/legacy.json",
+    ]
+
+
+def test_llm_response_cache_and_gc(fake_bucket, fixed_now, monkeypatch):
+    """LLM の応答は有効日数の間だけ返し、GC は古いものと合計サイズの上限を超えたものを削除する"""
+    monkeypatch.setattr(gcs_module, "get_now", lambda: fixed_now)
+    monkeypatch.setattr(
+        gcs_module, "delete_blobs", lambda blobs: deleted.extend(blobs) or blobs
+    )
+    deleted = []
+
+    blob = gcs_module.put_llm_response("k1", "<script>台本</script>")
+    assert blob.name == "private/llm_cache/k1.json"
+    assert gcs_module.get_llm_response("k1") == "<script>台本</script>"
+    assert gcs_module.get_llm_response("missing") is None
+
+    blob.time_created = fixed_now - timedelta(
+        days=gcs_module.LLM_RESPONSE_CACHE_DAYS + 1
+    )
+    assert gcs_module.get_llm_response("k1") is None
+
+    for i, days in enumerate([0, 1, 2]):
+        b = gcs_module.put_llm_response(f"n{i}", "x" * 100)
+        b.size = 100
+        b.time_created = fixed_now - timedelta(days=days)
+    blob.size = 10
+
+    result = gcs_module.gc_llm_response_cache(max_bytes=250)
+    assert result.scanned == 4
+    assert result.kept == 2
+    assert sorted(b.name for b in deleted) == [
+        "private/llm_cache/k1.json",
+        "private/llm_cache/n2.json",
+    ]
+    assert result.reclaimed_bytes == 110
@@ -1,23 +1,40 @@
 import time
+from contextlib import contextmanager
 from datetime import UTC, datetime
+from types import SimpleNamespace
 
 import feedparser
 import httpx
 import pytest
 import tenacity
 
-from src.book.feed import convert_to_entry_item, fetch_rss, parse_rss
+from src import http_client
+from src.book.feed import (
+    FeedEntry,
+    RssStreamParser,
+    convert_to_entry_item,
+    fetch_rss,
+    fetch_rss_conditional,
+    iter_rss_entries,
+    parse_rss,
+    stream_rss,
+)
 from src.logger import logger
 
 
 # FakeResponse の定義（すでに定義済みの場合はそのまま利用）
 class FakeResponse:
     def __init__(
-        self, text: str, status_code: int = 200, raise_exception: bool = False
+        self,
+        text: str,
+        status_code: int = 200,
+        raise_exception: bool = False,
+        headers: dict[str, str] | None = None,
     ):
         self.text = text
         self.status_code = status_code
         self.raise_exception = raise_exception
+        self.headers = headers or {}
 
     def raise_for_status(self):
         if self.raise_exception:
@@ -25,20 +42,74 @@ class FakeResponse:
             raise httpx.HTTPStatusError("Dummy error", request=None, response=self)
 
 
+def _patch_client_get(monkeypatch, fake_get):
+    monkeypatch.setattr(
+        http_client, "get_client", lambda url: SimpleNamespace(get=fake_get)
+    )
+
+
 def test_fetch_rss_success(monkeypatch):
-    """正常系: httpx.get で取得した RSS XML が返る"""
+    """正常系: 共有の httpx.Client で取得した RSS XML が返る"""
     dummy_xml = "<rss><channel><title>Test Feed</title></channel></rss>"
 
     def fake_get(url, timeout):
         return FakeResponse(dummy_xml, status_code=200)
 
-    # httpx.get を差し替え
-    monkeypatch.setattr(httpx, "get", fake_get)
+    # 共有の httpx.Client の get を差し替え
+    _patch_client_get(monkeypatch, fake_get)
 
     result = fetch_rss("http://dummy.url/rss")
     assert result == dummy_xml
 
 
+def test_fetch_rss_conditional_returns_validators(monkeypatch):
+    """200 の場合は本文と ETag / Last-Modified が返る"""
+    dummy_xml = "<rss><channel><title>Test Feed</title></channel></rss>"
+    requested_headers = []
+
+    def fake_get(url, headers, timeout):
+        requested_headers.append(headers)
+        return FakeResponse(
+            dummy_xml,
+            headers={"ETag": '"v1"', "Last-Modified": "Sun, 09 Feb 2025 00:00:00 GMT"},
+        )
+
+    _patch_client_get(monkeypatch, fake_get)
+
+    result = fetch_rss_conditional("http://dummy.url/rss")
+    assert requested_headers == [{}]
+    assert result.raw_xml == dummy_xml
+    assert result.etag == '"v1"'
+    assert result.last_modified == "Sun, 09 Feb 2025 00:00:00 GMT"
+    assert not result.not_modified
+
+
+def test_fetch_rss_conditional_not_modified(monkeypatch):
+    """validator を送り、304 の場合は not_modified が返る"""
+    requested_headers = []
+
+    def fake_get(url, headers, timeout):
+        requested_headers.append(headers)
+        return FakeResponse("", status_code=304)
+
+    _patch_client_get(monkeypatch, fake_get)
+
+    result = fetch_rss_conditional(
+        "http://dummy.url/rss",
+        etag='"v1"',
+        last_modified="Sun, 09 Feb 2025 00:00:00 GMT",
+    )
+    assert requested_headers == [
+        {
+            "If-None-Match": '"v1"',
+            "If-Modified-Since": "Sun, 09 Feb 2025 00:00:00 GMT",
+        }
+    ]
+    assert result.not_modified
+    assert result.raw_xml == ""
+    assert result.etag == '"v1"'
+
+
 @pytest.mark.skip("adhoc")
 def test_fetch_rss_retry_failure(monkeypatch):
     """失敗系: HTTPStatusError を毎回発生させ、最終的にリトライ上限に達して RetryError が上がること、
@@ -52,7 +123,7 @@ def test_fetch_rss_retry_failure(monkeypatch):
 
     # テスト中の待ち時間をゼロにするため、time.sleep を no-op に置き換え
     monkeypatch.setattr(time, "sleep", lambda seconds: None)
-    monkeypatch.setattr(httpx, "get", fake_get)
+    _patch_client_get(monkeypatch, fake_get)
 
     with pytest.raises(tenacity.RetryError) as exc_info:
         fetch_rss("http://dummy.url/rss")
@@ -187,3 +258,132 @@ def test_convert_to_entry_item_empty_id():
     assert entry.repo == ""
     assert entry.isbn == ""
     assert entry.jp_e_code == ""
+
+
+STREAM_RSS_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<channel>
+<title>Test Feed</title>
+<lastBuildDate>Sun, 09 Feb 2025 19:20:30 +0900</lastBuildDate>
+<item>
+<title>はじめての　シールえほん</title>
+<link>https://ndlsearch.ndl.go.jp/books/R100000137-I9784065386859</link>
+<description>講談社. ISBN:9784065386859</description>
+<guid isPermaLink="true">https://ndlsearch.ndl.go.jp/books/R100000137-I9784065386859</guid>
+<category>図書</category>
+<pubDate>Sat, 21 Dec 2024 18:46:00 +0900</pubDate>
+<dc:creator>ディック・ブルーナ</dc:creator>
+</item>
+<item>
+<title>Test &amp; Title</title>
+<link>https://ndlsearch.ndl.go.jp/books/R100000137-I01234567890123456789</link>
+<description>Test summary</description>
+<guid isPermaLink="true">https://ndlsearch.ndl.go.jp/books/R100000137-I01234567890123456789</guid>
+<pubDate>Sun, 09 Feb 2025 19:20:30 +0900</pubDate>
+</item>
+</channel>
+</rss>"""
+
+
+def test_rss_stream_parser_matches_feedparser():
+    """断片ごとに読み込んでも、feedparser + convert_to_entry_item と同じ FeedEntry が得られること"""
+    raw = STREAM_RSS_XML.encode("utf-8")
+    parser = RssStreamParser()
+    chunks = iter([raw[i : i + 17] for i in range(0, len(raw), 17)])
+    entries = list(iter_rss_entries(chunks, parser))
+
+    feed, last_build_date = parse_rss(STREAM_RSS_XML)
+    expected = [convert_to_entry_item(entry) for entry in feed.entries]
+
+    assert parser.last_build_date == last_build_date
+    assert len(entries) == len(expected) == 2
+    for entry, expected_entry in zip(entries, expected, strict=True):
+        for field in FeedEntry.model_fields:
+            assert getattr(entry, field) == getattr(expected_entry, field), field
+
+
+def test_rss_stream_parser_yields_entries_before_end():
+    """閉じた item はフィードの最後まで読み込む前に返されること"""
+    raw = STREAM_RSS_XML.encode("utf-8")
+    first_item_end = raw.index(b"</item>") + len(b"</item>")
+    parser = RssStreamParser()
+
+    entries = parser.feed(raw[:first_item_end])
+    assert parser.last_build_date == datetime(2025, 2, 9, 10, 20, 30, tzinfo=UTC)
+    assert [e.isbn for e in entries] == ["9784065386859"]
+
+    entries = parser.feed(raw[first_item_end:]) + parser.close()
+    assert [e.jp_e_code for e in entries] == ["01234567890123456789"]
+    # lastBuildDate は item より先にある
+    assert parser.items_before_last_build_date is False
+
+
+def test_rss_stream_parser_sanitizes_summary_like_feedparser():
+    """description の HTML は feedparser と同じく危険なタグや属性を取り除くこと"""
+    xml = """<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0"><channel><title>Test Feed</title>
+<item>
+<title>a</title>
+<link>https://ndlsearch.ndl.go.jp/books/R100000137-I9784065386859</link>
+<description>&lt;b onclick="x()"&gt;太字&lt;/b&gt;&lt;script&gt;alert(1)&lt;/script&gt; &amp;amp; ok</description>
+</item>
+<item>
+<title>b</title>
+<link>https://ndlsearch.ndl.go.jp/books/R100000137-I9784065386860</link>
+<description><![CDATA[<p>para</p><iframe src="x"></iframe> 1 &lt; 2]]></description>
+</item>
+</channel></rss>"""
+    parser = RssStreamParser()
+    entries = list(iter_rss_entries(iter([xml.encode("utf-8")]), parser))
+
+    feed, _ = parse_rss(xml)
+    assert [e.summary for e in entries] == [e.summary for e in feed.entries]
+    assert entries[0].summary == "<b>太字</b> &amp; ok"
+
+
+def _patch_client_stream(monkeypatch, chunks):
+    class FakeStreamResponse(FakeResponse):
+        def iter_bytes(self):
+            yield from chunks()
+
+    @contextmanager
+    def fake_stream(method, url, headers, timeout):
+        yield FakeStreamResponse("")
+
+    monkeypatch.setattr(
+        http_client, "get_client", lambda url: SimpleNamespace(stream=fake_stream)
+    )
+
+
+def test_stream_rss_does_not_log_consumer_errors_as_fetch_failure(monkeypatch):
+    """with の中で呼び出し側が投げた例外は、RSS の取得の失敗としてログに残さないこと"""
+    errors = []
+    monkeypatch.setattr(
+        logger, "error", lambda msg, *args, **kwargs: errors.append(msg)
+    )
+    _patch_client_stream(monkeypatch, lambda: iter([b"<rss>"]))
+
+    with pytest.raises(ValueError):
+        with stream_rss("http://dummy.url/rss") as response:
+            list(response.chunks)
+            raise ValueError("consumer error")
+    assert errors == []
+
+
+def test_stream_rss_logs_errors_while_receiving(monkeypatch):
+    """本文の受信中の失敗は RSS の取得の失敗としてログに残すこと"""
+    errors = []
+    monkeypatch.setattr(
+        logger, "error", lambda msg, *args, **kwargs: errors.append(msg)
+    )
+
+    def broken_chunks():
+        yield b"<rss>"
+        raise httpx.ReadTimeout("dummy timeout")
+
+    _patch_client_stream(monkeypatch, broken_chunks)
+
+    with pytest.raises(httpx.ReadTimeout):
+        with stream_rss("http://dummy.url/rss") as response:
+            list(response.chunks)
+    assert "RSS フィードの取得に失敗しました: http://dummy.url/rss" in errors
@@ -0,0 +1,106 @@
+from datetime import UTC, datetime
+from types import SimpleNamespace
+
+import pytest
+from lxml import etree
+
+from src.book import oai_pmh
+from src.book.oai_pmh import (
+    IDENTIFIER_TYPE_ISBN,
+    IDENTIFIER_TYPE_JP_E_CODE,
+    list_record_pages,
+    parse_oai_identifier,
+)
+
+
+def _list_records_xml(identifiers: list[str], token: str | None) -> bytes:
+    records = "".join(
+        f"""<record>
+<header><identifier>{identifier}</identifier><datestamp>2025-02-09T00:00:00Z</datestamp></header>
+<metadata><dc xmlns="http://purl.org/dc/elements/1.1/"><title>{identifier}</title></dc></metadata>
+</record>"""
+        for identifier in identifiers
+    )
+    token_xml = f"<resumptionToken>{token}</resumptionToken>" if token else ""
+    return f"""<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<ListRecords>{records}{token_xml}</ListRecords>
+</OAI-PMH>""".encode()
+
+
+@pytest.mark.parametrize(
+    "oai_identifier, expected",
+    [
+        (
+            "oai:ndlsearch.ndl.go.jp:R100000137-I9784621310328",
+            (IDENTIFIER_TYPE_ISBN, "9784621310328"),
+        ),
+        (
+            "oai:ndlsearch.ndl.go.jp:R100000137-I09D154490010d0000000",
+            (IDENTIFIER_TYPE_JP_E_CODE, "09D154490010d0000000"),
+        ),
+        ("oai:ndlsearch.ndl.go.jp:R100000137-I123", ("", "")),
+        ("oai:example.com:R100000137-I9784621310328", ("", "")),
+    ],
+)
+def test_parse_oai_identifier(oai_identifier, expected):
+    assert parse_oai_identifier(oai_identifier) == expected
+
+
+def test_list_record_pages_follows_resumption_token(monkeypatch):
+    """resumptionToken を辿って全ページを取得し、ページごとに次の token を返すこと"""
+    pages = {
+        None: _list_records_xml(
+            ["oai:ndlsearch.ndl.go.jp:R100000137-I9784621310328"], "token-1"
+        ),
+        "token-1": _list_records_xml(
+            ["oai:ndlsearch.ndl.go.jp:R100000137-I09D154490010d0000000"], None
+        ),
+    }
+    calls = []
+    parsed = []
+
+    class FakeResponse:
+        """sickle の OAIResponse と同じく、xml にアクセスするたびにパースする"""
+
+        def __init__(self, raw: bytes):
+            self.raw = raw
+
+        @property
+        def xml(self):
+            parsed.append(self.raw)
+            return etree.fromstring(self.raw)
+
+    def fake_harvest(**params):
+        calls.append(params)
+        return FakeResponse(pages[params.get("resumptionToken")])
+
+    monkeypatch.setattr(oai_pmh.sickle_client, "harvest", fake_harvest)
+
+    from_date = datetime(2025, 2, 8, 0, 0, 0, tzinfo=UTC)
+    until_date = datetime(2025, 2, 9, 0, 0, 0, tzinfo=UTC)
+    result = list(list_record_pages(from_date, until_date))
+
+    assert len(result) == 2
+    assert result[0].next_resumption_token == "token-1"
+    assert result[0].records[0].identifier == "9784621310328"
+    assert result[1].next_resumption_token is None
+    assert result[1].records[0].identifier_type == IDENTIFIER_TYPE_JP_E_CODE
+    assert calls[0]["from"] == "2025-02-08T00:00:00Z"
+    assert calls[0]["until"] == "2025-02-09T00:00:00Z"
+    assert calls[1] == {"verb": "ListRecords", "resumptionToken": "token-1"}
+    # ページごとに1回だけパースする
+    assert len(parsed) == 2
+
+
+def test_list_record_pages_no_records_match(monkeypatch):
+    xml = b"""<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<error code="noRecordsMatch">no records</error>
+</OAI-PMH>"""
+    monkeypatch.setattr(
+        oai_pmh.sickle_client,
+        "harvest",
+        lambda **params: SimpleNamespace(xml=etree.fromstring(xml)),
+    )
+    from_date = datetime(2025, 2, 8, 0, 0, 0, tzinfo=UTC)
+    until_date = datetime(2025, 2, 9, 0, 0, 0, tzinfo=UTC)
+    assert list(list_record_pages(from_date, until_date)) == []
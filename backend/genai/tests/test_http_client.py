@@ -0,0 +1,58 @@
+import httpx
+import pytest
+
+from src import http_client
+from src.book import oai_pmh
+from src.http_client import HttpClientRegistry
+
+
+def test_registry_shares_client_per_host():
+    """同じホストには同じ httpx.Client を返し、ホストが異なれば別の Client を返す"""
+    registry = HttpClientRegistry(max_connections_per_host=4, http2=False)
+    a = registry.get("https://ndlsearch.ndl.go.jp/api/oaipmh?verb=Identify")
+    b = registry.get("https://ndlsearch.ndl.go.jp/rss/ndls/book.xml")
+    c = registry.get("http://localhost:8000/add_radio_show")
+    assert a is b
+    assert a is not c
+
+    registry.close()
+    assert a.is_closed and c.is_closed
+    with pytest.raises(ValueError):
+        registry.get("https://ndlsearch.ndl.go.jp/")
+
+
+def test_registry_rejects_invalid_url():
+    registry = HttpClientRegistry(http2=False)
+    with pytest.raises(ValueError):
+        registry.get("/relative/path")
+    registry.close()
+
+
+def test_open_and_close_registry():
+    """lifespan で作成したレジストリを get_client が使い、close 後は作り直す"""
+    http_client.close_registry()
+    registry = http_client.open_registry()
+    assert http_client.open_registry() is registry
+    client = http_client.get_client("https://ndlsearch.ndl.go.jp/")
+    http_client.close_registry()
+    assert client.is_closed
+    assert http_client.open_registry() is not registry
+    http_client.close_registry()
+
+
+def test_sickle_requests_through_shared_client(monkeypatch):
+    """OAI-PMH のリクエストが共有の httpx.Client を通ることを確認する"""
+    requested = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested.append(request.url)
+        return httpx.Response(200, text="<OAI-PMH></OAI-PMH>")
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(http_client, "get_client", lambda url: client)
+
+    response = oai_pmh.sickle_client.harvest(verb="Identify")
+
+    assert response.raw == "<OAI-PMH></OAI-PMH>"
+    assert len(requested) == 1
+    assert requested[0].params["verb"] == "Identify"
@@ -1,6 +1,10 @@
+import threading
+import time
+from types import SimpleNamespace
+
 import pytest
 
-from src.llm import agent
+from src.llm import agent, config
 
 
 # 外部依存する LiteLLMModel のダミー実装
@@ -9,6 +13,12 @@ class DummyLiteLLMModel:
         self.model_id = model_id
         self.temperature = temperature
         self.config = config
+        self.kwargs = {"temperature": temperature, "config": config}
+
+
+class DummyMonitor:
+    def get_total_token_counts(self):
+        return {"input": 0, "output": 0}
 
 
 # 外部依存する ToolCallingAgent のダミー実装
@@ -18,20 +28,34 @@ class DummyToolCallingAgent:
         self.model = model
         self.prompt_templates = prompt_templates
         self.max_steps = max_steps
+        self.monitor = DummyMonitor()
 
     def run(self, task: str, stream: bool) -> str:
         # 常に <think> タグを含む文字列を返すことでテスト通過させる
         return "<think>dummy response</think>"
 
 
-def test_call_agent(monkeypatch):
-    """
-    call_agent 関数が、エージェントの run メソッドを呼び出して正しく結果を返すか検証するテスト
-    """
-    # agent モジュール内の LiteLLMModel, ToolCallingAgent, INSTRUCTION_PROMPT をダミーに置き換える
+@pytest.fixture
+def dummy_agents(monkeypatch):
+    """agent モジュール内の LiteLLMModel, ToolCallingAgent, 指示をダミーに置き換え、空のプールを使う"""
     monkeypatch.setattr(agent, "LiteLLMModel", DummyLiteLLMModel)
     monkeypatch.setattr(agent, "ToolCallingAgent", DummyToolCallingAgent)
     monkeypatch.setattr(agent, "INSTRUCTION_PROMPT", "dummy prompt")
+    monkeypatch.setattr(agent, "DIRECT_INSTRUCTION_PROMPT", "dummy direct prompt")
+    pool = agent.AgentPool(max_idle=2)
+    monkeypatch.setattr(agent, "_pool", pool)
+    # 応答のキャッシュはメモリ上に置く
+    responses = {}
+    monkeypatch.setattr(agent, "get_llm_response", responses.get)
+    monkeypatch.setattr(agent, "put_llm_response", responses.__setitem__)
+    pool.responses = responses
+    return pool
+
+
+def test_call_agent(dummy_agents):
+    """
+    call_agent 関数が、エージェントの run メソッドを呼び出して正しく結果を返すか検証するテスト
+    """
 
     # テスト用の文字列を用意して call_agent を呼び出す
     test_text = "test message"
@@ -41,6 +65,307 @@ def test_call_agent(monkeypatch):
     assert result == "<think>dummy response</think>"
 
 
+def test_call_agent_reuses_pooled_agent_with_own_temperature(dummy_agents, monkeypatch):
+    """agent は作り直さずに使い回し、temperature は呼び出しごとの値を使う"""
+    built = []
+    build = agent.AgentPool._build
+
+    def counting_build():
+        a = build()
+        built.append(a)
+        return a
+
+    monkeypatch.setattr(agent.AgentPool, "_build", staticmethod(counting_build))
+    temperatures = []
+    monkeypatch.setattr(
+        DummyToolCallingAgent,
+        "run",
+        lambda self, task, stream: (
+            temperatures.append(self.model.kwargs["temperature"]) or "<think></think>"
+        ),
+    )
+
+    agent.call_agent_with_dataset("a")
+    agent.call_agent_with_dataset("b", temperature=0.5)
+    agent.call_agent_with_dataset("c")
+
+    assert len(built) == 1
+    assert temperatures == [agent.INITIAL_TEMPERATURE, 0.5, agent.INITIAL_TEMPERATURE]
+
+
+def test_retry_raises_temperature_of_the_call_only(dummy_agents, monkeypatch):
+    """再試行で上げた temperature は、次の呼び出しには引き継がない"""
+    monkeypatch.setattr(agent._generate.retry, "sleep", lambda _: None)
+    temperatures = []
+
+    def run(self, task, stream):
+        temperatures.append(self.model.kwargs["temperature"])
+        return "no tags" if len(temperatures) == 1 else "<script>ok</script>"
+
+    monkeypatch.setattr(DummyToolCallingAgent, "run", run)
+
+    assert agent.call_agent_with_dataset("a") == "<script>ok</script>"
+    assert agent.call_agent_with_dataset("b") == "<script>ok</script>"
+    assert temperatures == [
+        pytest.approx(agent.INITIAL_TEMPERATURE),
+        pytest.approx(agent.INITIAL_TEMPERATURE + agent.TEMPERATURE_STEP),
+        pytest.approx(agent.INITIAL_TEMPERATURE),
+    ]
+
+
+def test_call_agent_returns_cached_response_for_same_inputs(dummy_agents, monkeypatch):
+    """同じ入力の応答は LLM を呼ばずに返し、dataset か temperature が違えば呼ぶ"""
+    tasks = []
+
+    def run(self, task, stream):
+        tasks.append(task)
+        return f"<script>{len(tasks)}</script>"
+
+    monkeypatch.setattr(DummyToolCallingAgent, "run", run)
+
+    assert agent.call_agent_with_dataset("a") == "<script>1</script>"
+    assert agent.call_agent_with_dataset("a") == "<script>1</script>"
+    assert agent.call_agent_with_dataset("b") == "<script>2</script>"
+    assert agent.call_agent_with_dataset("a", temperature=0.5) == "<script>3</script>"
+    assert len(tasks) == 3
+    assert agent.response_cache_key("a", 0.1) != agent.response_cache_key("a", 0.2)
+
+    # 台本のない応答は保存しない
+    monkeypatch.setattr(
+        DummyToolCallingAgent, "run", lambda self, task, stream: "<think></think>"
+    )
+    agent.call_agent_with_dataset("c")
+    assert agent.response_cache_key("c", agent.INITIAL_TEMPERATURE) not in (
+        dummy_agents.responses
+    )
+
+
+def test_direct_mode_calls_completion_once(dummy_agents, monkeypatch):
+    """direct では agent を使わずに、同じ指示と safety_settings で completion を1回だけ呼ぶ"""
+    monkeypatch.setattr(agent, "LLM_MODE", "direct")
+    calls = []
+
+    def fake_completion(**kwargs):
+        calls.append(kwargs)
+        return SimpleNamespace(
+            choices=[
+                SimpleNamespace(message=SimpleNamespace(content="<script>ok</script>"))
+            ],
+            usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5),
+        )
+
+    monkeypatch.setattr(agent.litellm, "completion", fake_completion)
+
+    def fail_acquire(sampling):
+        raise AssertionError("agent should not be used")
+
+    monkeypatch.setattr(dummy_agents, "acquire", fail_acquire)
+
+    assert agent.call_agent_with_dataset("data", temperature=0.2) == (
+        "<script>ok</script>"
+    )
+    assert len(calls) == 1
+    assert calls[0]["model"] == agent.MODEL_ID
+    assert calls[0]["temperature"] == 0.2
+    assert calls[0]["config"] == {"safety_settings": agent.safety_settings}
+    assert calls[0]["messages"] == [
+        {"role": "system", "content": "dummy direct prompt"},
+        {"role": "user", "content": "### dataset: \ndata"},
+    ]
+    # direct の応答は agent とは別の指示で作るので、キャッシュも共有しない
+    assert agent.response_cache_key("data", 0.2) != agent.response_cache_key(
+        "data", 0.2, "dummy prompt"
+    )
+
+    monkeypatch.setattr(agent, "LLM_MODE", "unknown")
+    with pytest.raises(ValueError):
+        agent.call_agent_with_dataset("other")
+
+
+def test_direct_prompt_does_not_mention_agent_tool():
+    """direct 用の指示は、agent の final_answer ツールに触れない"""
+    assert "final_answer" in config.INSTRUCTION_PROMPT
+    assert "final_answer" not in config.DIRECT_INSTRUCTION_PROMPT
+    assert "<script></script>" in config.DIRECT_INSTRUCTION_PROMPT
+
+
+def test_hedged_mode_takes_first_valid_candidate(dummy_agents, monkeypatch):
+    """並行生成では、最初に合格した候補を待たずに返し、役に立った回数を数える"""
+    monkeypatch.setattr(agent, "LLM_HEDGE_CANDIDATES", 2)
+    monkeypatch.setattr(agent, "hedge_stats", agent.HedgeStats())
+    release = threading.Event()
+    temperatures = []
+
+    def fake_complete(dataset, sampling):
+        temperatures.append(sampling.temperature)
+        if sampling.temperature == agent.INITIAL_TEMPERATURE:
+            # 最初の候補は遅い
+            release.wait(5)
+            return "<script>slow</script>"
+        return "<script>fast</script>"
+
+    monkeypatch.setattr(agent, "_complete", fake_complete)
+
+    assert agent.call_agent_with_dataset("a") == "<script>fast</script>"
+    release.set()
+    assert sorted(temperatures) == [
+        pytest.approx(agent.INITIAL_TEMPERATURE),
+        pytest.approx(agent.INITIAL_TEMPERATURE + agent.TEMPERATURE_STEP),
+    ]
+    assert agent.hedge_stats.wins_by_hedge == 1
+    assert agent.hedge_stats.paid_off_ratio == 1.0
+    # 遅い候補は取り消さずに結果を捨てるので、無駄になった呼び出しとして数える
+    assert agent.hedge_stats.wasted_calls == 1
+    assert agent.hedge_stats.failed_calls == 0
+
+
+def test_hedged_mode_stops_at_call_cap(dummy_agents, monkeypatch):
+    """不合格の候補が続いても、LLM を呼ぶのは上限の回数まで"""
+    monkeypatch.setattr(agent, "LLM_HEDGE_CANDIDATES", 2)
+    monkeypatch.setattr(agent, "LLM_HEDGE_MAX_CALLS", 3)
+    monkeypatch.setattr(agent, "LLM_HEDGE_BACKOFF_SECONDS", 0)
+    monkeypatch.setattr(agent, "hedge_stats", agent.HedgeStats())
+    calls = []
+
+    def fake_complete(dataset, sampling):
+        calls.append(sampling.temperature)
+        return "no tags"
+
+    monkeypatch.setattr(agent, "_complete", fake_complete)
+
+    with pytest.raises(ValueError):
+        agent.call_agent_with_dataset("a")
+    assert len(calls) == 3
+    assert agent.hedge_stats.failures == 1
+    assert agent.hedge_stats.calls == 3
+    assert agent.hedge_stats.failed_calls == 3
+    assert agent.hedge_stats.wasted_calls == 0
+
+
+def test_hedged_mode_caps_concurrent_hedges(dummy_agents, monkeypatch):
+    """hedge はプロセス全体の上限までしか並行に始めない"""
+    monkeypatch.setattr(agent, "LLM_HEDGE_CANDIDATES", 3)
+    monkeypatch.setattr(agent, "_hedge_slots", threading.BoundedSemaphore(1))
+    monkeypatch.setattr(agent, "hedge_stats", agent.HedgeStats())
+    lock = threading.Lock()
+    running = {"count": 0, "max": 0}
+
+    def fake_complete(dataset, sampling):
+        with lock:
+            running["count"] += 1
+            running["max"] = max(running["max"], running["count"])
+        time.sleep(0.05)
+        with lock:
+            running["count"] -= 1
+        return "<script>ok</script>"
+
+    monkeypatch.setattr(agent, "_complete", fake_complete)
+
+    assert agent.call_agent_with_dataset("a") == "<script>ok</script>"
+    # 最初の候補と、hedge 1つだけ
+    assert running["max"] == 2
+    assert agent.hedge_stats.calls == 2
+
+
+def test_hedged_mode_backs_off_after_failed_candidate(dummy_agents, monkeypatch):
+    """不合格の候補が出たら、待ってから次の候補を始める"""
+    monkeypatch.setattr(agent, "LLM_HEDGE_CANDIDATES", 2)
+    monkeypatch.setattr(agent, "LLM_HEDGE_BACKOFF_SECONDS", 0.2)
+    # hedge の枠がないので、候補は1つずつ実行される
+    monkeypatch.setattr(agent, "_hedge_slots", threading.BoundedSemaphore(1))
+    agent._hedge_slots.acquire()
+    monkeypatch.setattr(agent, "hedge_stats", agent.HedgeStats())
+    started_at = []
+
+    def fake_complete(dataset, sampling):
+        started_at.append(time.monotonic())
+        if len(started_at) == 1:
+            raise RuntimeError("rate limited")
+        return "<script>ok</script>"
+
+    monkeypatch.setattr(agent, "_complete", fake_complete)
+
+    assert agent.call_agent_with_dataset("a") == "<script>ok</script>"
+    assert len(started_at) == 2
+    assert started_at[1] - started_at[0] >= 0.2
+    assert agent.hedge_stats.failed_calls == 1
+    assert agent.hedge_stats.wins_by_hedge == 1
+
+
+def test_iter_script_sentences_across_chunks():
+    """タグや文が chunk をまたいでも、<script> の中身だけを文ごとに返す"""
+    chunks = [
+        "<think>考えます。ここは読まない。</think><scr",
+        'ipt lang="ja">はい、こんにちは！今日は',
+        "本の話です。\n短い。",
+        "最後の文",
+        "です。</scr",
+        "ipt>この後も読まない。",
+    ]
+    consumed = []
+
+    def gen():
+        for chunk in chunks:
+            consumed.append(chunk)
+            yield chunk
+
+    sentences = list(agent.iter_script_sentences(gen(), min_chars=1))
+    assert sentences == [
+        "はい、こんにちは！",
+        "今日は本の話です。",
+        "短い。",
+        "最後の文です。",
+    ]
+    # 応答は最後まで読む
+    assert consumed == chunks
+    # 短い文は次の文とまとめる
+    assert list(agent.iter_script_sentences(chunks, min_chars=10)) == [
+        "はい、こんにちは！今日は本の話です。",
+        "短い。最後の文です。",
+    ]
+    # </script> がなくても受け取った分は返し、<script> がなければ何も返さない
+    assert list(agent.iter_script_sentences(["<script>途中で", "終わる"])) == [
+        "途中で終わる"
+    ]
+    assert list(agent.iter_script_sentences(["<think>のみ</think>"])) == []
+
+
+def test_stream_script_with_dataset_uses_and_fills_cache(dummy_agents, monkeypatch):
+    """ストリーミングでも、台本を含む応答はキャッシュに保存し、次からはキャッシュを返す"""
+    calls = []
+
+    def fake_stream_completion(dataset, temperature):
+        calls.append((dataset, temperature))
+        yield "<script>台本"
+        yield "です。</script>"
+
+    monkeypatch.setattr(agent, "_stream_completion", fake_stream_completion)
+
+    assert list(agent.stream_script_with_dataset("a")) == [
+        "<script>台本",
+        "です。</script>",
+    ]
+    assert list(agent.stream_script_with_dataset("a")) == [
+        "<script>台本です。</script>"
+    ]
+    assert calls == [("a", agent.INITIAL_TEMPERATURE)]
+
+
+def test_agent_pool_lends_each_agent_to_one_caller(dummy_agents):
+    """同時に借りた場合は別の agent を作成し、返却されたものは max_idle 個まで保持する"""
+    pool = agent.AgentPool(max_idle=1)
+    pool.warm_up()
+    sampling = agent.SamplingParams()
+    with pool.acquire(sampling) as first, pool.acquire(sampling) as second:
+        assert first is not second
+    with pool.acquire(sampling) as third:
+        assert third is first or third is second
+    pool.close()
+    with pytest.raises(ValueError):
+        with pool.acquire(sampling):
+            pass
+
+
 def test_extract_script_block_found():
     text = """
 <html>
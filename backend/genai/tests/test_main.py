@@ -1,4 +1,6 @@
+import asyncio
 import json
+import threading
 from datetime import datetime
 from typing import Any
 from uuid import uuid4
@@ -58,6 +60,43 @@ def patch_exec_run_agent_workflow(monkeypatch):
 client = TestClient(main_module.app)
 
 
+class FakeAgentPool:
+    def __init__(self):
+        self.warm_up_threads = []
+
+    def warm_up(self):
+        self.warm_up_threads.append(threading.current_thread())
+
+
+@pytest.fixture
+def fake_agent_pool(monkeypatch):
+    pool = FakeAgentPool()
+    monkeypatch.setattr(main_module.agent, "init_tracing", lambda: None)
+    monkeypatch.setattr(main_module.agent, "open_pool", lambda: pool)
+    monkeypatch.setattr(main_module.agent, "close_pool", lambda: None)
+    return pool
+
+
+async def _run_lifespan():
+    async with main_module.lifespan(main_module.app):
+        pass
+
+
+def test_lifespan_warms_up_agent_pool_off_event_loop(fake_agent_pool, monkeypatch):
+    """agent の作成は event loop のスレッドではなく、スレッドプールで行う"""
+    monkeypatch.setattr(main_module.agent, "LLM_MODE", "agent")
+    asyncio.run(_run_lifespan())
+    assert len(fake_agent_pool.warm_up_threads) == 1
+    assert fake_agent_pool.warm_up_threads[0] is not threading.main_thread()
+
+
+def test_lifespan_skips_agent_warm_up_in_direct_mode(fake_agent_pool, monkeypatch):
+    """direct では agent を使わないので作成しない"""
+    monkeypatch.setattr(main_module.agent, "LLM_MODE", "direct")
+    asyncio.run(_run_lifespan())
+    assert fake_agent_pool.warm_up_threads == []
+
+
 def test_add_user(monkeypatch):
     # given
     dummy_id = str(uuid4())
@@ -1,3 +1,5 @@
+import time
+
 import pytest
 
 import src.tts.google as tts_google
@@ -37,3 +39,17 @@ def test_synthesize(monkeypatch):
 
     # レスポンスの audio_content がダミーの値と一致することを検証
     assert response.audio_content == b"dummy audio content"
+
+
+def test_synthesize_sentences_keeps_order(monkeypatch):
+    """文ごとの読み上げは並行に行い、音声は文の順につなげる"""
+
+    def slow_synthesize(text):
+        # 先の文ほど遅く終わるようにする
+        time.sleep(0.05 / len(text))
+        return DummyResponse(audio_content=text.encode("utf-8"))
+
+    monkeypatch.setattr(tts_google, "synthesize", slow_synthesize)
+
+    audio = tts_google.synthesize_sentences(iter(["a", "bb", "ccc"]), max_workers=3)
+    assert audio == b"abbccc"